@@ -0,0 +1,218 @@
+"""
+Versioned JSON api for the mobile client.
+
+Every response carries an ETag built from the request path and the user's library version, which is bumped on every
+change to their books or tags. A request whose If-None-Match matches gets a 304 before any of the library queries run.
+"""
+import hashlib
+from functools import wraps
+from flask import Blueprint, current_app, g, jsonify, request
+from sqlalchemy import func, literal
+from models import db, Book, Author, Publisher, Subject, SubjectPlace, SubjectPerson, SubjectTime, BookAuthor, \
+    BookPublisher, BookSubject, BookSubjectPlace, BookSubjectPerson, BookSubjectTime, UserBook, Tag, UserTag, \
+    UserBookTag
+
+API_VERSION = 'v1'
+
+api = Blueprint('api', __name__, url_prefix=f'/api/{API_VERSION}')
+
+# (key in the response, vocabulary model, link model, link column) for everything shown on the book detail page
+BOOK_VOCABULARIES = [
+    ('authors', Author, BookAuthor, BookAuthor.author_id),
+    ('publishers', Publisher, BookPublisher, BookPublisher.publisher_id),
+    ('subjects', Subject, BookSubject, BookSubject.subject_id),
+    ('subject_places', SubjectPlace, BookSubjectPlace, BookSubjectPlace.subject_place_id),
+    ('subject_people', SubjectPerson, BookSubjectPerson, BookSubjectPerson.subject_person_id),
+    ('subject_times', SubjectTime, BookSubjectTime, BookSubjectTime.subject_time_id),
+]
+
+
+def api_error(message, status):
+    resp = jsonify({'error': message})
+    resp.status_code = status
+    return resp
+
+
+def library_etag(user, path):
+    """
+    The ETag for the resource at `path` in a user's library. It changes whenever the library version is bumped.
+    The path keeps one resource's ETag from matching another's, which may not exist at all and has to be a 404.
+    """
+
+    path_hash = hashlib.sha1(path.encode()).hexdigest()[:16]
+    return f'{API_VERSION}-{user.id}-{user.library_version}-{path_hash}'
+
+
+def user_library_resource(view):
+    """
+    Authorize the request for the user's library and make it conditional on the library version.
+    The wrapped view returns a dict to serialize, or a response for errors.
+    """
+
+    @wraps(view)
+    def wrapper(user_id, **kwargs):
+        if not g.user:
+            return api_error('You are not authorized.', 401)
+
+        if g.user.id != user_id:
+            return api_error('You are not authorized.', 403)
+
+        etag = library_etag(g.user, request.path)
+        if request.if_none_match.contains(etag):
+            resp = current_app.response_class(status=304)
+        else:
+            body = view(user_id, **kwargs)
+            if not isinstance(body, dict):
+                return body
+            resp = jsonify(body)
+
+        resp.set_etag(etag)
+        # the client may keep a copy but has to revalidate it on every use
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+
+    return wrapper
+
+
+def cover_url(size):
+    """Project a single cover url out of the open library images json."""
+
+    return Book.open_library_images[size].as_string()
+
+
+def book_summaries(user_id, book_query):
+    """
+    Serialize the books selected by `book_query` (a query on Book.id) for a list view.
+    Uses three queries no matter how many books there are: the books, their authors and the user's tags on them.
+    """
+
+    book_ids = book_query.subquery().select()
+    rows = db.session.query(Book.id, Book.isbn, Book.title, cover_url('medium'))\
+        .filter(Book.id.in_(book_ids))\
+        .order_by(Book.title, Book.id)\
+        .all()
+
+    authors = {}
+    for book_id, name in db.session.query(BookAuthor.book_id, Author.name)\
+            .join(Author)\
+            .filter(BookAuthor.book_id.in_(book_ids))\
+            .order_by(Author.name):
+        authors.setdefault(book_id, []).append(name)
+
+    tags = {}
+    for book_id, tag_id, name in db.session.query(UserBookTag.book_id, Tag.id, Tag.name)\
+            .join(Tag)\
+            .filter(UserBookTag.user_id == user_id, UserBookTag.book_id.in_(book_ids))\
+            .order_by(Tag.name):
+        tags.setdefault(book_id, []).append({'id': tag_id, 'name': name})
+
+    return [
+        {
+            'id': book_id,
+            'isbn': isbn,
+            'title': title,
+            'cover': cover,
+            'authors': authors.get(book_id, []),
+            'tags': tags.get(book_id, [])
+        }
+        for book_id, isbn, title, cover in rows
+    ]
+
+
+def book_vocabularies(book_id):
+    """Return the names of the book's authors, publishers and subjects, keyed like BOOK_VOCABULARIES, in one query."""
+
+    queries = [
+        db.session.query(literal(key).label('key'), model.name.label('name'))
+            .join(link, link_column == model.id)
+            .filter(link.book_id == book_id)
+        for key, model, link, link_column in BOOK_VOCABULARIES
+    ]
+
+    vocabularies = {key: [] for key, model, link, link_column in BOOK_VOCABULARIES}
+    for key, name in queries[0].union_all(*queries[1:]).order_by('name'):
+        vocabularies[key].append(name)
+    return vocabularies
+
+
+@api.route('/users/<int:user_id>/books')
+@user_library_resource
+def user_books(user_id):
+    """The books in the user's collection."""
+
+    book_ids = db.session.query(UserBook.book_id).filter(UserBook.user_id == user_id)
+    return {'books': book_summaries(user_id, book_ids)}
+
+
+@api.route('/users/<int:user_id>/books/<int:book_id>')
+@user_library_resource
+def user_book_detail(user_id, book_id):
+    """A single book with everything known about it and the tags the user applied to it."""
+
+    book = db.session.query(
+        Book.id,
+        Book.isbn,
+        Book.title,
+        Book.number_of_pages,
+        Book.publish_date,
+        Book.open_library_url,
+        Book.open_library_images,
+        db.session.query(UserBook.book_id)
+            .filter(UserBook.user_id == user_id, UserBook.book_id == Book.id)
+            .exists()
+            .label('in_collection')
+    ).filter(Book.id == book_id).first()
+
+    if not book:
+        return api_error('Book not found!', 404)
+
+    tags = db.session.query(Tag.id, Tag.name)\
+        .join(UserBookTag)\
+        .filter(UserBookTag.user_id == user_id, UserBookTag.book_id == book_id)\
+        .order_by(Tag.name)
+
+    body = {
+        'id': book.id,
+        'isbn': book.isbn,
+        'title': book.title,
+        'number_of_pages': book.number_of_pages,
+        'publish_date': book.publish_date.isoformat() if book.publish_date else None,
+        'open_library_url': book.open_library_url,
+        'covers': book.open_library_images or {},
+        'in_collection': book.in_collection,
+        'tags': [{'id': tag_id, 'name': name} for tag_id, name in tags]
+    }
+    body.update(book_vocabularies(book_id))
+    return body
+
+
+@api.route('/users/<int:user_id>/tags')
+@user_library_resource
+def user_tags(user_id):
+    """The user's tags with the number of books each one is applied to."""
+
+    tags = db.session.query(Tag.id, Tag.name, func.count(UserBookTag.book_id))\
+        .join(UserTag, UserTag.tag_id == Tag.id)\
+        .outerjoin(UserBookTag, (UserBookTag.tag_id == Tag.id) & (UserBookTag.user_id == user_id))\
+        .filter(UserTag.user_id == user_id)\
+        .group_by(Tag.id, Tag.name)\
+        .order_by(Tag.name)
+
+    return {'tags': [{'id': tag_id, 'name': name, 'book_count': count} for tag_id, name, count in tags]}
+
+
+@api.route('/users/<int:user_id>/tags/<int:tag_id>/books')
+@user_library_resource
+def user_books_by_tag(user_id, tag_id):
+    """The books in the user's collection with the specified tag."""
+
+    tag = db.session.query(Tag.id, Tag.name)\
+        .join(UserTag)\
+        .filter(UserTag.user_id == user_id, UserTag.tag_id == tag_id)\
+        .first()
+    if not tag:
+        return api_error('Tag not found!', 404)
+
+    book_ids = db.session.query(UserBookTag.book_id)\
+        .filter(UserBookTag.user_id == user_id, UserBookTag.tag_id == tag_id)
+    return {'tag': {'id': tag.id, 'name': tag.name}, 'books': book_summaries(user_id, book_ids)}
@@ -1,36 +1,76 @@
-import os
-from flask import Flask, request, render_template, redirect, session, g, flash
-from flask_debugtoolbar import DebugToolbarExtension
+from math import ceil
+from flask import Flask, Blueprint, request, render_template, redirect, session, g, flash
 from models import connect_db, db, Book, User, UserBook, Tag, UserTag, UserBookTag
 from forms import UserForm
-from utils import lookup_isbn_open_library, map_response_to_book, search_user_books
+from utils import lookup_isbn_open_library, map_response_to_book, open_library_budget, search_user_books_query, unique
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import undefer
+from config import get_config
+from commands import register_commands
+from api import api
+from export import export
+from imports import imports
+from similar import similar_books, queue_refresh
+from autocomplete import autocomplete, init_autocomplete, get_prefix_indexes
+from tags import tags, tag_ids_for, add_user_tags
+from fragments import init_fragment_cache, render_book_cards
+from search_cache import init_search_cache, cached_book_ids
+from passwords import passwords, LoginThrottled
+from metrics import init_metrics
+from slow_queries import init_slow_query_log
+from rate_limit import RateLimited
+from invalidation import init_invalidation
+from user_cache import init_user_cache, load_user
 
-app = Flask(__name__)
-
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///personal_library').replace("://", "ql://", 1))
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+CURR_USER_KEY = 'curr_user'
 
-connect_db(app)
-db.create_all()
+library = Blueprint('library', __name__)
 
-CURR_USER_KEY = 'curr_user'
 
+def create_app(config=None):
+    """
+    Build the Flask app for the given config class or environment name (defaults to FLASK_ENV).
+    Nothing here talks to the database, so workers boot without a round trip. Create the schema with `flask create-db`.
+    """
 
-@app.before_request
+    app = Flask(__name__)
+    app.config.from_object(config if isinstance(config, type) else get_config(config))
+    if app.config['OPEN_LIBRARY_RATE_LIMIT']:
+        # refuse a budget that can't work when the worker boots, not on the first lookup
+        for caller in ('interactive', 'background'):
+            open_library_budget(caller, app.config.get)
+
+    if app.config['DEBUG_TOOLBAR']:
+        # only development pays for importing and installing the toolbar
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    init_metrics(app)
+    connect_db(app)
+    init_fragment_cache(app)
+    init_search_cache(app)
+    init_autocomplete(app)
+    init_slow_query_log(app)
+    init_invalidation(app)
+    init_user_cache(app)
+    passwords.init_app(app)
+    app.register_blueprint(library)
+    app.register_blueprint(api)
+    app.register_blueprint(export)
+    app.register_blueprint(imports)
+    app.register_blueprint(autocomplete)
+    app.register_blueprint(tags)
+    register_commands(app)
+
+    return app
+
+
+@library.before_app_request
 def add_user_to_g():
     """If there is a logged in user, add curr_user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_user(session[CURR_USER_KEY])
     else:
         g.user = None
 
@@ -48,7 +88,14 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=['GET', 'POST'])
+def login_throttled(login_form, signup_form):
+    """Turn a login away when too many are already waiting on password hashing."""
+
+    flash("Too many people are logging in right now. Please try again in a moment.", "danger")
+    return render_template('home-anon.html', login_form=login_form, signup_form=signup_form), 503
+
+
+@library.route('/signup', methods=['GET', 'POST'])
 def signup():
     """Sign up a user."""
 
@@ -62,14 +109,17 @@ def signup():
 
     if signup_form.validate_on_submit():
         try:
-            user = User.signup(
-                username=signup_form.username.data,
-                password=signup_form.password.data
-            )
+            with passwords.login_slot():
+                user = User.signup(
+                    username=signup_form.username.data,
+                    password=signup_form.password.data
+                )
             db.session.commit()
         except IntegrityError:
             flash("Username already taken", "danger")
             return render_template('home-anon.html', login_form=login_form, signup_form=signup_form)
+        except LoginThrottled:
+            return login_throttled(login_form, signup_form)
 
         do_login(user)
 
@@ -82,18 +132,24 @@ def signup():
     return render_template('home-anon.html', login_form=login_form, signup_form=signup_form)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@library.route('/login', methods=['GET', 'POST'])
 def login():
     """Log the user in."""
 
     login_form = UserForm()
 
     if login_form.validate_on_submit():
-        user = User.authenticate(
-            username=login_form.username.data,
-            password=login_form.password.data
-        )
+        try:
+            with passwords.login_slot():
+                user = User.authenticate(
+                    username=login_form.username.data,
+                    password=login_form.password.data
+                )
+        except LoginThrottled:
+            return login_throttled(login_form, UserForm())
         if user:
+            # saves the password if authenticate upgraded its hash
+            db.session.commit()
             do_login(user)
             return redirect('/')
         else:
@@ -107,7 +163,7 @@ def login():
     return render_template('home-anon.html', login_form=login_form, signup_form=signup_form)
 
 
-@app.route('/logout')
+@library.route('/logout')
 def logout():
     """Log the user out."""
 
@@ -117,7 +173,7 @@ def logout():
     return redirect('/')
 
 
-@app.route('/')
+@library.route('/')
 def home():
     """Redirect the user to the appropriate route based on whether or not they are logged in."""
 
@@ -130,7 +186,7 @@ def home():
         return render_template('home-anon.html', login_form=login_form, signup_form=signup_form)
 
 
-@app.route('/books/search', methods=['POST'])
+@library.route('/books/search', methods=['POST'])
 def search_isbn():
     """
     Lookup up the isbn submitted by the user in the application database.
@@ -147,17 +203,24 @@ def search_isbn():
     isbn = request.form.get('isbn')
     book = Book.query.filter_by(isbn=isbn).first()
     if book:
-        if g.user.id in book.users:
-            return redirect('/users/{user_id}/books/{book_id}')
+        # one user's row, not every owner of the book, so a partitioned users_books reads one partition
+        owned = db.session.query(UserBook.query.filter_by(user_id=g.user.id, book_id=book.id).exists()).scalar()
+        if owned:
+            return redirect(f'/users/{g.user.id}/books/{book.id}')
     else:
-        resp = lookup_isbn_open_library(isbn)
+        try:
+            resp = lookup_isbn_open_library(isbn)
+        except RateLimited as error:
+            flash(f'Open Library is busy, please try again in about {ceil(error.retry_after)} seconds.', 'danger')
+            return redirect('/')
         book = map_response_to_book(resp, isbn)
         db.session.add(book)
         db.session.commit()
+        queue_refresh()
     return redirect(f'/books/{book.id}')
 
 
-@app.route('/books/<int:book_id>', methods=['GET'])     # removed post
+@library.route('/books/<int:book_id>', methods=['GET'])     # removed post
 def book_detail(book_id):
     """Show the searched books information."""
 
@@ -165,12 +228,14 @@ def book_detail(book_id):
         flash("You are not authorized.", "danger")
         return redirect('/')
 
-    book = Book.query.get(book_id)
+    book = Book.query.options(undefer(Book.open_library_images)).get(book_id)
+    in_collection = request.args.get('similar') == 'collection'
 
-    return render_template('book-detail.html', user=g.user, book=book)
+    return render_template('book-detail.html', user=g.user, book=book, similar_in_collection=in_collection,
+                           similar=similar_books(g.user.id, book_id, in_collection))
 
 
-@app.route('/users/<int:user_id>/books', methods=['GET'])
+@library.route('/users/<int:user_id>/books', methods=['GET'])
 def user_books(user_id):
     """Show the books in the user's collection."""
 
@@ -182,12 +247,12 @@ def user_books(user_id):
         flash('You are not authorized.', 'danger')
         return redirect('/')
 
-    books = db.session.query(Book).join(UserBook).filter(UserBook.user_id == user_id).all()
+    book_ids = db.session.query(UserBook.book_id).filter(UserBook.user_id == user_id)
 
-    return render_template('user-books.html', user=g.user, books=books)
+    return render_template('user-books.html', user=g.user, cards=render_book_cards(user_id, book_ids))
 
 
-@app.route('/users/<int:user_id>/books/search', methods=['POST'])
+@library.route('/users/<int:user_id>/books/search', methods=['POST'])
 def user_books_search(user_id):
     """Search the user's collection."""
 
@@ -202,12 +267,15 @@ def user_books_search(user_id):
     search_field = request.form.get('radio-search')
     search_string = request.form.get('search-input')
 
-    books = search_user_books(user_id, search_field, search_string)
+    # title searches ignore case, so do their cache keys
+    terms = (search_string or '').casefold() if search_field == 'title' else search_string
+    book_ids = cached_book_ids(g.user, search_field if search_field in ('title', 'isbn') else 'all', terms,
+                               search_user_books_query(user_id, search_field, search_string).with_entities(Book.id))
 
-    return render_template('user-books.html', user=g.user, books=books)
+    return render_template('user-books.html', user=g.user, cards=render_book_cards(user_id, book_ids))
 
 
-@app.route('/users/<int:user_id>/books/<int:book_id>', methods=['GET', 'POST'])
+@library.route('/users/<int:user_id>/books/<int:book_id>', methods=['GET', 'POST'])
 def user_book_detail(user_id, book_id):
     """Add a book to the user's collection or display the book that is already in the user's collection."""
 
@@ -219,7 +287,7 @@ def user_book_detail(user_id, book_id):
         flash('You are not authorized.', 'danger')
         return redirect('/')
 
-    book = Book.query.filter_by(id=book_id).first()
+    book = Book.query.options(undefer(Book.open_library_images)).filter_by(id=book_id).first()
     if not book:
         flash('Book not found!', 'danger')
         return redirect('/')
@@ -229,28 +297,36 @@ def user_book_detail(user_id, book_id):
         book_tags = book.get_user_book_tags(user_id)
         # Get all the tags created by the user, except those applied to this book
         available_tags = [tag for tag in g.user.tags if tag not in book_tags]
+        # "more like this" leaves out the user's own books unless asked for them
+        in_collection = request.args.get('similar') == 'collection'
 
         return render_template(
             'book-detail.html',
             book=book,
             user=g.user,
             book_tags=book_tags,
-            available_tags=available_tags
+            available_tags=available_tags,
+            similar=similar_books(user_id, book_id, in_collection),
+            similar_in_collection=in_collection
         )
 
     if request.method == 'POST':
         if book_id not in [book.id for book in g.user.books]:
             book_user = UserBook(
                 user_id=user_id,
-                book_id=book_id
+                book_id=book_id,
+                tag_version=UserBook.first_tag_version(user_id)
             )
             db.session.add(book_user)
+            version = g.user.library_version
+            g.user.bump_library_version()
             db.session.commit()
+            get_prefix_indexes().changed(user_id, version, books_added=[book])
 
         return redirect(f'/users/{user_id}/books/{book_id}')
 
 
-@app.route('/users/<int:user_id>/books/<int:book_id>/delete', methods=['POST'])
+@library.route('/users/<int:user_id>/books/<int:book_id>/delete', methods=['POST'])
 def delete_user_book(user_id, book_id):
     """Remove a book from a user's collection."""
 
@@ -266,6 +342,7 @@ def delete_user_book(user_id, book_id):
         flash('Book not found!', 'danger')
         return redirect('/')
 
+    removed_book = next(book for book in g.user.books if book.id == book_id)
     user_book = db.session.query(UserBook).filter(UserBook.user_id == user_id, UserBook.book_id == book_id).first()
     db.session.delete(user_book)
     book_tags = db.session.query(UserBookTag)\
@@ -273,12 +350,15 @@ def delete_user_book(user_id, book_id):
         .all()
     for book in book_tags:
         db.session.delete(book)
+    version = g.user.library_version
+    g.user.bump_library_version()
     db.session.commit()
+    get_prefix_indexes().changed(user_id, version, books_removed=[removed_book])
 
     return redirect(f'/users/{user_id}/books')
 
 
-@app.route('/users/<int:user_id>/tags', methods=['GET'])
+@library.route('/users/<int:user_id>/tags', methods=['GET'])
 def user_tags(user_id):
     """
     GET: Show the tags the user has defined.
@@ -296,10 +376,10 @@ def user_tags(user_id):
     return render_template('user-tags.html', user=g.user)
 
 
-@app.route('/users/<int:user_id>/tag', methods=['POST'])
+@library.route('/users/<int:user_id>/tag', methods=['POST'])
 def add_user_tag(user_id):
     """
-    POST: Create a user tag.
+    POST: Add tags to the user's tag list, creating the names no one has used yet.
     """
 
     if not g.user:
@@ -310,35 +390,28 @@ def add_user_tag(user_id):
         flash('You are not authorized.', 'danger')
         return redirect('/')
 
-    if request.method == 'POST':
-        tag_name = request.form.get('tag')
-        tag = Tag.query.filter_by(name=tag_name).first()
-        """
-        if the tag exists in the application and is in the user's collection flash a message and return the user's
-        tag page.
-        """
-        if tag:
-            if tag.id in [user_tag.id for user_tag in g.user.tags]:
-                flash("Tag already in user's collection", "success")
-                return redirect(f'/users/{g.user.id}/tags')
-
-        # if the tag does not exist in the application, create it
-        if not tag:
-            tag = Tag(name=tag_name)
-            db.session.add(tag)
-            db.session.commit()
-        # add the tag to the user's collection
-        user_tag = UserTag(
-            user_id=g.user.id,
-            tag_id=tag.id
-        )
-        db.session.add(user_tag)
-        db.session.commit()
+    # one name per tag field, commas and all, and one per line of the tags textarea
+    names = unique(name.strip() for name in request.form.getlist('tag') + request.form.get('tags', '').splitlines())
+    if not names:
+        flash('Enter a tag name.', 'danger')
+        return redirect(f'/users/{user_id}/tags')
+
+    # created and added in one transaction, a concurrent request adding the same names skips them instead of failing
+    tag_ids = tag_ids_for(names)
+    added = add_user_tags(user_id, list(tag_ids.values()))
+    if not added:
+        flash("Tag already in user's collection", "success")
+        return redirect(f'/users/{user_id}/tags')
+
+    version = g.user.library_version
+    g.user.bump_library_version()
+    db.session.commit()
+    get_prefix_indexes().changed(user_id, version, tags_added=[name for name in names if tag_ids[name] in added])
 
-        return redirect(f'/users/{g.user.id}/tags')
+    return redirect(f'/users/{user_id}/tags')
 
 
-@app.route('/users/<int:user_id>/tag/<int:tag_id>/delete', methods=['POST'])
+@library.route('/users/<int:user_id>/tag/<int:tag_id>/delete', methods=['POST'])
 def delete_user_tag(user_id, tag_id):
     """
     Remove a tag from the users' collection.
@@ -357,19 +430,26 @@ def delete_user_tag(user_id, tag_id):
         flash('Tag not found!', 'danger')
         return redirect('/')
 
+    tag_name = next(tag.name for tag in g.user.tags if tag.id == tag_id)
     user_tag = db.session.query(UserTag).filter(UserTag.user_id == user_id, UserTag.tag_id == tag_id).first()
     user_book_tags = db.session.query(UserBookTag)\
         .filter(UserBookTag.user_id == user_id, UserBookTag.tag_id == tag_id)\
         .all()
+    # re-render only the cards of the books that had this tag
+    UserBook.bump_tag_version(user_id, db.session.query(UserBookTag.book_id)
+                              .filter(UserBookTag.user_id == user_id, UserBookTag.tag_id == tag_id))
     db.session.delete(user_tag)
     for user_book_tag in user_book_tags:
         db.session.delete(user_book_tag)
+    version = g.user.library_version
+    g.user.bump_library_version()
     db.session.commit()
+    get_prefix_indexes().changed(user_id, version, tags_removed=[tag_name])
 
     return redirect(f'/users/{user_id}/tags')
 
 
-@app.route('/users/<int:user_id>/books/<int:book_id>/tag/<int:tag_id>', methods=['POST'])
+@library.route('/users/<int:user_id>/books/<int:book_id>/tag/<int:tag_id>', methods=['POST'])
 def add_book_tag(user_id, book_id, tag_id):
     """Add a tag to a book in a user's collection."""
 
@@ -395,12 +475,17 @@ def add_book_tag(user_id, book_id, tag_id):
         tag_id=tag_id
     )
     db.session.add(book_tag)
+    UserBook.bump_tag_version(user_id, [book_id])
+    version = g.user.library_version
+    g.user.bump_library_version()
     db.session.commit()
+    # nothing to suggest changed, the index only moves on to the new version
+    get_prefix_indexes().changed(user_id, version)
 
     return redirect(f'/users/{user_id}/books/{book_id}')
 
 
-@app.route('/users/<int:user_id>/books/<int:book_id>/tag/<int:tag_id>/delete', methods=['POST'])
+@library.route('/users/<int:user_id>/books/<int:book_id>/tag/<int:tag_id>/delete', methods=['POST'])
 def delete_book_tag(user_id, book_id, tag_id):
     """Remove a tag from a book in the user's collection."""
 
@@ -422,12 +507,17 @@ def delete_book_tag(user_id, book_id, tag_id):
 
     user_book_tag = UserBookTag.query.filter_by(user_id=user_id, book_id=book_id, tag_id=tag_id).first()
     db.session.delete(user_book_tag)
+    UserBook.bump_tag_version(user_id, [book_id])
+    version = g.user.library_version
+    g.user.bump_library_version()
     db.session.commit()
+    # nothing to suggest changed, the index only moves on to the new version
+    get_prefix_indexes().changed(user_id, version)
 
     return redirect(f'/users/{user_id}/books/{book_id}')
 
 
-@app.route('/users/<int:user_id>/tags/<int:tag_id>')
+@library.route('/users/<int:user_id>/tags/<int:tag_id>')
 def show_user_book_by_tag(user_id, tag_id):
     """Show all the books in the user's collection with the specified tag."""
 
@@ -444,9 +534,10 @@ def show_user_book_by_tag(user_id, tag_id):
         flash('Tag not found!', 'danger')
         return redirect('/')
 
-    books = db.session.query(Book)\
-        .join(UserBookTag)\
-        .filter(UserBookTag.user_id == user_id, UserBookTag.tag_id == tag_id)\
-        .all()
+    book_ids = cached_book_ids(g.user, 'tag', tag_id, db.session.query(UserBookTag.book_id)
+                               .filter(UserBookTag.user_id == user_id, UserBookTag.tag_id == tag_id))
+
+    return render_template('user-books.html', user=g.user, cards=render_book_cards(user_id, book_ids), tag=tag)
+
 
-    return render_template('user-books.html', user=g.user, books=books, tag=tag)
+app = create_app()
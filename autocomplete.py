@@ -0,0 +1,192 @@
+"""
+Prefix suggestions for the search box and the tag entry.
+
+Each worker keeps a sorted list of the lowercased titles, author names and tag names in a user's library, with an entry
+for every word so 'tolk' finds 'J. R. R. Tolkien', and answers a prefix with a bisect and a short scan. An index is built on the first
+request for the user and belongs to one library version. The routes that change a library patch the index in place when
+it was current, anything else (another worker, an import) moves the version on and the next request rebuilds it.
+"""
+import bisect
+import threading
+from collections import OrderedDict
+
+from flask import Blueprint, current_app, g, jsonify, request
+from sqlalchemy import func
+
+from models import db, Book, Author, BookAuthor, UserBook, Tag, UserTag
+
+autocomplete = Blueprint('autocomplete', __name__)
+
+KINDS = ('title', 'author', 'tag')
+# suggestions per request, unless asked for fewer
+SUGGESTIONS = 10
+
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+def index_keys(name):
+    """The lowercased name from each word on, so any word of it can start a match."""
+
+    words = normalize(name).split(' ')
+    return {' '.join(words[i:]) for i in range(len(words))}
+
+
+class PrefixIndex:
+    """The names in one user's library at one library version, in a sorted list of (key, kind, name)."""
+
+    def __init__(self, version):
+        self.version = version
+        # (kind, name) -> how many books bring it, a shared author stays until its last book goes
+        self.counts = {}
+        self.entries = []
+
+    @classmethod
+    def build(cls, version, names):
+        """`names` is an iterable of (kind, name, count)."""
+
+        index = cls(version)
+        for kind, name, count in names:
+            if name:
+                index.counts[(kind, name)] = index.counts.get((kind, name), 0) + count
+        index.entries = sorted((key, kind, name) for kind, name in index.counts for key in index_keys(name))
+        return index
+
+    def add(self, kind, name):
+        if not name:
+            return
+        count = self.counts.get((kind, name), 0)
+        self.counts[(kind, name)] = count + 1
+        if not count:
+            for key in index_keys(name):
+                bisect.insort(self.entries, (key, kind, name))
+
+    def remove(self, kind, name):
+        count = self.counts.get((kind, name), 0)
+        if count > 1:
+            self.counts[(kind, name)] = count - 1
+        elif count:
+            del self.counts[(kind, name)]
+            for key in index_keys(name):
+                position = bisect.bisect_left(self.entries, (key, kind, name))
+                if position < len(self.entries) and self.entries[position] == (key, kind, name):
+                    del self.entries[position]
+
+    def search(self, prefix, kinds=KINDS, limit=SUGGESTIONS):
+        """Return up to `limit` distinct (kind, name) whose name has a word starting with the prefix, in key order."""
+
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        found = {}
+        entries = self.entries
+        position = bisect.bisect_left(entries, (prefix,))
+        while position < len(entries) and len(found) < limit:
+            key, kind, name = entries[position]
+            if not key.startswith(prefix):
+                break
+            if kind in kinds:
+                found.setdefault((kind, name), None)
+            position += 1
+        return list(found)
+
+
+def library_names(user_id):
+    """(kind, name, count) for every title, author and tag in the user's library. Three queries."""
+
+    titles = db.session.query(Book.title, func.count())\
+        .join(UserBook)\
+        .filter(UserBook.user_id == user_id)\
+        .group_by(Book.title)
+    authors = db.session.query(Author.name, func.count())\
+        .join(BookAuthor)\
+        .join(UserBook, UserBook.book_id == BookAuthor.book_id)\
+        .filter(UserBook.user_id == user_id)\
+        .group_by(Author.name)
+    tags = db.session.query(Tag.name)\
+        .join(UserTag)\
+        .filter(UserTag.user_id == user_id)
+
+    yield from (('title', title, count) for title, count in titles)
+    yield from (('author', name, count) for name, count in authors)
+    yield from (('tag', name, 1) for name, in tags)
+
+
+def book_names(book):
+    """The (kind, name) pairs a book brings to a library."""
+
+    return [('title', book.title)] + [('author', author.name) for author in book.authors]
+
+
+class PrefixIndexes:
+    """The prefix indexes of the most recently active users in this worker."""
+
+    def __init__(self, max_users=1000):
+        self.max_users = max_users
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        """The user's index, rebuilt when it's missing or belongs to an older library version."""
+
+        with self._lock:
+            index = self._indexes.get(user.id)
+            if index is not None:
+                self._indexes.move_to_end(user.id)
+        if index is None or index.version != user.library_version:
+            index = PrefixIndex.build(user.library_version, library_names(user.id))
+            with self._lock:
+                self._indexes[user.id] = index
+                self._indexes.move_to_end(user.id)
+                while len(self._indexes) > self.max_users:
+                    self._indexes.popitem(last=False)
+        return index
+
+    def changed(self, user_id, seen_version, books_added=(), books_removed=(), tags_added=(), tags_removed=()):
+        """
+        Patch the user's index after a commit that bumped their library version once, from `seen_version`.
+        Takes Book objects and tag names. An index that wasn't at `seen_version` is left to be rebuilt.
+        """
+
+        index = self._indexes.get(user_id)
+        if index is None or index.version != seen_version:
+            return
+        # read before taking the lock, the books may have to be loaded again after the commit
+        added = [name for book in books_added for name in book_names(book)] + [('tag', name) for name in tags_added]
+        removed = [name for book in books_removed for name in book_names(book)] + \
+            [('tag', name) for name in tags_removed]
+
+        with self._lock:
+            if index.version != seen_version:
+                return
+            for kind, name in added:
+                index.add(kind, name)
+            for kind, name in removed:
+                index.remove(kind, name)
+            index.version = seen_version + 1
+
+
+def init_autocomplete(app):
+    app.extensions['autocomplete'] = PrefixIndexes(app.config['AUTOCOMPLETE_USERS'])
+
+
+def get_prefix_indexes():
+    return current_app.extensions['autocomplete']
+
+
+@autocomplete.route('/users/<int:user_id>/autocomplete')
+def suggest(user_id):
+    """Suggestions for `q`, optionally only of one `kind`. Answered from memory once the user's index is built."""
+
+    if not g.user or g.user.id != user_id:
+        resp = jsonify({'error': 'You are not authorized.'})
+        resp.status_code = 401 if not g.user else 403
+        return resp
+
+    kind = request.args.get('kind')
+    kinds = (kind,) if kind in KINDS else KINDS
+    limit = min(request.args.get('limit', SUGGESTIONS, type=int), SUGGESTIONS)
+    suggestions = get_prefix_indexes().get(g.user).search(request.args.get('q', ''), kinds, limit)
+
+    return jsonify({'suggestions': [{'kind': kind, 'name': name} for kind, name in suggestions]})
@@ -0,0 +1,92 @@
+"""
+Compare gunicorn's sync workers with the gevent mode while Open Library is slow.
+
+Starts the Open Library stub with the given latency, then runs gunicorn once per worker class and keeps
+`--concurrency` clients posting new ISBNs to /books/search (one Open Library call and one insert per request).
+
+    DATABASE_URL=postgres:///personal_library_test python -m benchmarks.async_workers --latency-ms 300
+"""
+import argparse
+import itertools
+import statistics
+import threading
+import time
+
+import requests
+
+from app import app
+from benchmarks.fixtures import BENCH_PREFIX, create_user, drop_library, session_cookie
+from benchmarks.gunicorn_server import gunicorn
+from benchmarks.openlibrary_stub import start_stub
+
+
+def drive(url, cookie, concurrency, seconds, isbns):
+    """Keep `concurrency` clients busy for `seconds` and return the latency of every completed request."""
+
+    latencies, errors = [], []
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        with requests.Session() as http:
+            http.cookies.set('session', cookie)
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    resp = http.post(f'{url}/books/search', data={'isbn': f'{BENCH_PREFIX}-ol-{next(isbns)}'},
+                                     allow_redirects=False, timeout=60)
+                    ok = resp.status_code == 302
+                except requests.RequestException:
+                    ok = False
+                (latencies if ok else errors).append(time.perf_counter() - start)
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    return latencies, errors
+
+
+def run_mode(worker_class, args, stub_url, cookie, isbns):
+    with gunicorn(worker_class, args.workers, args.concurrency, OPEN_LIBRARY_URL=stub_url) as url:
+        latencies, errors = drive(url, cookie, args.concurrency, args.seconds, isbns)
+
+    latencies.sort()
+    return {
+        'requests_per_second': len(latencies) / args.seconds,
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else None,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+        'errors': len(errors)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency-ms', type=float, default=300)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=15)
+    parser.add_argument('--modes', nargs='+', default=['sync', 'gevent'])
+    args = parser.parse_args()
+
+    stub = start_stub(latency_ms=args.latency_ms)
+    stub_url = f'http://127.0.0.1:{stub.server_port}'
+    drop_library()
+    cookie = session_cookie(app, create_user().id)
+    # a shared count is safe to advance from every client thread, a generator is not
+    isbns = itertools.count()
+
+    print(f'{args.workers} workers, {args.concurrency} clients, Open Library latency {args.latency_ms:.0f} ms')
+    print(f"{'mode':<8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    try:
+        for mode in args.modes:
+            result = run_mode(mode, args, stub_url, cookie, isbns)
+            print(f"{mode:<8} {result['requests_per_second']:>8.1f} {result['p50_ms'] or 0:>8.0f} "
+                  f"{result['p99_ms'] or 0:>8.0f} {result['errors']:>7}")
+    finally:
+        stub.shutdown()
+        drop_library()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Build time of a user's autocomplete index and the latency of lookups, in memory and through the endpoint.
+
+    DATABASE_URL=postgres:///personal_library_test python -m benchmarks.autocomplete --books 1000 10000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from app import app, CURR_USER_KEY
+from autocomplete import PrefixIndex, library_names
+from benchmarks.fixtures import create_library, drop_library
+from models import db
+
+PREFIXES = ['b', 'be', 'ben', 'book 0', 'book 00', 'bench author 1', 'bench tag', 'x', '12', '0004']
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return statistics.median(timings) * 1000, timings[int(len(timings) * 0.99)] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'books':>8} {'entries':>8} {'build ms':>9} {'search p50/p99 ms':>18} {'endpoint p50/p99 ms':>20}")
+    with app.app_context():
+        for books in args.books:
+            drop_library()
+            user_id = create_library(books)
+            try:
+                start = time.perf_counter()
+                index = PrefixIndex.build(0, library_names(user_id))
+                build = time.perf_counter() - start
+
+                searches = []
+                for _ in range(args.lookups):
+                    prefix = random.choice(PREFIXES)
+                    start = time.perf_counter()
+                    index.search(prefix)
+                    searches.append(time.perf_counter() - start)
+
+                requests = []
+                with app.test_client() as client:
+                    with client.session_transaction() as change_session:
+                        change_session[CURR_USER_KEY] = user_id
+                    # builds the worker's index
+                    client.get(f'/users/{user_id}/autocomplete?q=b')
+                    for _ in range(args.lookups // 10):
+                        start = time.perf_counter()
+                        client.get(f'/users/{user_id}/autocomplete?q={random.choice(PREFIXES)}')
+                        requests.append(time.perf_counter() - start)
+
+                print(f'{books:>8} {len(index.entries):>8} {build * 1000:>9.0f} '
+                      f'{"%.3f / %.3f" % percentiles(searches):>18} {"%.2f / %.2f" % percentiles(requests):>20}')
+            finally:
+                db.session.remove()
+                drop_library()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Time the library page with a cold and a warm book card cache.
+
+    DATABASE_URL=postgres:///personal_library_test python -m benchmarks.book_cards --books 500 --runs 5
+"""
+import argparse
+import statistics
+import time
+
+from app import app, CURR_USER_KEY
+from benchmarks.fixtures import create_library, drop_library
+
+
+def time_page(client, url):
+    start = time.perf_counter()
+    resp = client.get(url)
+    elapsed = (time.perf_counter() - start) * 1000
+    assert resp.status_code == 200, resp.status_code
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=500)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    cache = app.extensions['fragment_cache']
+    drop_library()
+    user_id = create_library(args.books)
+    url = f'/users/{user_id}/books'
+    try:
+        with app.test_client() as c:
+            with c.session_transaction() as s:
+                s[CURR_USER_KEY] = user_id
+
+            cold, warm = [], []
+            for _ in range(args.runs):
+                cache.clear()
+                cold.append(time_page(c, url))
+                warm.append(time_page(c, url))
+    finally:
+        drop_library()
+
+    cold_ms, warm_ms = statistics.median(cold), statistics.median(warm)
+    print(f'{args.books} books, median of {args.runs} runs')
+    print(f'cold cache: {cold_ms:8.1f} ms')
+    print(f'warm cache: {warm_ms:8.1f} ms  ({cold_ms / warm_ms:.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Measure worker cold start: the time for a fresh interpreter to import app.py (what a gunicorn worker does on boot) and
+then serve its first request, which is where the first database connection is opened.
+
+    python -m benchmarks.boot_time --runs 10 --profiles production development
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Runs in a fresh interpreter so that no module is already imported.
+PROBE = """
+import json, os, sys, time
+os.environ['FLASK_ENV'] = sys.argv[1]
+start = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+with app.test_client() as c:
+    c.get('/')
+served = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'first_request_ms': (served - imported) * 1000}))
+"""
+
+
+def measure(profile, runs):
+    """Boot the app `runs` times under the given profile and return the per run timings."""
+
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', PROBE, profile],
+                             check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        # the development profile echoes sql to stdout, the timings are always the last line
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return samples
+
+
+def summarize(samples, key):
+    values = [sample[key] for sample in samples]
+    return {'median': statistics.median(values), 'min': min(values), 'max': max(values)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--profiles', nargs='+', default=['production', 'development'])
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    for profile in args.profiles:
+        samples = measure(profile, args.runs)
+        results[profile] = {
+            'import_ms': summarize(samples, 'import_ms'),
+            'first_request_ms': summarize(samples, 'first_request_ms')
+        }
+
+    print(f"{'profile':<12} {'import ms (median/min/max)':>30} {'first request ms (median/min/max)':>36}")
+    for profile, result in results.items():
+        imp, first = result['import_ms'], result['first_request_ms']
+        print(f"{profile:<12} {imp['median']:>12.1f} {imp['min']:>8.1f} {imp['max']:>8.1f} "
+              f"{first['median']:>18.1f} {first['min']:>8.1f} {first['max']:>8.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
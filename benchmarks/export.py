@@ -0,0 +1,86 @@
+"""
+Peak Python memory and time of the streaming export at growing library sizes, next to serializing g.user.books.
+
+    DATABASE_URL=postgres:///personal_library_test python -m benchmarks.export --books 1000 5000
+    DATABASE_URL=postgres:///personal_library_test python -m benchmarks.export --books 50000 --skip-in-memory
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from app import app, CURR_USER_KEY
+from benchmarks.fixtures import create_library, drop_library
+from models import db, User
+
+
+def measure(run):
+    """Return (peak MiB, seconds, bytes) of run(), which returns the number of bytes it produced."""
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = run()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20, elapsed, size
+
+
+def stream_export(user_id, file_format):
+    def run():
+        size = 0
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = user_id
+            resp = client.get(f'/users/{user_id}/export.{file_format}')
+            # consume the stream a chunk at a time like a socket would
+            for chunk in resp.response:
+                size += len(chunk)
+            resp.close()
+        return size
+    return run
+
+
+def in_memory_export(user_id):
+    """What the export would cost built from the ORM relationships in one go."""
+
+    def run():
+        with app.app_context():
+            user = User.query.get(user_id)
+            body = '\n'.join(json.dumps({
+                'isbn': book.isbn,
+                'title': book.title,
+                'authors': [author.name for author in book.authors],
+                'publishers': [publisher.name for publisher in book.publishers],
+                'subjects': [subject.name for subject in book.subjects],
+                'tags': [tag.name for tag in book.get_user_book_tags(user_id)]
+            }) for book in user.books)
+            db.session.remove()
+        return len(body)
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--skip-in-memory', action='store_true', help='it makes a query per book')
+    args = parser.parse_args()
+
+    print(f"{'books':>8} {'method':<16} {'peak MiB':>9} {'seconds':>8} {'MiB out':>8}")
+    for books in args.books:
+        drop_library()
+        user_id = create_library(books)
+        db.session.remove()
+        try:
+            methods = [('stream csv', stream_export(user_id, 'csv')), ('stream jsonl', stream_export(user_id, 'jsonl'))]
+            if not args.skip_in_memory:
+                methods.append(('in memory jsonl', in_memory_export(user_id)))
+            for label, run in methods:
+                peak, elapsed, size = measure(run)
+                print(f'{books:>8} {label:<16} {peak:>9.1f} {elapsed:>8.2f} {size / 2 ** 20:>8.1f}')
+        finally:
+            drop_library()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Throwaway libraries for the benchmarks. Everything is created under one user and removed again by drop_library."""
+import datetime
+from models import db, User, Book, Author, BookAuthor, UserBook, Tag, UserTag, UserBookTag
+
+BENCH_PREFIX = 'bench'
+
+
+def create_user():
+    """Insert the benchmark user and return it."""
+
+    user = User(username=f'{BENCH_PREFIX}@nodomain.com', password='not a hash')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def session_cookie(app, user_id):
+    """The value of a session cookie that logs `user_id` in, for clients outside the flask test client."""
+
+    from app import CURR_USER_KEY
+    return app.session_interface.get_signing_serializer(app).dumps({CURR_USER_KEY: user_id})
+
+
+def create_library(n_books, authors_per_book=2, n_tags=20, tags_per_book=3):
+    """Insert a user owning `n_books` books, each with authors and tags, and return the user's id."""
+
+    user = create_user()
+
+    books = db.session.execute(Book.__table__.insert().returning(Book.id), [
+        {
+            'isbn': f'{BENCH_PREFIX}-{i}',
+            'open_library_id': f'OL{i}M',
+            'open_library_images': {size: f'https://covers.example/{i}-{size[0].upper()}.jpg'
+                                    for size in ('small', 'medium', 'large')},
+            'open_library_url': f'https://openlibrary.example/books/OL{i}M',
+            'number_of_pages': 100 + i % 400,
+            'publish_date': datetime.date(1950 + i % 70, 1, 1),
+            'title': f'Benchmark book {i:06d}'
+        }
+        for i in range(n_books)
+    ]).scalars().all()
+
+    authors = db.session.execute(Author.__table__.insert().returning(Author.id), [
+        {'name': f'{BENCH_PREFIX} author {i}'} for i in range(max(1, n_books // 2))
+    ]).scalars().all()
+    tags = db.session.execute(Tag.__table__.insert().returning(Tag.id), [
+        {'name': f'{BENCH_PREFIX} tag {i}'} for i in range(n_tags)
+    ]).scalars().all()
+
+    db.session.execute(BookAuthor.__table__.insert(), [
+        {'book_id': book_id, 'author_id': authors[(i + j) % len(authors)]}
+        for i, book_id in enumerate(books) for j in range(authors_per_book)
+    ])
+    db.session.execute(UserBook.__table__.insert(), [{'user_id': user.id, 'book_id': book_id} for book_id in books])
+    db.session.execute(UserTag.__table__.insert(), [{'user_id': user.id, 'tag_id': tag_id} for tag_id in tags])
+    if tags_per_book:
+        db.session.execute(UserBookTag.__table__.insert(), [
+            {'user_id': user.id, 'book_id': book_id, 'tag_id': tags[(i + j) % len(tags)]}
+            for i, book_id in enumerate(books) for j in range(min(tags_per_book, len(tags)))
+        ])
+    db.session.commit()
+
+    return user.id
+
+
+def drop_library():
+    """Remove everything create_library inserted."""
+
+    db.session.rollback()
+    user_ids = db.session.query(User.id).filter(User.username.like(f'{BENCH_PREFIX}@%'))
+    book_ids = db.session.query(Book.id).filter(Book.isbn.like(f'{BENCH_PREFIX}-%'))
+    db.session.query(UserBookTag).filter(UserBookTag.user_id.in_(user_ids)).delete(synchronize_session=False)
+    db.session.query(UserTag).filter(UserTag.user_id.in_(user_ids)).delete(synchronize_session=False)
+    db.session.query(UserBook).filter(UserBook.book_id.in_(book_ids)).delete(synchronize_session=False)
+    db.session.query(Book).filter(Book.isbn.like(f'{BENCH_PREFIX}-%')).delete(synchronize_session=False)
+    db.session.query(Author).filter(Author.name.like(f'{BENCH_PREFIX} %')).delete(synchronize_session=False)
+    db.session.query(Tag).filter(Tag.name.like(f'{BENCH_PREFIX} %')).delete(synchronize_session=False)
+    db.session.query(User).filter(User.username.like(f'{BENCH_PREFIX}@%')).delete(synchronize_session=False)
+    db.session.commit()
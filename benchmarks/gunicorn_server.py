@@ -0,0 +1,41 @@
+"""Run the app under gunicorn for the HTTP benchmarks."""
+import os
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'gunicorn did not start listening on {port}')
+
+
+@contextmanager
+def gunicorn(worker_class='sync', workers=2, worker_connections=100, log=None, **env):
+    """Start `gunicorn app:app` with the given settings and extra environment, yield its base url, then stop it."""
+
+    port = free_port()
+    env = dict(os.environ, FLASK_ENV='production', GUNICORN_WORKER_CLASS=worker_class, WEB_CONCURRENCY=str(workers),
+               GUNICORN_WORKER_CONNECTIONS=str(worker_connections), **env)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app', '-b', f'127.0.0.1:{port}'], env=env,
+                              stdout=subprocess.DEVNULL, stderr=log or subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,97 @@
+"""
+Time a Goodreads import against the local Open Library stub, one isbn per call and transaction next to batches.
+Part of the books are already in the books table and never go to Open Library.
+
+    DATABASE_URL=postgres:///personal_library_test python -m benchmarks.imports --books 1000 --local 0.5 --latency-ms 50
+"""
+import argparse
+import io
+import time
+from unittest.mock import patch
+
+import imports
+from app import app
+from benchmarks.fixtures import BENCH_PREFIX, create_user, drop_library
+from benchmarks.openlibrary_stub import start_stub
+from models import db, Book, UserBook, UserBookTag
+from query_budget import count_queries
+
+# the books the benchmark imports, cleaned up with their prefix
+ISBN_PREFIX = '97899'
+
+
+def goodreads_export(n_books, n_shelves=10):
+    lines = ['Book Id,Title,Author,ISBN,ISBN13,Bookshelves,Exclusive Shelf']
+    for i in range(n_books):
+        shelves = ', '.join(f'{BENCH_PREFIX} shelf {(i + j) % n_shelves}' for j in range(2))
+        lines.append(f'{i},Book {i},Author,"=""""","=""{ISBN_PREFIX}{i:08d}""","{shelves}",read')
+    return '\n'.join(lines) + '\n'
+
+
+def add_local_books(n_books, local):
+    """Put every 1/local-th book of the export in the books table already."""
+
+    step = round(1 / local) if local else 0
+    if step:
+        db.session.execute(Book.__table__.insert(), [
+            {'isbn': f'{ISBN_PREFIX}{i:08d}', 'open_library_id': f'OL{i}M', 'title': f'Book {i}'}
+            for i in range(0, n_books, step)
+        ])
+        db.session.commit()
+
+
+def remove_books():
+    db.session.rollback()
+    book_ids = db.session.query(Book.id).filter(Book.isbn.like(f'{ISBN_PREFIX}%'))
+    db.session.query(UserBookTag).filter(UserBookTag.book_id.in_(book_ids)).delete(synchronize_session=False)
+    db.session.query(UserBook).filter(UserBook.book_id.in_(book_ids)).delete(synchronize_session=False)
+    db.session.query(Book).filter(Book.isbn.like(f'{ISBN_PREFIX}%')).delete(synchronize_session=False)
+    db.session.commit()
+    drop_library()
+
+
+def run(export, batch):
+    """Import the export for a fresh user, `batch` rows at a time. Returns (seconds, open library calls, statements)."""
+
+    user = create_user()
+    calls = []
+
+    def counted(isbns):
+        calls.append(len(isbns))
+        return lookup(isbns)
+
+    lookup = imports.lookup_isbns_open_library
+    start = time.perf_counter()
+    with patch('imports.IMPORT_BATCH', batch), patch('imports.lookup_isbns_open_library', counted), \
+            count_queries() as statements:
+        library_import = imports.stage_import(user.id, io.StringIO(export, newline=''))
+        imports.run_import(library_import.id)
+    return time.perf_counter() - start, len(calls), len(statements)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--local', type=float, default=0.5, help='share of the books already in the books table')
+    parser.add_argument('--latency-ms', type=float, default=50, help='added to every Open Library call')
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, imports.IMPORT_BATCH])
+    args = parser.parse_args()
+
+    stub = start_stub(latency_ms=args.latency_ms)
+    app.config['OPEN_LIBRARY_URL'] = f'http://127.0.0.1:{stub.server_port}'
+    export = goodreads_export(args.books)
+
+    print(f"{'batch':>6} {'seconds':>8} {'books/s':>8} {'OL calls':>9} {'statements':>11}")
+    with app.app_context():
+        for batch in args.batches:
+            remove_books()
+            add_local_books(args.books, args.local)
+            try:
+                seconds, calls, statements = run(export, batch)
+                print(f'{batch:>6} {seconds:>8.2f} {args.books / seconds:>8.0f} {calls:>9} {statements:>11}')
+            finally:
+                remove_books()
+
+
+if __name__ == '__main__':
+    main()
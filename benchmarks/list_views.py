@@ -0,0 +1,109 @@
+"""
+Peak Python memory and time of loading what the library page's cards need: whole Book rows as the page used to, next
+to BookCard rows with only the card's columns. Also g.user.books, which routes still load, with and without the images
+json deferred, and the whole page with its cards cached.
+
+    DATABASE_URL=postgres:///personal_library_test python -m benchmarks.list_views --books 5000
+"""
+import argparse
+import statistics
+import time
+import tracemalloc
+
+from sqlalchemy.orm import defaultload, undefer
+
+from app import app, CURR_USER_KEY
+from benchmarks.fixtures import create_library, drop_library
+from fragments import load_book_cards
+from models import db, Book, User, UserBook
+
+
+def measure(run, repeat):
+    """Return (peak MiB of one run, median seconds over `repeat` runs). Every run starts with an empty session."""
+
+    db.session.remove()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    db.session.remove()
+    return peak / 2 ** 20, statistics.median(timings)
+
+
+def book_rows(user_id):
+    """The page before BookCard: whole books, then their tag versions."""
+
+    def run():
+        books = db.session.query(Book).options(undefer(Book.open_library_images))\
+            .join(UserBook)\
+            .filter(UserBook.user_id == user_id)\
+            .all()
+        tag_versions = dict(db.session.query(UserBook.book_id, UserBook.tag_version)
+                            .filter(UserBook.user_id == user_id, UserBook.book_id.in_([book.id for book in books])))
+        return [(book.id, book.title, book.version, book.get_cover_image_url('medium'), tag_versions[book.id])
+                for book in sorted(books, key=lambda book: book.title)]
+    return run
+
+
+def card_rows(user_id):
+    def run():
+        return load_book_cards(user_id, db.session.query(UserBook.book_id).filter(UserBook.user_id == user_id))
+    return run
+
+
+def user_books(user_id, deferred):
+    def run():
+        query = User.query
+        if not deferred:
+            query = query.options(defaultload(User.books).undefer(Book.open_library_images))
+        return [book.id for book in query.get(user_id).books]
+    return run
+
+
+def library_page(user_id):
+    client = app.test_client()
+    with client.session_transaction() as change_session:
+        change_session[CURR_USER_KEY] = user_id
+    # renders and caches every card
+    client.get(f'/users/{user_id}/books')
+
+    def run():
+        return client.get(f'/users/{user_id}/books').get_data()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, nargs='+', default=[5000])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'books':>8} {'load':<28} {'peak MiB':>9} {'median ms':>10}")
+    with app.app_context():
+        for books in args.books:
+            drop_library()
+            user_id = create_library(books)
+            # plans for the new rows rather than for the empty tables autovacuum last saw
+            db.session.execute('ANALYZE books, users_books')
+            try:
+                for label, run in [('Book rows', book_rows(user_id)),
+                                   ('BookCard rows', card_rows(user_id)),
+                                   ('user.books, images loaded', user_books(user_id, deferred=False)),
+                                   ('user.books, images deferred', user_books(user_id, deferred=True)),
+                                   ('library page, cached cards', library_page(user_id))]:
+                    peak, elapsed = measure(run, args.repeat)
+                    print(f'{books:>8} {label:<28} {peak:>9.1f} {elapsed * 1000:>10.1f}')
+            finally:
+                db.session.remove()
+                drop_library()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""
+End to end load test: gunicorn serving the app from a seeded database, with Open Library replaced by the local stub.
+
+`run` drives a weighted mix of routes with one client per seeded user and writes requests per second and a latency
+histogram per route as JSON. `compare` diffs two such files and exits non-zero when a route regressed.
+
+    DATABASE_URL=postgres:///personal_library_seed python -m benchmarks.loadtest run --seed-books 100000 \\
+        --latency-ms 200 --error-rate 0.01 --output before.json
+    ... change something ...
+    DATABASE_URL=postgres:///personal_library_seed python -m benchmarks.loadtest run --output after.json
+    python -m benchmarks.loadtest compare before.json after.json
+"""
+import argparse
+import bisect
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+import requests
+
+from benchmarks.fixtures import BENCH_PREFIX, drop_library, session_cookie
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf')]
+
+DEFAULT_MIX = 'user_books=30,user_book_detail=30,show_user_book_by_tag=10,search_isbn=10,add_book_tag=20'
+
+
+class RouteStats:
+    """Latencies and errors for one route."""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds, ok):
+        with self.lock:
+            if ok:
+                self.latencies.append(seconds * 1000)
+            else:
+                self.errors += 1
+
+    def summary(self, duration):
+        latencies = sorted(self.latencies)
+        counts = [0] * len(BUCKETS_MS)
+        for latency in latencies:
+            counts[bisect.bisect_left(BUCKETS_MS, latency)] += 1
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else None
+
+        return {
+            'count': len(latencies),
+            'errors': self.errors,
+            'requests_per_second': len(latencies) / duration,
+            'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+            'p50_ms': percentile(0.50),
+            'p90_ms': percentile(0.90),
+            'p99_ms': percentile(0.99),
+            'max_ms': latencies[-1] if latencies else None,
+            'histogram': {'le_ms': [str(bucket) for bucket in BUCKETS_MS], 'counts': counts}
+        }
+
+
+class Workload:
+    """What one client knows about its user's library, so it can make requests that are valid for that user."""
+
+    def __init__(self, user_id, book_ids, tag_ids, tagged, isbns):
+        self.user_id = user_id
+        self.book_ids = book_ids
+        self.tag_ids = tag_ids
+        self.tagged = tagged
+        self.isbns = isbns
+
+
+def load_workloads(count, rng):
+    """Snapshot `count` seeded users that have books and tags."""
+
+    from models import db, Book, UserBook, UserTag, UserBookTag
+
+    user_ids = [user_id for user_id, in db.session.query(UserBook.user_id)
+                .join(UserTag, UserTag.user_id == UserBook.user_id)
+                .group_by(UserBook.user_id)
+                .order_by(UserBook.user_id)
+                .limit(count)]
+    workloads = []
+    for user_id in user_ids:
+        book_ids = [book_id for book_id, in db.session.query(UserBook.book_id)
+                    .filter(UserBook.user_id == user_id).limit(500)]
+        tag_ids = [tag_id for tag_id, in db.session.query(UserTag.tag_id).filter(UserTag.user_id == user_id)]
+        tagged = set(db.session.query(UserBookTag.book_id, UserBookTag.tag_id)
+                     .filter(UserBookTag.user_id == user_id, UserBookTag.book_id.in_(book_ids)))
+        isbns = [isbn for isbn, in db.session.query(Book.isbn).filter(Book.id.in_(rng.sample(book_ids, min(20, len(
+            book_ids)))))]
+        workloads.append(Workload(user_id, book_ids, tag_ids, tagged, isbns))
+    db.session.remove()
+    return workloads
+
+
+def make_request(http, url, route, workload, rng, new_isbns):
+    """Send one request for the route. Returns the name it is recorded under and whether the response was expected."""
+
+    user_id = workload.user_id
+    if route == 'user_books':
+        return route, http.get(f'{url}/users/{user_id}/books').status_code == 200
+    if route == 'user_book_detail':
+        book_id = rng.choice(workload.book_ids)
+        return route, http.get(f'{url}/users/{user_id}/books/{book_id}').status_code == 200
+    if route == 'show_user_book_by_tag':
+        tag_id = rng.choice(workload.tag_ids)
+        return route, http.get(f'{url}/users/{user_id}/tags/{tag_id}').status_code == 200
+    if route == 'search_isbn':
+        # half the lookups are for books already in the database, the other half go to open library
+        isbn = rng.choice(workload.isbns) if rng.random() < 0.5 else f'{BENCH_PREFIX}-lt-{next(new_isbns)}'
+        resp = http.post(f'{url}/books/search', data={'isbn': isbn}, allow_redirects=False)
+        return route, resp.status_code == 302
+    if route == 'add_book_tag':
+        # toggle so that the library stays the same size, removals are recorded as delete_book_tag
+        pair = (rng.choice(workload.book_ids), rng.choice(workload.tag_ids))
+        if pair in workload.tagged:
+            resp = http.post(f'{url}/users/{user_id}/books/{pair[0]}/tag/{pair[1]}/delete', allow_redirects=False)
+            workload.tagged.discard(pair)
+            return 'delete_book_tag', resp.status_code == 302
+        resp = http.post(f'{url}/users/{user_id}/books/{pair[0]}/tag/{pair[1]}', allow_redirects=False)
+        workload.tagged.add(pair)
+        return route, resp.status_code == 302
+    raise ValueError(f'Unknown route in the mix: {route}')
+
+
+def drive(url, app, workloads, mix, seconds, warmup, seed):
+    """Run one client per workload for warmup + seconds, and return the stats gathered after the warmup."""
+
+    routes, weights = zip(*mix.items())
+    stats = {}
+    stats_lock = threading.Lock()
+    new_isbns = itertools.count()
+    started = time.perf_counter()
+    measure_from = started + warmup
+    deadline = measure_from + seconds
+
+    def client(index, workload):
+        rng = random.Random(f'{seed}-{index}')
+        with requests.Session() as http:
+            http.cookies.set('session', session_cookie(app, workload.user_id))
+            while True:
+                start = time.perf_counter()
+                if start >= deadline:
+                    return
+                route = rng.choices(routes, weights=weights)[0]
+                try:
+                    route, ok = make_request(http, url, route, workload, rng, new_isbns)
+                except requests.RequestException:
+                    ok = False
+                if start >= measure_from:
+                    with stats_lock:
+                        route_stats = stats.setdefault(route, RouteStats())
+                    route_stats.record(time.perf_counter() - start, ok)
+
+    clients = [threading.Thread(target=client, args=(i, workload)) for i, workload in enumerate(workloads)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    return stats
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        route, weight = part.split('=')
+        mix[route.strip()] = float(weight)
+    return mix
+
+
+def run(args):
+    if args.seed_books:
+        import seed
+        from app import app
+        with app.app_context():
+            seed.generate(seed.parse_args(['--users', str(args.seed_users), '--books', str(args.seed_books),
+                                           '--seed', str(args.seed)]))
+
+    from app import app
+    from benchmarks.gunicorn_server import gunicorn
+    from benchmarks.openlibrary_stub import start_stub
+
+    mix = parse_mix(args.mix)
+    workloads = load_workloads(args.concurrency, random.Random(args.seed))
+    if not workloads:
+        sys.exit('No users with books and tags in the database, seed it first (--seed-books).')
+
+    stub = start_stub(latency_ms=args.latency_ms, error_rate=args.error_rate)
+    try:
+        with gunicorn(args.worker_class, args.workers, args.concurrency,
+                      OPEN_LIBRARY_URL=f'http://127.0.0.1:{stub.server_port}') as url:
+            stats = drive(url, app, workloads, mix, args.seconds, args.warmup, args.seed)
+    finally:
+        stub.shutdown()
+        # remove the books and authors the isbn searches added
+        drop_library()
+
+    total = RouteStats()
+    for route_stats in stats.values():
+        total.latencies.extend(route_stats.latencies)
+        total.errors += route_stats.errors
+    result = {
+        'settings': {key: value for key, value in vars(args).items() if key != 'func'},
+        'clients': len(workloads),
+        'routes': {route: route_stats.summary(args.seconds) for route, route_stats in sorted(stats.items())},
+        'total': total.summary(args.seconds)
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    print_table(result)
+    print(f'wrote {args.output}')
+
+
+def print_table(result):
+    print(f"{'route':<24} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for route, summary in list(result['routes'].items()) + [('total', result['total'])]:
+        print(f"{route:<24} {summary['requests_per_second']:>8.1f} {summary['p50_ms'] or 0:>8.1f} "
+              f"{summary['p90_ms'] or 0:>8.1f} {summary['p99_ms'] or 0:>8.1f} {summary['errors']:>7}")
+
+
+def compare(args):
+    """Flag routes whose throughput fell or whose p99 rose by more than the thresholds."""
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    regressions = []
+    print(f"{'route':<24} {'req/s':>18} {'change':>8} {'p99 ms':>18} {'change':>8}")
+    for route in sorted(set(baseline['routes']) & set(candidate['routes'])):
+        old, new = baseline['routes'][route], candidate['routes'][route]
+        rps_change = new['requests_per_second'] / old['requests_per_second'] - 1 if old['requests_per_second'] else 0
+        p99_change = new['p99_ms'] / old['p99_ms'] - 1 if old['p99_ms'] and new['p99_ms'] else 0
+        flags = []
+        if rps_change < -args.throughput_threshold:
+            flags.append('throughput')
+        if p99_change > args.latency_threshold:
+            flags.append('p99')
+        if new['errors'] > old['errors']:
+            flags.append('errors')
+        if flags:
+            regressions.append(route)
+        print(f"{route:<24} {old['requests_per_second']:>8.1f} -> {new['requests_per_second']:>6.1f} "
+              f"{rps_change:>+8.0%} {old['p99_ms'] or 0:>8.1f} -> {new['p99_ms'] or 0:>6.1f} {p99_change:>+8.0%}"
+              f"  {'REGRESSION: ' + ', '.join(flags) if flags else ''}")
+
+    if regressions:
+        sys.exit(f"{len(regressions)} route(s) regressed: {', '.join(regressions)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='load test the app and write the results as json')
+    run_parser.add_argument('--output', default='loadtest.json')
+    run_parser.add_argument('--seconds', type=float, default=30)
+    run_parser.add_argument('--warmup', type=float, default=5, help='seconds of load before measuring')
+    run_parser.add_argument('--concurrency', type=int, default=20, help='clients, each logged in as its own user')
+    run_parser.add_argument('--mix', default=DEFAULT_MIX, help='route=weight pairs')
+    run_parser.add_argument('--workers', type=int, default=2)
+    run_parser.add_argument('--worker-class', default='sync')
+    run_parser.add_argument('--latency-ms', type=float, default=200, help='Open Library stub latency')
+    run_parser.add_argument('--error-rate', type=float, default=0.0, help='share of Open Library calls that fail')
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument('--seed-books', type=int, default=0, help='regenerate the database with this many books')
+    run_parser.add_argument('--seed-users', type=int, default=100)
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--throughput-threshold', type=float, default=0.10)
+    compare_parser.add_argument('--latency-threshold', type=float, default=0.25)
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Logins per second per core at each bcrypt cost factor.
+
+Every thread logs the same user in over and over through User.authenticate, so the numbers include the user lookup.
+
+    DATABASE_URL=postgres:///personal_library_test python -m benchmarks.login_throughput --costs 10 11 12 13
+"""
+import argparse
+import os
+import threading
+import time
+
+from app import app
+from models import db, User
+from passwords import passwords
+
+USERNAME = 'bench-login@nodomain.com'
+PASSWORD = 'correct horse battery staple'
+
+
+def run_logins(seconds, counts, index):
+    with app.app_context():
+        deadline = time.perf_counter() + seconds
+        count = 0
+        while time.perf_counter() < deadline:
+            assert User.authenticate(USERNAME, PASSWORD)
+            count += 1
+        counts[index] = count
+        db.session.remove()
+
+
+def measure(cost, threads, seconds):
+    """Return the logins per second reached by `threads` concurrent login loops at the given cost."""
+
+    passwords.log_rounds = cost
+    User.query.filter_by(username=USERNAME).delete()
+    User.signup(USERNAME, PASSWORD)
+    db.session.commit()
+
+    counts = [0] * threads
+    workers = [threading.Thread(target=run_logins, args=(seconds, counts, i)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--costs', type=int, nargs='+', default=[8, 10, 11, 12, 13])
+    parser.add_argument('--cores', type=int, default=os.cpu_count(), help='login threads, one per core')
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    # one login thread per core, each hashing on its own thread, and enough login slots that none are turned away
+    passwords._slots = threading.BoundedSemaphore(args.cores)
+
+    print(f"{'cost':>4} {'logins/s':>10} {'logins/s/core':>14} {'ms/login':>9}")
+    try:
+        for cost in args.costs:
+            rate = measure(cost, args.cores, args.seconds)
+            print(f'{cost:>4} {rate:>10.1f} {rate / args.cores:>14.1f} {1000 * args.cores / rate:>9.1f}')
+    finally:
+        User.query.filter_by(username=USERNAME).delete()
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
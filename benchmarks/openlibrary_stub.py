@@ -0,0 +1,91 @@
+"""
+A local stand-in for the Open Library books api with configurable latency and error rate.
+Point the app at it with OPEN_LIBRARY_URL=http://127.0.0.1:<port>.
+
+    python -m benchmarks.openlibrary_stub --port 8090 --latency-ms 200 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def fake_book(isbn):
+    """Book data shaped like the jscmd=data response, stable for a given isbn."""
+
+    rng = random.Random(isbn)
+    number = rng.randrange(1000000)
+    return {
+        'url': f'https://openlibrary.org/books/OL{number}M',
+        'key': f'/books/OL{number}M',
+        'title': f'Stub book {isbn}',
+        'number_of_pages': rng.randrange(32, 900),
+        'publish_date': str(rng.randrange(1900, 2021)),
+        'authors': [{'name': f'bench author {rng.randrange(500)}'} for _ in range(rng.randrange(1, 3))],
+        'cover': {size: f'https://covers.openlibrary.org/b/id/{number}-{size[0].upper()}.jpg'
+                  for size in ('small', 'medium', 'large')}
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    error_rate = 0.0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        time.sleep(self.latency)
+
+        if url.path != '/api/books':
+            self.send_error(404)
+            return
+        if random.random() < self.error_rate:
+            self.send_error(500)
+            return
+
+        bibkeys = parse_qs(url.query).get('bibkeys', [''])[0]
+        body = json.dumps({
+            key: fake_book(key[len('ISBN:'):]) for key in bibkeys.split(',') if key.startswith('ISBN:')
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port=0, latency_ms=0, error_rate=0.0):
+    """Serve the stub from a background thread. Returns the server, its url is http://127.0.0.1:<server_port>."""
+
+    handler = type('ConfiguredStubHandler', (StubHandler,), {
+        'latency': latency_ms / 1000,
+        'error_rate': error_rate
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    server = start_stub(args.port, args.latency_ms, args.error_rate)
+    print(f'Open Library stub on http://127.0.0.1:{server.server_port}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
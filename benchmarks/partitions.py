@@ -0,0 +1,100 @@
+"""
+Time the queries on the per user tables before and after hash partitioning them: the page queries, which name one user,
+and the background jobs' lookups across users, which read every partition. Converts the database it runs on, so point
+it at a scratch copy filled by seed.py:
+
+    DATABASE_URL=postgres:///personal_library_seed python seed.py --users 2000 --books 50000
+    DATABASE_URL=postgres:///personal_library_seed python -m benchmarks.partitions --partitions 16
+"""
+import argparse
+import random
+import re
+import statistics
+import sys
+import time
+
+from sqlalchemy import text
+
+from app import app
+from models import db, UserBook, UserBookTag
+from orphans import ORPHAN_TABLES, SCAN_BATCH, unreferenced
+from partitions import partition_tables, table_kind
+
+
+def sample(args):
+    """Users with books and tags, and books with owners, to run the queries for."""
+
+    rng = random.Random(args.seed)
+    pairs = db.session.query(UserBookTag.user_id, UserBookTag.book_id, UserBookTag.tag_id)\
+        .order_by(db.func.random()).limit(args.repeat).all()
+    book_ids = [book_id for book_id, in db.session.query(UserBook.book_id).distinct().limit(10000)]
+    return pairs, [rng.sample(book_ids, min(100, len(book_ids))) for _ in range(args.repeat)]
+
+
+def queries(pairs, merged_books):
+    """(label, [query per run]) for each kind of statement the app runs on these tables."""
+
+    tag_ids = db.session.query(db.func.max(ORPHAN_TABLES[0].model.id)).scalar() or 0
+    return [
+        ('tag page (one user)', [
+            db.session.query(UserBookTag.book_id).filter_by(user_id=user_id, tag_id=tag_id)
+            for user_id, book_id, tag_id in pairs]),
+        ('isbn search (one user)', [
+            db.session.query(UserBook.query.filter_by(user_id=user_id, book_id=book_id).exists())
+            for user_id, book_id, tag_id in pairs]),
+        ('merged books\' owners', [
+            db.session.query(UserBook.user_id).filter(UserBook.book_id.in_(book_ids)) for book_ids in merged_books]),
+        ('orphaned tags', [
+            db.session.query(db.func.count()).filter(unreferenced(ORPHAN_TABLES[0], 0, min(tag_ids, SCAN_BATCH)))]),
+    ]
+
+
+def scanned(query):
+    """How many partitions, or tables, the plan of `query` reads."""
+
+    sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    plan = '\n'.join(line for line, in db.session.execute(text(f'EXPLAIN {sql}')))
+    return len(set(re.findall(r' on (users_(?:books|tags|books_tags)(?:_p\d+)?)\b', plan)))
+
+
+def time_queries(runs):
+    """Median milliseconds of the runs, each run once to warm the cache first."""
+
+    for query in runs:
+        query.all()
+    times = []
+    for query in runs:
+        start = time.perf_counter()
+        query.all()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--partitions', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with app.app_context():
+        if table_kind('users_books') == 'p':
+            sys.exit('users_books is already partitioned, run this on a freshly seeded database')
+        pairs, merged_books = sample(args)
+        if not pairs:
+            sys.exit('users_books_tags is empty, fill the database with seed.py first')
+
+        before = [(label, time_queries(runs), scanned(runs[0])) for label, runs in queries(pairs, merged_books)]
+        db.session.commit()
+        start = time.perf_counter()
+        partition_tables(args.partitions)
+        print(f'partitioned into {args.partitions} in {time.perf_counter() - start:.1f}s')
+        after = [(time_queries(runs), scanned(runs[0])) for label, runs in queries(pairs, merged_books)]
+
+        print(f"{'query':<26} {'before ms':>10} {'after ms':>10} {'partitions read':>16}")
+        for (label, before_ms, tables), (after_ms, partitions) in zip(before, after):
+            print(f'{label:<26} {before_ms:>10.2f} {after_ms:>10.2f} {partitions:>16}')
+
+
+if __name__ == '__main__':
+    main()
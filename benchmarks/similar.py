@@ -0,0 +1,58 @@
+"""
+Time the "more like this" job: a full refresh over every book, then an incremental one after a batch of new books.
+
+    DATABASE_URL=postgres:///personal_library_test python -m benchmarks.similar --books 10000 50000 --new 100
+"""
+import argparse
+import random
+import time
+
+from app import app
+from benchmarks.fixtures import BENCH_PREFIX, create_library, drop_library
+from models import db, Book, Author, BookAuthor, SimilarBook, SimilarRefresh
+from similar import refresh_similar_books
+
+
+def add_books(n_books, start):
+    """Books by the benchmark's authors, like the ones an import brings in."""
+
+    author_ids = [author_id for author_id, in db.session.query(Author.id).filter(Author.name.like(f'{BENCH_PREFIX} %'))]
+    book_ids = db.session.execute(Book.__table__.insert().returning(Book.id), [
+        {'isbn': f'{BENCH_PREFIX}-{start + i}', 'open_library_id': f'OL{start + i}M', 'title': f'New book {i}'}
+        for i in range(n_books)
+    ]).scalars().all()
+    db.session.execute(BookAuthor.__table__.insert(), [
+        {'book_id': book_id, 'author_id': author_id}
+        for book_id in book_ids for author_id in random.sample(author_ids, 2)
+    ])
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, nargs='+', default=[10000])
+    parser.add_argument('--new', type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'books':>8} {'full s':>8} {'neighbours':>11} {'new':>5} {'incremental s':>14} {'lists updated':>14}")
+    with app.app_context():
+        for books in args.books:
+            drop_library()
+            first_refresh = (db.session.query(db.func.max(SimilarRefresh.id)).scalar() or 0) + 1
+            create_library(books)
+            try:
+                full = refresh_similar_books(full=True)
+                neighbours = SimilarBook.query.count()
+                add_books(args.new, books)
+                start = time.perf_counter()
+                incremental = refresh_similar_books()
+                print(f'{books:>8} {full.seconds:>8.2f} {neighbours:>11} {args.new:>5} '
+                      f'{time.perf_counter() - start:>14.2f} {incremental.books:>14}')
+            finally:
+                drop_library()
+                SimilarRefresh.query.filter(SimilarRefresh.id >= first_refresh).delete()
+                db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
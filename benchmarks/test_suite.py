@@ -0,0 +1,43 @@
+"""
+Wall time of the test suite with the shared database, with every test rolled back, and spread over xdist workers.
+
+    python -m benchmarks.test_suite --workers 4 --runs 3
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+def run_suite(args):
+    """Run pytest with the extra arguments and return the wall time in seconds."""
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider'] + args,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    modes = [
+        ('shared database', ['--shared-db']),
+        ('rolled back', []),
+        (f'rolled back, {args.workers} workers', ['-n', str(args.workers)]),
+    ]
+    # creates the per worker databases, so the timed runs don't pay for it
+    run_suite(['-n', str(args.workers), '--collect-only'])
+
+    print(f"{'mode':<28} {'median s':>9} {'best s':>9}")
+    for label, extra in modes:
+        times = [run_suite(extra) for _ in range(args.runs)]
+        print(f'{label:<28} {statistics.median(times):>9.2f} {min(times):>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Small key/value caches with LRU eviction.
+
+LocalCache lives in the worker's memory. SQLiteCache keeps entries in a file that every worker on the host shares, and
+stands in for a shared store like memcached or redis. Both take and return str values keyed by str.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache:
+    """An in-process LRU cache holding at most `max_entries` values."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def get_many(self, keys):
+        """Return a dict of the keys that are cached."""
+
+        found = {}
+        with self._lock:
+            for key in keys:
+                value = self._entries.get(key)
+                if value is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = value
+        return found
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def set_many(self, mapping):
+        for key, value in mapping.items():
+            self.set(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """
+    An LRU cache in a sqlite file shared by every process on the host.
+    Reads record an access time, and writes trim the least recently used entries beyond `max_entries`.
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        # sqlite connections can't be shared between threads
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Return a dict of the keys that are cached."""
+
+        keys = list(keys)
+        found = {}
+        conn = self._connect()
+        # stay well under sqlite's limit on bound parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            found.update(conn.execute(f'SELECT key, value FROM cache WHERE key IN ({placeholders})', chunk))
+        if found:
+            with conn:
+                conn.executemany('UPDATE cache SET accessed = ? WHERE key = ?',
+                                 [(time.time(), key) for key in found])
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, mapping):
+        if not mapping:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO cache (key, value, accessed) VALUES (?, ?, ?)',
+                             [(key, value, now) for key, value in mapping.items()])
+            conn.execute('DELETE FROM cache WHERE key IN '
+                         '(SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache')
+
+    def __len__(self):
+        return self._connect().execute('SELECT count(*) FROM cache').fetchone()[0]
+
+
+def create_cache(backend, max_entries, path=None):
+    """Build the cache named by a config value: 'local' or 'sqlite'."""
+
+    if backend == 'local':
+        return LocalCache(max_entries)
+    if backend == 'sqlite':
+        return SQLiteCache(path or os.path.join(os.getcwd(), 'cache.sqlite3'), max_entries)
+    raise ValueError(f'Unknown cache backend: {backend}')
@@ -0,0 +1,140 @@
+import os
+import click
+from flask.cli import with_appcontext
+from models import db, User, LibraryImport
+from migrations import create_schema
+from imports import ImportFileError, stage_import, run_import
+from similar import refresh_similar_books
+from vocabulary import merge_vocabularies
+from orphans import collect_orphans
+from partitions import partition_tables
+
+
+@click.command('create-db')
+@with_appcontext
+def create_db():
+    """Create any missing tables and apply schema migrations to existing ones."""
+
+    create_schema()
+    click.echo('Created the database schema.')
+
+
+@click.command('drop-db')
+@with_appcontext
+@click.confirmation_option(prompt='This deletes every table and all of their data. Continue?')
+def drop_db():
+    """Drop every table."""
+
+    db.drop_all()
+    click.echo('Dropped the database schema.')
+
+
+def run_with_progress(import_id):
+    """Run an import showing a progress bar, and fail with how to resume it when it stops."""
+
+    library_import = LibraryImport.query.get(import_id)
+    with click.progressbar(length=library_import.total, label=f'Import {import_id}') as bar:
+        bar.update(library_import.done)
+        finished = run_import(import_id, progress=bar.update)
+
+    library_import = LibraryImport.query.get(import_id)
+    if not finished:
+        raise click.ClickException(f'Import {import_id} is {library_import.status}: {library_import.error}. '
+                                   f'Carry on with `flask resume-import {import_id}`.')
+    click.echo(f'Added {library_import.imported} books, {library_import.not_found} were not found on Open Library.')
+
+
+@click.command('import-library')
+@click.argument('username')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def import_library(username, path):
+    """Import a Goodreads or LibraryThing export into the user's library."""
+
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f'There is no user {username}.')
+
+    with open(path, encoding='utf-8-sig', newline='') as lines:
+        try:
+            library_import = stage_import(user.id, lines, os.path.basename(path))
+        except ImportFileError as error:
+            raise click.ClickException(str(error))
+
+    run_with_progress(library_import.id)
+
+
+@click.command('resume-import')
+@click.argument('import_id', type=int)
+@with_appcontext
+def resume_import(import_id):
+    """Carry on with a failed or abandoned import from its first unfinished row."""
+
+    if not LibraryImport.query.get(import_id):
+        raise click.ClickException(f'There is no import {import_id}.')
+
+    run_with_progress(import_id)
+
+
+@click.command('refresh-similar')
+@click.option('--full', is_flag=True, help='Recompute every book instead of the ones added since the last run.')
+@with_appcontext
+def refresh_similar(full):
+    """Update the "more like this" neighbours of the books added since the last run."""
+
+    refresh = refresh_similar_books(full)
+    click.echo(f'Updated the neighbours of {refresh.books} books in {refresh.seconds:.1f}s.')
+
+
+@click.command('merge-vocabulary')
+@with_appcontext
+def merge_vocabulary():
+    """Key the author, publisher and subject names and merge the rows that spell the same name differently."""
+
+    for table, (filled, merged) in merge_vocabularies().items():
+        click.echo(f'{table}: keyed {filled} names, merged {merged} duplicates.')
+
+
+@click.command('collect-orphans')
+@click.option('--budget', default=60.0, show_default=True, help='Seconds to spend before stopping.')
+@click.option('--dry-run', is_flag=True, help='Count the orphaned rows without deleting them.')
+@with_appcontext
+def collect_orphans_command(budget, dry_run):
+    """Delete the tags, authors, publishers and subjects nothing links to any more."""
+
+    reports = collect_orphans(budget, dry_run)
+    for table, report in reports.items():
+        done = 'all' if report.complete else 'stopped after'
+        if dry_run:
+            click.echo(f'{table}: {report.found} orphans in {done} {report.scanned} rows.')
+        else:
+            click.echo(f'{table}: deleted {report.deleted} orphans in {done} {report.scanned} rows.')
+    if not all(report.complete for report in reports.values()):
+        click.echo('The time budget ran out before every table was done, give it a larger --budget.')
+
+
+@click.command('partition-tables')
+@click.option('--partitions', default=16, show_default=True, help='Hash partitions per table.')
+@with_appcontext
+def partition_tables_command(partitions):
+    """Hash partition users_books, users_tags and users_books_tags on user_id, copying the rows while the app runs."""
+
+    for table, copied in partition_tables(partitions).items():
+        if copied is None:
+            click.echo(f'{table} is already partitioned.')
+        else:
+            click.echo(f'{table}: copied {copied} rows into {partitions} partitions. The old table is kept as '
+                       f'{table}_unpartitioned, drop it once the app is fine without it.')
+
+
+def register_commands(app):
+    """Add the database management commands to the app's `flask` cli."""
+
+    app.cli.add_command(create_db)
+    app.cli.add_command(drop_db)
+    app.cli.add_command(import_library)
+    app.cli.add_command(resume_import)
+    app.cli.add_command(refresh_similar)
+    app.cli.add_command(merge_vocabulary)
+    app.cli.add_command(collect_orphans_command)
+    app.cli.add_command(partition_tables_command)
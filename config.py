@@ -0,0 +1,120 @@
+import os
+
+
+def get_database_uri(default):
+    """
+    Get DB_URI from environ variable (useful for production/testing) or, if not set there, use the passed in default.
+    Heroku still hands out postgres:// urls which SQLAlchemy no longer accepts, so rewrite the scheme.
+    """
+
+    return os.environ.get('DATABASE_URL', default).replace("://", "ql://", 1)
+
+
+class Config:
+    """Settings shared by every environment."""
+
+    SQLALCHEMY_DATABASE_URI = get_database_uri('postgres:///personal_library')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    # database connections per worker. In gevent mode greenlets wait their turn for one without blocking the worker.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    }
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+    DEBUG_TOOLBAR = False
+    # rendered book cards, 'local' keeps them in each worker and 'sqlite' shares a file between the workers on a host
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND', 'local')
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 20000))
+    FRAGMENT_CACHE_PATH = os.environ.get('FRAGMENT_CACHE_PATH')
+    # book ids found by library searches and tag pages, kept per user and library version. Larger results aren't kept.
+    SEARCH_CACHE_BACKEND = os.environ.get('SEARCH_CACHE_BACKEND', 'local')
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 10000))
+    SEARCH_CACHE_MAX_IDS = int(os.environ.get('SEARCH_CACHE_MAX_IDS', 5000))
+    SEARCH_CACHE_PATH = os.environ.get('SEARCH_CACHE_PATH')
+    # bcrypt cost factor, every step doubles the work per login. Hashes with another cost are redone at login.
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    # threads per gevent worker running bcrypt, how many logins may wait for a hash and for how many seconds
+    BCRYPT_THREADS = int(os.environ.get('BCRYPT_THREADS', 2))
+    LOGIN_CONCURRENCY = int(os.environ.get('LOGIN_CONCURRENCY', 8))
+    LOGIN_QUEUE_TIMEOUT = float(os.environ.get('LOGIN_QUEUE_TIMEOUT', 3))
+    OPEN_LIBRARY_URL = os.environ.get('OPEN_LIBRARY_URL', 'https://openlibrary.org')
+    OPEN_LIBRARY_TIMEOUT = float(os.environ.get('OPEN_LIBRARY_TIMEOUT', 10))
+    # Open Library calls per second from every worker together, the burst allowed after a quiet spell and the longest a
+    # call waits for its turn. Page views and imports have budgets of their own. OPEN_LIBRARY_RATE_LIMIT=0 turns it off.
+    OPEN_LIBRARY_RATE_LIMIT = os.environ.get('OPEN_LIBRARY_RATE_LIMIT', '1') == '1'
+    OPEN_LIBRARY_INTERACTIVE_RATE = float(os.environ.get('OPEN_LIBRARY_INTERACTIVE_RATE', 2))
+    OPEN_LIBRARY_INTERACTIVE_BURST = float(os.environ.get('OPEN_LIBRARY_INTERACTIVE_BURST', 10))
+    OPEN_LIBRARY_INTERACTIVE_MAX_WAIT = float(os.environ.get('OPEN_LIBRARY_INTERACTIVE_MAX_WAIT', 3))
+    OPEN_LIBRARY_BACKGROUND_RATE = float(os.environ.get('OPEN_LIBRARY_BACKGROUND_RATE', 1))
+    OPEN_LIBRARY_BACKGROUND_BURST = float(os.environ.get('OPEN_LIBRARY_BACKGROUND_BURST', 2))
+    OPEN_LIBRARY_BACKGROUND_MAX_WAIT = float(os.environ.get('OPEN_LIBRARY_BACKGROUND_MAX_WAIT', 300))
+    # per request timings and query counts served on /metrics, METRICS_TOKEN makes scrapers send a bearer token
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # opt-in: statements slower than this many milliseconds are saved with their plan, see /admin/slow-queries
+    SLOW_QUERY_MS = float(os.environ['SLOW_QUERY_MS']) if os.environ.get('SLOW_QUERY_MS') else None
+    SLOW_QUERY_KEEP = int(os.environ.get('SLOW_QUERY_KEEP', 10000))
+    SLOW_QUERY_EXPLAIN_INTERVAL = float(os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', 60))
+    # run slow SELECTs again under EXPLAIN ANALYZE for their actual row counts and timings, which doubles their load
+    SLOW_QUERY_EXPLAIN_ANALYZE = os.environ.get('SLOW_QUERY_EXPLAIN_ANALYZE') == '1'
+    # comma separated usernames that may see the admin pages
+    ADMIN_USERNAMES = [name for name in os.environ.get('ADMIN_USERNAMES', '').split(',') if name]
+    # users whose autocomplete index each worker keeps in memory
+    AUTOCOMPLETE_USERS = int(os.environ.get('AUTOCOMPLETE_USERS', 1000))
+    # library imports run on a thread of the worker that took the upload. One that hasn't finished a batch in this many
+    # seconds is taken to have lost its worker and can be resumed.
+    IMPORT_IN_BACKGROUND = True
+    IMPORT_STALE_SECONDS = int(os.environ.get('IMPORT_STALE_SECONDS', 300))
+    # logged in users each worker keeps in memory. Workers hear of changes from a listener on a connection of their own,
+    # and reload anything older than INVALIDATION_TTL seconds in case they missed one.
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+    INVALIDATION_LISTEN = os.environ.get('INVALIDATION_LISTEN', '1') == '1'
+    INVALIDATION_TTL = float(os.environ.get('INVALIDATION_TTL', 60))
+    # seconds between adding books and refreshing the "more like this" lists in the background, empty to leave it to
+    # the scheduled `flask refresh-similar`
+    SIMILAR_REFRESH_DELAY = float(os.environ.get('SIMILAR_REFRESH_DELAY', 30)) \
+        if os.environ.get('SIMILAR_REFRESH_DELAY') != '' else None
+
+
+class ProductionConfig(Config):
+    """Settings for the deployed app. No SQL echo and no debug toolbar."""
+
+
+class DevelopmentConfig(Config):
+    """Settings for running locally with flask run."""
+
+    DEBUG = True
+    SQLALCHEMY_ECHO = True
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+
+class TestingConfig(Config):
+    """Settings for the test suite."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = get_database_uri('postgres:///personal_library_test')
+    WTF_CSRF_ENABLED = False
+    # the cheapest cost bcrypt allows, the tests hash a lot of passwords
+    BCRYPT_LOG_ROUNDS = 4
+    # imports finish inside the upload request, where the test can see what they did
+    IMPORT_IN_BACKGROUND = False
+    # the tests' commits never reach the database, so there would be nothing to hear
+    INVALIDATION_LISTEN = False
+    # a refresh on another thread would share the test's connection
+    SIMILAR_REFRESH_DELAY = None
+
+
+configs = {
+    'production': ProductionConfig,
+    'development': DevelopmentConfig,
+    'testing': TestingConfig
+}
+
+
+def get_config(name=None):
+    """Return the config class for the named environment, falling back to FLASK_ENV and then production."""
+
+    return configs[name or os.environ.get('FLASK_ENV') or 'production']
@@ -0,0 +1,111 @@
+"""
+Test database isolation for pytest.
+
+Every test runs inside a transaction that is rolled back afterwards. The session works in a savepoint within it, so the
+commits and rollbacks made by the app and the tests stay inside the test. Each pytest-xdist worker gets a database of
+its own (personal_library_test_gw0, ...), created on first use, so `pytest -n 4` runs the suite in parallel. The tables
+are emptied once at the start of the session, so isolation.clean_tables has nothing to do in the tests' setUp.
+`--shared-db` goes back to committing to the one shared database, where it deletes the rows again for every test.
+The rate limiter's buckets are committed on a connection of their own either way, so they are emptied after every test.
+"""
+import os
+
+import pytest
+from sqlalchemy import create_engine, event
+
+BASE_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', 'postgres:///personal_library_test')
+WORKER = os.environ.get('PYTEST_XDIST_WORKER')
+TEST_DATABASE_URL = f'{BASE_DATABASE_URL}_{WORKER}' if WORKER else BASE_DATABASE_URL
+# set before any test module is imported, so whichever module reads the config first reads the test database from it.
+# A DATABASE_URL exported in the shell is never used.
+os.environ['TEST_DATABASE_URL'] = os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+os.environ['FLASK_ENV'] = 'testing'
+
+
+def pytest_addoption(parser):
+    parser.addoption('--shared-db', action='store_true',
+                     help='commit to the one test database instead of rolling every test back')
+
+
+def pytest_configure(config):
+    if WORKER:
+        create_database(TEST_DATABASE_URL)
+
+
+def create_database(url):
+    """Create the database named at the end of the url, unless it exists."""
+
+    base, name = url.rsplit('/', 1)
+    # same scheme fix as config.get_database_uri
+    engine = create_engine(f'{base}/postgres'.replace('://', 'ql://', 1), isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as conn:
+            if not conn.execute('SELECT 1 FROM pg_database WHERE datname = %s', (name,)).scalar():
+                conn.execute(f'CREATE DATABASE "{name}"')
+    finally:
+        engine.dispose()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def empty_tables(request):
+    """Start the rolled back tests from empty tables, whatever a --shared-db run or an interrupted one left behind."""
+
+    if request.config.getoption('shared_db'):
+        return
+
+    from models import db
+
+    if db.engine.url.database != TEST_DATABASE_URL.rsplit('/', 1)[1]:
+        raise pytest.UsageError(f'the app is connected to {db.engine.url.database}, not the test database '
+                                f'{TEST_DATABASE_URL}, its tables are left alone')
+    with db.engine.begin() as conn:
+        conn.execute(f"TRUNCATE {', '.join(table.name for table in db.metadata.sorted_tables)} CASCADE")
+
+
+@pytest.fixture(autouse=True)
+def database_transaction(request, empty_tables):
+    """Bind the session to a connection in a transaction for the test, and roll it all back at the end."""
+
+    if request.config.getoption('shared_db'):
+        yield
+        return
+
+    import isolation
+    from models import db
+
+    db.session.remove()
+    session_options = dict(db.session.session_factory.kw)
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    savepoint = connection.begin_nested()
+    # flask-sqlalchemy binds every table to the engine by default, those binds would win over the connection
+    db.session.configure(bind=connection, binds={})
+
+    def restart_savepoint(session, ended):
+        # every commit or rollback in the test or the app ends the savepoint, start the next one
+        nonlocal savepoint
+        if not savepoint.is_active:
+            savepoint = connection.begin_nested()
+
+    event.listen(db.session, 'after_transaction_end', restart_savepoint)
+    isolation.rolled_back = True
+    try:
+        yield
+    finally:
+        isolation.rolled_back = False
+        event.remove(db.session, 'after_transaction_end', restart_savepoint)
+        db.session.remove()
+        db.session.session_factory.kw = session_options
+        transaction.rollback()
+        connection.close()
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limits(empty_tables):
+    """Empty the token buckets after the test, so the Open Library calls of one test don't hold up the next."""
+
+    yield
+    from models import db, RateLimit
+
+    with db.engine.begin() as conn:
+        conn.execute(RateLimit.__table__.delete())
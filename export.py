@@ -0,0 +1,139 @@
+"""
+Backups of a user's library as CSV or JSON Lines.
+
+Rows are read through a server side cursor a batch at a time and written to the response as they arrive, so memory
+stays flat however large the library is. Clients that accept gzip get the stream compressed.
+"""
+import csv
+import io
+import json
+import zlib
+
+from flask import Blueprint, Response, flash, g, redirect, request, stream_with_context
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
+
+from models import db, Book, Author, Publisher, Subject, BookAuthor, BookPublisher, BookSubject, UserBook, Tag, \
+    UserBookTag
+
+export = Blueprint('export', __name__)
+
+# rows fetched from the cursor, and written to the response, at a time
+EXPORT_BATCH = 1000
+
+EXPORT_COLUMNS = ['isbn', 'title', 'authors', 'publishers', 'subjects', 'tags']
+# joins the names in a csv cell
+CSV_LIST_SEPARATOR = '; '
+
+
+def names(model, link, link_column):
+    """The sorted names linked to the book in the enclosing query, as an array, or null when there are none."""
+
+    return db.session.query(array_agg(aggregate_order_by(model.name, model.name)))\
+        .join(link, link_column == model.id)\
+        .filter(link.book_id == Book.id)\
+        .scalar_subquery()
+
+
+def library_rows(user_id):
+    """Yield a dict per book in the user's collection, ordered by title, reading EXPORT_BATCH rows at a time."""
+
+    tags = db.session.query(array_agg(aggregate_order_by(Tag.name, Tag.name)))\
+        .join(UserBookTag)\
+        .filter(UserBookTag.user_id == user_id, UserBookTag.book_id == Book.id)\
+        .scalar_subquery()
+
+    rows = db.session.query(
+        Book.isbn,
+        Book.title,
+        names(Author, BookAuthor, BookAuthor.author_id),
+        names(Publisher, BookPublisher, BookPublisher.publisher_id),
+        names(Subject, BookSubject, BookSubject.subject_id),
+        tags
+    ).join(UserBook, UserBook.book_id == Book.id)\
+        .filter(UserBook.user_id == user_id)\
+        .order_by(Book.title, Book.id)\
+        .yield_per(EXPORT_BATCH)
+
+    for isbn, title, authors, publishers, subjects, book_tags in rows:
+        yield {
+            'isbn': isbn,
+            'title': title,
+            'authors': authors or [],
+            'publishers': publishers or [],
+            'subjects': subjects or [],
+            'tags': book_tags or []
+        }
+
+
+def batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == EXPORT_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in batches(rows):
+        for row in batch:
+            writer.writerow([CSV_LIST_SEPARATOR.join(value) if isinstance(value, list) else value
+                             for value in (row[column] for column in EXPORT_COLUMNS)])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def jsonl_chunks(rows):
+    for batch in batches(rows):
+        yield ''.join(json.dumps(row) + '\n' for row in batch).encode()
+
+
+def gzipped(chunks):
+    """Compress the chunks into one gzip stream."""
+
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+FORMATS = {
+    'csv': ('text/csv', csv_chunks),
+    'jsonl': ('application/x-ndjson', jsonl_chunks),
+}
+
+
+@export.route('/users/<int:user_id>/export.<any(csv, jsonl):file_format>')
+def export_library(user_id, file_format):
+    """Download the user's books with their authors, publishers, subjects and tags."""
+
+    if not g.user:
+        flash("You are not authorized.", "danger")
+        return redirect('/')
+
+    if g.user.id != user_id:
+        flash('You are not authorized.', 'danger')
+        return redirect('/')
+
+    mimetype, chunks = FORMATS[file_format]
+    body = chunks(library_rows(user_id))
+    headers = {
+        'Content-Disposition': f'attachment; filename=library.{file_format}',
+        'Vary': 'Accept-Encoding'
+    }
+    # the quality, 0 when gzip is refused with q=0 or not listed at all
+    if request.accept_encodings['gzip'] > 0:
+        body = gzipped(body)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
@@ -0,0 +1,104 @@
+"""
+Cached rendering of the book cards on the library pages.
+
+A card is cached under (user_id, book_id, book_version, user_tag_version). Book.version and UserBook.tag_version are
+bumped by anything that changes what the card shows, so a changed card gets a new key and its stale entry ages out of
+the LRU. A book added to a collection again starts from the user's library version rather than 0, so it doesn't get
+the keys of its cards from before it was removed. Only the affected cards are re-rendered.
+
+Cards are built from BookCard rows holding only the columns a card shows, with the medium cover url projected out of
+the images json in SQL, so a page of thousands of books never loads whole Book rows.
+"""
+from flask import current_app, render_template
+from markupsafe import Markup
+from sqlalchemy import and_
+from sqlalchemy.orm import Query
+from api import cover_url
+from cache import create_cache
+from models import db, Book, Author, BookAuthor, Tag, UserBook, UserBookTag
+
+
+def init_fragment_cache(app):
+    """Create the fragment cache configured for the app."""
+
+    app.extensions['fragment_cache'] = create_cache(
+        app.config['FRAGMENT_CACHE_BACKEND'],
+        app.config['FRAGMENT_CACHE_SIZE'],
+        app.config.get('FRAGMENT_CACHE_PATH')
+    )
+
+
+def get_fragment_cache():
+    return current_app.extensions['fragment_cache']
+
+
+def book_card_key(user_id, book_id, book_version, tag_version):
+    return f'book-card:{user_id}:{book_id}:{book_version}:{tag_version}'
+
+
+class BookCard:
+    """The columns of a book that its card shows, selected instead of loading whole Book rows."""
+
+    __slots__ = ('id', 'title', 'version', 'cover_url', 'tag_version')
+
+    def __init__(self, id, title, version, cover_url, tag_version):
+        self.id = id
+        self.title = title
+        self.version = version
+        self.cover_url = cover_url
+        self.tag_version = tag_version
+
+
+def load_book_cards(user_id, book_ids):
+    """BookCards, sorted by title, for the books in the user's collection in `book_ids`, a list or a query of ids."""
+
+    if isinstance(book_ids, Query):
+        book_ids = book_ids.subquery().select()
+    return [BookCard(*row) for row in db.session.query(Book.id, Book.title, Book.version, cover_url('medium'),
+                                                       UserBook.tag_version)
+            .join(UserBook, and_(UserBook.book_id == Book.id, UserBook.user_id == user_id))
+            .filter(Book.id.in_(book_ids))
+            .order_by(Book.title, Book.id)]
+
+
+def render_book_cards(user_id, book_ids):
+    """
+    Return the card markup for each book in `book_ids`, a list or a query of ids of books in the user's collection,
+    sorted by title. Costs one query for the cards' columns, plus one each for the tags and author names on the cards
+    that have to be rendered.
+    """
+
+    books = load_book_cards(user_id, book_ids)
+    if not books:
+        return []
+
+    cache = get_fragment_cache()
+    keys = [book_card_key(user_id, book.id, book.version, book.tag_version) for book in books]
+    cards = cache.get_many(keys)
+
+    missing = [(key, book) for key, book in zip(keys, books) if key not in cards]
+    if missing:
+        missing_ids = [book.id for key, book in missing]
+        book_tags = {}
+        for book_id, tag_id, name in db.session.query(UserBookTag.book_id, Tag.id, Tag.name)\
+                .join(Tag)\
+                .filter(UserBookTag.user_id == user_id, UserBookTag.book_id.in_(missing_ids))\
+                .order_by(Tag.name):
+            book_tags.setdefault(book_id, []).append({'id': tag_id, 'name': name})
+        # one query for every card's authors instead of a lazy load per card
+        book_authors = {}
+        for book_id, name in db.session.query(BookAuthor.book_id, Author.name)\
+                .join(Author)\
+                .filter(BookAuthor.book_id.in_(missing_ids))\
+                .order_by(BookAuthor.book_id, Author.id):
+            book_authors.setdefault(book_id, []).append(name)
+
+        rendered = {
+            key: render_template('book-card.html', user_id=user_id, book=book, tags=book_tags.get(book.id, []),
+                                 authors=book_authors.get(book.id, []))
+            for key, book in missing
+        }
+        cache.set_many(rendered)
+        cards.update(rendered)
+
+    return [Markup(cards[key]) for key in keys]
@@ -0,0 +1,37 @@
+"""
+Gunicorn settings, picked up automatically by `gunicorn app:app`.
+
+The default is gunicorn's sync workers: one request per process at a time.
+GUNICORN_WORKER_CLASS=gevent is the high concurrency mode. Each worker runs up to GUNICORN_WORKER_CONNECTIONS requests
+as greenlets, and a request waiting on Open Library (gevent patched sockets) or Postgres (psycogreen) yields to the
+others instead of holding the process. Size DB_POOL_SIZE/DB_MAX_OVERFLOW for the number of requests that should reach
+the database at once.
+"""
+import glob
+import multiprocessing
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+
+def on_starting(server):
+    # metrics files left by the previous run would be added to this one's
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        for name in glob.glob(os.path.join(os.environ['PROMETHEUS_MULTIPROC_DIR'], '*.db')):
+            os.remove(name)
+
+
+def child_exit(server, worker):
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 is a C extension that gevent can't patch, this makes it wait on the hub for query results
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,372 @@
+"""
+Bulk import of a Goodreads or LibraryThing export into a user's library.
+
+The uploaded file is read a row at a time into library_import_rows, then worked through IMPORT_BATCH rows per
+transaction: isbns already in the books table are used as they are, the rest are fetched from Open Library in one call
+per batch, and shelves become the user's tags with set based inserts. Every batch commits together with the rows it
+finished, so an import that fails partway, or whose worker goes away, carries on from the first unfinished row when it
+is resumed.
+"""
+import codecs
+import csv
+import datetime
+import logging
+import re
+import threading
+
+from flask import Blueprint, current_app, flash, g, redirect, render_template, request
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
+
+from invalidation import pending
+from models import db, User, Book, UserBook, UserBookTag, LibraryImport, LibraryImportRow
+from similar import queue_refresh
+from tags import tag_ids_for, add_user_tags
+from user_cache import user_key
+from utils import get_setting, lookup_isbns_open_library, map_book_data, unique
+
+logger = logging.getLogger(__name__)
+
+imports = Blueprint('imports', __name__)
+
+# rows per transaction, and isbns per Open Library call
+IMPORT_BATCH = 50
+# rows per insert while reading the file
+STAGE_BATCH = 1000
+
+
+class ImportFileError(ValueError):
+    """The upload isn't a Goodreads or LibraryThing export."""
+
+
+def clean_isbn(value):
+    """'="0439023483"' (Goodreads), '[0439023483]' (LibraryThing) or '978-0-439-02348-1' to the bare isbn."""
+
+    isbn = re.sub(r'[^0-9X]', '', (value or '').upper())
+    return isbn if len(isbn) in (10, 13) else None
+
+
+def split_names(value):
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+
+def goodreads_book(row):
+    isbns = unique([clean_isbn(row.get('ISBN13')), clean_isbn(row.get('ISBN'))])
+    shelves = unique([row.get('Exclusive Shelf')] + split_names(row.get('Bookshelves')))
+    return isbns, shelves
+
+
+def librarything_book(row):
+    isbns = unique([clean_isbn(row.get('ISBN'))] + [clean_isbn(isbn) for isbn in (row.get('ISBNs') or '').split(',')])
+    return isbns, unique(split_names(row.get('Tags')))
+
+
+# source -> (a column only its exports have, what to make of a row)
+SOURCES = {
+    'goodreads': ('Exclusive Shelf', goodreads_book),
+    'librarything': ('Primary Author', librarything_book),
+}
+
+
+def parse_export(lines):
+    """
+    Return the source of an export and an iterator of (isbns, shelves) per book, reading `lines` as it goes.
+    Takes Goodreads' CSV and LibraryThing's CSV or tab separated export.
+    """
+
+    lines = iter(lines)
+    header_line = next(lines, '')
+    delimiter = '\t' if '\t' in header_line else ','
+    header = [column.strip() for column in next(csv.reader([header_line], delimiter=delimiter), [])]
+
+    for source, (column, read_book) in SOURCES.items():
+        if column in header:
+            rows = csv.DictReader(lines, fieldnames=header, delimiter=delimiter)
+            return source, (read_book(row) for row in rows)
+
+    raise ImportFileError('That is not a Goodreads or LibraryThing export.')
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stage_import(user_id, lines, filename=None):
+    """Read an export into a new import and its rows, STAGE_BATCH rows per insert. Returns the committed import."""
+
+    source, books = parse_export(lines)
+    library_import = LibraryImport(user_id=user_id, source=source, filename=filename)
+    db.session.add(library_import)
+    db.session.flush()
+
+    total = no_isbn = 0
+    try:
+        for batch in batches(enumerate(books, 1), STAGE_BATCH):
+            db.session.execute(LibraryImportRow.__table__.insert(), [
+                {
+                    'import_id': library_import.id,
+                    'position': position,
+                    'isbns': isbns,
+                    'shelves': shelves,
+                    # nothing to look up
+                    'outcome': None if isbns else 'no_isbn'
+                }
+                for position, (isbns, shelves) in batch
+            ])
+            total += len(batch)
+            no_isbn += sum(1 for position, (isbns, shelves) in batch if not isbns)
+    except UnicodeDecodeError:
+        db.session.rollback()
+        raise ImportFileError('The file has to be UTF-8 text.')
+
+    library_import.total = total
+    # rows without an isbn are finished before they start
+    library_import.done = no_isbn
+    db.session.commit()
+    return library_import
+
+
+def fetch_books(isbns):
+    """Add the books Open Library knows of to the books table with one call. Returns {isbn: book id} for those."""
+
+    data = lookup_isbns_open_library(isbns)
+    books = []
+    for isbn in isbns:
+        if f'ISBN:{isbn}' in data:
+            book = map_book_data(data[f'ISBN:{isbn}'], isbn)
+            db.session.add(book)
+            books.append(book)
+    db.session.flush()
+    return {book.isbn: book.id for book in books}
+
+
+def add_to_library(user_id, shelves_by_book):
+    """Add the books, {book id: shelf names}, to the user's library with their shelves as tags. Set based throughout."""
+
+    if not shelves_by_book:
+        return
+
+    tag_version = UserBook.first_tag_version(user_id)
+    db.session.execute(insert(UserBook.__table__)
+                       .values([{'user_id': user_id, 'book_id': book_id, 'tag_version': tag_version}
+                                for book_id in shelves_by_book])
+                       .on_conflict_do_nothing())
+
+    tag_ids = tag_ids_for(name for shelves in shelves_by_book.values() for name in shelves)
+    if tag_ids:
+        add_user_tags(user_id, list(tag_ids.values()))
+        db.session.execute(insert(UserBookTag.__table__)
+                           .values([{'user_id': user_id, 'book_id': book_id, 'tag_id': tag_ids[name]}
+                                    for book_id, shelves in shelves_by_book.items() for name in shelves])
+                           .on_conflict_do_nothing())
+        UserBook.bump_tag_version(user_id, [book_id for book_id, shelves in shelves_by_book.items() if shelves])
+
+    db.session.query(User)\
+        .filter(User.id == user_id)\
+        .update({User.library_version: User.library_version + 1}, synchronize_session=False)
+    # the flush doesn't see a bulk update, the trigger on users tells the other workers
+    pending(user_key(user_id))
+
+
+def import_batch(library_import, rows):
+    """
+    Resolve a batch of rows to books and add them to the library. The caller commits. Returns how many books were new
+    to the books table.
+    """
+
+    isbns = {isbn for row in rows for isbn in row.isbns}
+    book_ids = dict(db.session.query(Book.isbn, Book.id).filter(Book.isbn.in_(isbns)))
+    missing = unique(row.isbns[0] for row in rows if not any(isbn in book_ids for isbn in row.isbns))
+    fetched = fetch_books(missing) if missing else {}
+    book_ids.update(fetched)
+
+    shelves_by_book = {}
+    for row in rows:
+        row.book_id = next((book_ids[isbn] for isbn in row.isbns if isbn in book_ids), None)
+        if row.book_id:
+            row.outcome = 'imported'
+            library_import.imported += 1
+            shelves_by_book.setdefault(row.book_id, set()).update(row.shelves)
+        else:
+            row.outcome = 'not_found'
+            library_import.not_found += 1
+
+    add_to_library(library_import.user_id, shelves_by_book)
+    library_import.done += len(rows)
+    library_import.updated = datetime.datetime.utcnow()
+    return len(fetched)
+
+
+def claim_import(import_id):
+    """Mark the import running unless it's done or a live worker has it. Returns whether the caller got it."""
+
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=get_setting('IMPORT_STALE_SECONDS'))
+    claimed = db.session.query(LibraryImport)\
+        .filter(LibraryImport.id == import_id,
+                LibraryImport.status != 'done',
+                or_(LibraryImport.status != 'running', LibraryImport.updated < stale))\
+        .update({LibraryImport.status: 'running', LibraryImport.error: None,
+                 LibraryImport.updated: datetime.datetime.utcnow()},
+                synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+
+def run_import(import_id, progress=None):
+    """
+    Work through the import's unfinished rows, committing after every batch. `progress` is called with the number of
+    rows each batch finished. Returns whether the import is done, a failure is saved on the import for resuming.
+    The books it added to the books table, finished or not, queue a refresh of the similar books.
+    """
+
+    if not claim_import(import_id):
+        return False
+
+    added = 0
+    try:
+        while True:
+            rows = LibraryImportRow.query\
+                .filter_by(import_id=import_id, outcome=None)\
+                .order_by(LibraryImportRow.position)\
+                .limit(IMPORT_BATCH)\
+                .all()
+            if not rows:
+                break
+            added += import_batch(LibraryImport.query.get(import_id), rows)
+            db.session.commit()
+            if progress:
+                progress(len(rows))
+    except Exception as error:
+        logger.exception('import %s failed', import_id)
+        db.session.rollback()
+        db.session.query(LibraryImport)\
+            .filter(LibraryImport.id == import_id)\
+            .update({LibraryImport.status: 'failed', LibraryImport.error: str(error) or type(error).__name__},
+                    synchronize_session=False)
+        db.session.commit()
+        if added:
+            queue_refresh()
+        return False
+
+    db.session.query(LibraryImport)\
+        .filter(LibraryImport.id == import_id)\
+        .update({LibraryImport.status: 'done', LibraryImport.updated: datetime.datetime.utcnow()},
+                synchronize_session=False)
+    db.session.commit()
+    if added:
+        queue_refresh()
+    return True
+
+
+def start_import(import_id):
+    """Run the import on a thread of its own, or right here when IMPORT_IN_BACKGROUND is off."""
+
+    app = current_app._get_current_object()
+    if not app.config['IMPORT_IN_BACKGROUND']:
+        run_import(import_id)
+        return
+
+    def work():
+        with app.app_context():
+            try:
+                run_import(import_id)
+            finally:
+                db.session.remove()
+
+    threading.Thread(target=work, name=f'import-{import_id}', daemon=True).start()
+
+
+def resumable(library_import):
+    """Failed imports, and ones whose worker went away before or while running them, can be picked up again."""
+
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=current_app.config['IMPORT_STALE_SECONDS'])
+    return library_import.status == 'failed' \
+        or (library_import.status in ('pending', 'running') and library_import.updated < stale)
+
+
+@imports.route('/users/<int:user_id>/imports', methods=['GET', 'POST'])
+def user_imports(user_id):
+    """
+    GET: Show the upload form and the user's imports.
+    POST: Read an uploaded export and start importing it.
+    """
+
+    if not g.user:
+        flash("You are not authorized.", "danger")
+        return redirect('/')
+
+    if g.user.id != user_id:
+        flash('You are not authorized.', 'danger')
+        return redirect('/')
+
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Choose a file to import.', 'danger')
+            return redirect(f'/users/{user_id}/imports')
+        try:
+            library_import = stage_import(user_id, codecs.iterdecode(upload.stream, 'utf-8-sig'), upload.filename)
+        except ImportFileError as error:
+            flash(str(error), 'danger')
+            return redirect(f'/users/{user_id}/imports')
+
+        start_import(library_import.id)
+        return redirect(f'/users/{user_id}/imports/{library_import.id}')
+
+    library_imports = LibraryImport.query\
+        .filter_by(user_id=user_id)\
+        .order_by(LibraryImport.created.desc())\
+        .all()
+
+    return render_template('user-imports.html', user=g.user, library_imports=library_imports)
+
+
+@imports.route('/users/<int:user_id>/imports/<int:import_id>')
+def user_import(user_id, import_id):
+    """Show an import's progress."""
+
+    if not g.user:
+        flash("You are not authorized.", "danger")
+        return redirect('/')
+
+    if g.user.id != user_id:
+        flash('You are not authorized.', 'danger')
+        return redirect('/')
+
+    library_import = LibraryImport.query.filter_by(id=import_id, user_id=user_id).first()
+    if not library_import:
+        flash('Import not found!', 'danger')
+        return redirect(f'/users/{user_id}/imports')
+
+    return render_template('user-import.html', user=g.user, library_import=library_import,
+                           resumable=resumable(library_import))
+
+
+@imports.route('/users/<int:user_id>/imports/<int:import_id>/resume', methods=['POST'])
+def resume_user_import(user_id, import_id):
+    """Carry on with a failed or abandoned import from its first unfinished row."""
+
+    if not g.user:
+        flash("You are not authorized.", "danger")
+        return redirect('/')
+
+    if g.user.id != user_id:
+        flash('You are not authorized.', 'danger')
+        return redirect('/')
+
+    library_import = LibraryImport.query.filter_by(id=import_id, user_id=user_id).first()
+    if not library_import:
+        flash('Import not found!', 'danger')
+        return redirect(f'/users/{user_id}/imports')
+
+    if resumable(library_import):
+        start_import(import_id)
+
+    return redirect(f'/users/{user_id}/imports/{import_id}')
@@ -0,0 +1,192 @@
+"""
+Tell every worker when something it keeps in memory changed in the database.
+
+Messages are Postgres notifications on CHANNEL, which go out when the transaction that sent them commits and not at all
+when it rolls back. publish(key) sends one from the session's transaction, and the users table has a trigger sending
+one for every row changed, by any statement (see migrations). Each worker listens on a connection of its own, on a
+thread, and hands the keys to the caches subscribed to their kind: 'user:42' goes to the subscribers of 'user'. Keys
+marked `pending` in a worker's session also reach its own subscribers right after the commit, without the round trip.
+
+A listener that loses its connection can't know what it missed, so every subscribed cache is cleared each time it starts
+listening. Subscribers also drop entries older than INVALIDATION_TTL seconds, which bounds how stale an entry gets when
+a message is lost without the listener noticing.
+"""
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import defaultdict
+from functools import partial
+
+from flask import current_app
+from prometheus_client import Counter, Histogram
+from sqlalchemy import event, func
+
+from models import db
+
+CHANNEL = 'invalidations'
+# how often a quiet listener checks whether it was stopped, and how long it waits to connect again after an error
+POLL_SECONDS = 1
+RETRY_SECONDS = 5
+
+INVALIDATIONS_SENT = Counter('invalidations_sent', 'Invalidations published by this process and committed', ['kind'])
+INVALIDATIONS_RECEIVED = Counter('invalidations_received', "Invalidations handed to this worker's subscribers",
+                                 ['kind', 'source'])
+INVALIDATION_DELIVERY_SECONDS = Histogram('invalidation_delivery_seconds',
+                                          'Time from sending an invalidation to its arrival at a listening worker',
+                                          buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+INVALIDATION_RESETS = Counter('invalidation_resets',
+                              'Subscribed caches cleared on (re)connecting, as messages may have been missed meanwhile')
+
+logger = logging.getLogger(__name__)
+
+
+def kind_of(key):
+    return key.partition(':')[0]
+
+
+def pending(key, session=None):
+    """Hand `key` to this worker's subscribers once the session's transaction commits."""
+
+    (session or db.session).info.setdefault('invalidations', set()).add(key)
+
+
+def publish(key):
+    """Send `key` to every worker once the session's transaction commits."""
+
+    session = db.session()
+    published = session.info.setdefault('published_invalidations', set())
+    if key not in published:
+        session.execute(db.select([func.pg_notify(CHANNEL, json.dumps({'key': key, 'sent': time.time()}))]))
+        published.add(key)
+    pending(key, session)
+
+
+def after_commit(session):
+    for key in session.info.pop('published_invalidations', ()):
+        INVALIDATIONS_SENT.labels(kind_of(key)).inc()
+    keys = session.info.pop('invalidations', None)
+    if keys:
+        # the app bound to the session outside a request, as in scripts and tests
+        bus = db.get_app().extensions.get('invalidation')
+        if bus is not None:
+            bus.deliver(keys, 'local')
+
+
+def after_rollback(session):
+    session.info.pop('published_invalidations', None)
+    session.info.pop('invalidations', None)
+
+
+class InvalidationBus:
+    """The subscribed caches of this worker, and the thread listening for other workers' invalidations."""
+
+    def __init__(self):
+        self._subscribers = defaultdict(list)
+        self._thread = None
+        self._pid = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def subscribe(self, kind, subscriber):
+        """Send the keys of `kind` to `subscriber.invalidate(name)`, and call `subscriber.clear()` on a reset."""
+
+        self._subscribers[kind].append(subscriber)
+
+    def deliver(self, keys, source):
+        for key in keys:
+            kind, _, name = key.partition(':')
+            INVALIDATIONS_RECEIVED.labels(kind, source).inc()
+            for subscriber in self._subscribers.get(kind, ()):
+                subscriber.invalidate(name)
+
+    def reset(self):
+        """Clear every subscribed cache."""
+
+        INVALIDATION_RESETS.inc()
+        for subscribers in self._subscribers.values():
+            for subscriber in subscribers:
+                subscriber.clear()
+
+    def receive(self, payload):
+        """Deliver one notification."""
+
+        try:
+            message = json.loads(payload)
+            key, sent = message['key'], float(message['sent'])
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Ignored a malformed invalidation: %r', payload)
+            return
+        INVALIDATION_DELIVERY_SECONDS.observe(max(time.time() - sent, 0))
+        self.deliver([key], 'notify')
+
+    def start(self, connect):
+        """
+        Listen on a daemon thread, with a DB-API connection from `connect()`. Does nothing when this process already
+        listens, and starts again in a process forked from one that did, as threads don't survive a fork.
+        """
+
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.listen, args=(connect,), name='invalidations', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def listen(self, connect):
+        """Deliver notifications until stopped, connecting again after errors."""
+
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {CHANNEL}')
+                # whatever was sent while nothing listened is lost
+                self.reset()
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], POLL_SECONDS)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self.receive(conn.notifies.pop(0).payload)
+            except Exception:
+                logger.exception('Invalidation listener lost its connection, retrying in %s seconds', RETRY_SECONDS)
+                self._stopped.wait(RETRY_SECONDS)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+def connect_to(engine):
+    """A new connection to the engine's database, outside its pool: the listener holds it as long as the worker runs."""
+
+    cargs, cparams = engine.dialect.create_connect_args(engine.url)
+    return engine.dialect.dbapi.connect(*cargs, **cparams)
+
+
+def init_invalidation(app):
+    """Create the app's bus and, with INVALIDATION_LISTEN, listen from the first request each worker serves."""
+
+    bus = app.extensions['invalidation'] = InvalidationBus()
+    # the session is shared by every app, so are its listeners
+    if not event.contains(db.session, 'after_commit', after_commit):
+        event.listen(db.session, 'after_commit', after_commit)
+        event.listen(db.session, 'after_rollback', after_rollback)
+
+    if app.config['INVALIDATION_LISTEN']:
+        @app.before_request
+        def start_listening():
+            bus.start(partial(connect_to, db.get_engine()))
+
+
+def get_invalidation_bus():
+    return current_app.extensions['invalidation']
@@ -0,0 +1,15 @@
+"""Clearing the tables a test builds on, only where the test database fixture doesn't already start it from nothing."""
+# set by conftest while a test runs in a transaction that is rolled back at its end
+rolled_back = False
+
+
+def clean_tables(*models):
+    """
+    Delete every row of the models, in the order given. Tests rolled back at the end start from the tables conftest
+    emptied for the session, so this deletes nothing for them and only the --shared-db runs pay for it.
+    """
+
+    if rolled_back:
+        return
+    for model in models:
+        model.query.delete()
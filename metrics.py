@@ -0,0 +1,128 @@
+"""
+Per request timing, SQL and Open Library metrics, served to Prometheus from /metrics.
+
+Recording a request costs a few perf_counter calls and dictionary updates. The text format is only produced when
+/metrics is scraped. Under gunicorn set PROMETHEUS_MULTIPROC_DIR to an empty directory so that every worker's numbers
+are added up on a scrape, whichever worker answers it.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, abort, current_app, g, has_request_context, request
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+REQUEST_SECONDS = Histogram('request_seconds', 'Wall time of a request', ['endpoint'])
+REQUEST_SQL_STATEMENTS = Histogram('request_sql_statements', 'SQL statements run by a request', ['endpoint'],
+                                   buckets=COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('request_db_seconds', 'Time a request spent waiting on SQL statements', ['endpoint'])
+REQUEST_OPEN_LIBRARY_CALLS = Histogram('request_open_library_calls', 'Open Library calls made by a request',
+                                       ['endpoint'], buckets=COUNT_BUCKETS)
+REQUESTS = Counter('requests', 'Requests by endpoint and status code', ['endpoint', 'status'])
+OPEN_LIBRARY_SECONDS = Histogram('open_library_seconds', 'Latency of Open Library calls', ['endpoint', 'outcome'])
+
+metrics = Blueprint('metrics', __name__)
+
+
+class RequestMetrics:
+    """What the current request has done so far, kept on g."""
+
+    __slots__ = ('started', 'sql_statements', 'db_seconds', 'open_library_calls', 'status')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_statements = 0
+        self.db_seconds = 0.0
+        self.open_library_calls = 0
+        self.status = None
+
+
+def current_metrics():
+    """The metrics of the request being handled, or None outside of a request or with metrics turned off."""
+
+    return g.get('request_metrics') if has_request_context() else None
+
+
+def init_metrics(app):
+    """Record every request of the app. Call before registering blueprints so their before_request queries count."""
+
+    if not app.config['METRICS_ENABLED']:
+        return
+    app.before_request(start_request)
+    app.after_request(record_status)
+    app.teardown_request(finish_request)
+    app.register_blueprint(metrics)
+
+
+def start_request():
+    g.request_metrics = RequestMetrics()
+
+
+def record_status(response):
+    request_metrics = current_metrics()
+    if request_metrics:
+        request_metrics.status = response.status_code
+    return response
+
+
+def finish_request(exc):
+    request_metrics = g.pop('request_metrics', None)
+    if request_metrics is None or request.endpoint == 'metrics.show_metrics':
+        return
+    endpoint = request.endpoint or 'none'
+    REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - request_metrics.started)
+    REQUEST_SQL_STATEMENTS.labels(endpoint).observe(request_metrics.sql_statements)
+    REQUEST_DB_SECONDS.labels(endpoint).observe(request_metrics.db_seconds)
+    REQUEST_OPEN_LIBRARY_CALLS.labels(endpoint).observe(request_metrics.open_library_calls)
+    REQUESTS.labels(endpoint, 500 if exc else request_metrics.status).inc()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info['statement_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement, parameters, context, executemany):
+    request_metrics = current_metrics()
+    if request_metrics:
+        request_metrics.sql_statements += 1
+        request_metrics.db_seconds += time.perf_counter() - conn.info.pop('statement_started')
+
+
+@contextmanager
+def open_library_call():
+    """Time an Open Library call, counting it against the current request. Calls that raise are recorded as errors."""
+
+    request_metrics = current_metrics()
+    endpoint = (request.endpoint or 'none') if request_metrics else 'none'
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        OPEN_LIBRARY_SECONDS.labels(endpoint, outcome).observe(time.perf_counter() - started)
+        if request_metrics:
+            request_metrics.open_library_calls += 1
+
+
+@metrics.route('/metrics')
+def show_metrics():
+    """Metrics in the Prometheus text format. With METRICS_TOKEN set, scrapers must send it as a bearer token."""
+
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
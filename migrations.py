@@ -0,0 +1,46 @@
+"""
+Schema changes for databases that were created before a column or index existed.
+db.create_all only creates missing tables, so every statement here has to be safe to run again.
+"""
+from invalidation import CHANNEL
+from models import db
+
+MIGRATIONS = [
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS library_version INTEGER NOT NULL DEFAULT 0',
+    'ALTER TABLE books ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0',
+    'ALTER TABLE users_books ADD COLUMN IF NOT EXISTS tag_version INTEGER NOT NULL DEFAULT 0',
+    'CREATE INDEX IF NOT EXISTS ix_users_books_tags_user_tag ON users_books_tags (user_id, tag_id)',
+    'CREATE INDEX IF NOT EXISTS ix_users_books_book_id ON users_books (book_id)',
+] + [
+    # filled in for existing rows by `flask merge-vocabulary`
+    statement
+    for table in ('authors', 'publishers', 'subjects', 'subject_places', 'subject_people', 'subject_times')
+    for statement in (f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS name_key TEXT',
+                      f'CREATE INDEX IF NOT EXISTS ix_{table}_name_key ON {table} (name_key)',
+                      # keys from before `+` and `#` were kept, or blank, are computed again
+                      f"UPDATE {table} SET name_key = NULL WHERE name_key = '' "
+                      "OR (name ~ '[+#]' AND name_key !~ '[+#]')")
+] + [
+    # every worker drops its cached copy of a user whose row changed, whatever statement changed it
+    "CREATE OR REPLACE FUNCTION notify_user_changed() RETURNS trigger AS $$ BEGIN "
+    f"PERFORM pg_notify('{CHANNEL}', json_build_object('key', 'user:' || OLD.id, "
+    "'sent', extract(epoch FROM clock_timestamp()))::text); "
+    "RETURN NULL; END $$ LANGUAGE plpgsql",
+    'DROP TRIGGER IF EXISTS users_changed ON users',
+    'CREATE TRIGGER users_changed AFTER UPDATE OR DELETE ON users FOR EACH ROW EXECUTE FUNCTION notify_user_changed()',
+]
+
+
+def upgrade_schema():
+    """Apply every migration in order."""
+
+    for statement in MIGRATIONS:
+        db.session.execute(statement)
+    db.session.commit()
+
+
+def create_schema():
+    """Create any missing tables and bring existing ones up to date."""
+
+    db.create_all()
+    upgrade_schema()
@@ -1,8 +1,9 @@
 import datetime
+import re
+import unicodedata
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+from passwords import passwords
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
@@ -16,6 +17,30 @@ def connect_db(app):
     db.init_app(app)
 
 
+def normalize_name(name, person=False):
+    """
+    The key that names differing only in case, accents, punctuation and spacing share. With `person`, a single comma
+    is read as 'Last, First', so 'Tolkien, J.R.R.' and 'J. R. R. Tolkien' both become 'j r r tolkien'. `+` and `#`
+    are kept, so 'C++', 'C#' and 'C' stay apart, and a name that is all punctuation is its own key, case folded.
+    Only a blank name gives ''.
+    """
+
+    if person and name.count(',') == 1:
+        last, first = name.split(',')
+        name = f'{first} {last}'
+    decomposed = unicodedata.normalize('NFKD', name.casefold())
+    unaccented = ''.join(character for character in decomposed if not unicodedata.combining(character))
+    return ' '.join(re.sub(r'[^\w+#]+|_+', ' ', unaccented).split()) or ' '.join(name.casefold().split())
+
+
+def name_key_default(person=False):
+    """Column default filling name_key from the name being inserted."""
+
+    def default(context):
+        return normalize_name(context.get_current_parameters()['name'], person)
+    return default
+
+
 class User(db.Model):
     """Model that represents a user of the application."""
 
@@ -31,6 +56,11 @@ class User(db.Model):
                          unique=True)
     password = db.Column(db.Text,
                          nullable=False)
+    # bumped on every change to the user's books or tags, api etags are derived from it
+    library_version = db.Column(db.Integer,
+                                nullable=False,
+                                default=0,
+                                server_default='0')
 
     # relationships
     books = db.relationship('Book',
@@ -45,7 +75,7 @@ class User(db.Model):
     def signup(cls, username, password):
         """Sign up a user with a hashed password and return an instance of the user class"""
 
-        hashed = bcrypt.generate_password_hash(password).decode("utf8")
+        hashed = passwords.hash(password)
         user = User(
             username=username,
             password=hashed
@@ -56,14 +86,24 @@ class User(db.Model):
 
     @classmethod
     def authenticate(cls, username, password):
-        """Attempt to authenticate the user. Return an instance of the user class on success or false on failure"""
+        """
+        Attempt to authenticate the user. Return an instance of the user class on success or false on failure.
+        A password hashed with an outdated cost factor is rehashed, the caller commits the change.
+        """
         user = User.query.filter_by(username=username).first()
 
-        if user and bcrypt.check_password_hash(user.password, password):
+        if user and passwords.check(user.password, password):
+            if passwords.needs_rehash(user.password):
+                user.password = passwords.hash(password)
             return user
         else:
             return False
 
+    def bump_library_version(self):
+        """Record a change to the user's books or tags. The increment happens in the database when the session flushes."""
+
+        self.library_version = User.library_version + 1
+
 
 class Book(db.Model):
     """Model that represents a physical book."""
@@ -79,12 +119,18 @@ class Book(db.Model):
                      unique=True)
     open_library_id = db.Column(db.Text,
                                 nullable=False)
-    open_library_images = db.Column(db.JSON)
+    # only the detail pages show the covers, they undefer it and list views project one url out with api.cover_url
+    open_library_images = db.deferred(db.Column(db.JSON))
     open_library_url = db.Column(db.Text)
     number_of_pages = db.Column(db.Integer)
     publish_date = db.Column(db.Date)
     title = db.Column(db.Text,
                       nullable=False)
+    # bumped whenever anything shown on the book's card changes, part of the card's cache key
+    version = db.Column(db.Integer,
+                        nullable=False,
+                        default=0,
+                        server_default='0')
 
     # relationships
     authors = db.relationship('Author',
@@ -133,6 +179,10 @@ class Author(db.Model):
     name = db.Column(db.Text,
                      nullable=False,
                      unique=True)
+    # normalize_name(name), names that share it are the same person spelled differently
+    name_key = db.Column(db.Text,
+                         index=True,
+                         default=name_key_default(person=True))
 
 
 class BookAuthor(db.Model):
@@ -159,6 +209,10 @@ class Publisher(db.Model):
     name = db.Column(db.Text,
                      nullable=False,
                      unique=True)
+    # normalize_name(name), names that share it are the same thing spelled differently
+    name_key = db.Column(db.Text,
+                         index=True,
+                         default=name_key_default())
 
 
 class BookPublisher(db.Model):
@@ -185,6 +239,10 @@ class Subject(db.Model):
     name = db.Column(db.Text,
                      nullable=False,
                      unique=True)
+    # normalize_name(name), names that share it are the same thing spelled differently
+    name_key = db.Column(db.Text,
+                         index=True,
+                         default=name_key_default())
 
 
 class BookSubject(db.Model):
@@ -211,6 +269,10 @@ class SubjectPlace(db.Model):
     name = db.Column(db.Text,
                      nullable=False,
                      unique=True)
+    # normalize_name(name), names that share it are the same thing spelled differently
+    name_key = db.Column(db.Text,
+                         index=True,
+                         default=name_key_default())
 
 
 class BookSubjectPlace(db.Model):
@@ -237,6 +299,10 @@ class SubjectPerson(db.Model):
     name = db.Column(db.Text,
                      nullable=False,
                      unique=True)
+    # normalize_name(name), names that share it are the same person spelled differently
+    name_key = db.Column(db.Text,
+                         index=True,
+                         default=name_key_default(person=True))
 
 
 class BookSubjectPerson(db.Model):
@@ -263,6 +329,10 @@ class SubjectTime(db.Model):
     name = db.Column(db.Text,
                      nullable=False,
                      unique=True)
+    # normalize_name(name), names that share it are the same thing spelled differently
+    name_key = db.Column(db.Text,
+                         index=True,
+                         default=name_key_default())
 
 
 class BookSubjectTime(db.Model):
@@ -282,6 +352,8 @@ class UserBook(db.Model):
     """Relates users to books in a many to many relationship"""
 
     __tablename__ = 'users_books'
+    # the owners of a book, for the few statements that look books up across users
+    __table_args__ = (db.Index('ix_users_books_book_id', 'book_id'),)
 
     user_id = db.Column(db.Integer,
                         db.ForeignKey('users.id', ondelete="cascade"),
@@ -291,6 +363,29 @@ class UserBook(db.Model):
                         primary_key=True)
     created_date = db.Column(db.DateTime,
                              default=datetime.datetime.now())
+    # bumped whenever the user changes the tags on this book, part of the book card's cache key. New rows start from
+    # first_tag_version, so a book removed and added again doesn't reuse the keys of its old cards.
+    tag_version = db.Column(db.Integer,
+                            nullable=False,
+                            default=0,
+                            server_default='0')
+
+    @classmethod
+    def first_tag_version(cls, user_id):
+        """
+        The tag_version to insert a new row with: the user's library version, as a subquery. Every tag_version bump
+        comes with a library version bump, so it is past any version an earlier row for the same book reached.
+        """
+
+        return db.session.query(User.library_version).filter(User.id == user_id).scalar_subquery()
+
+    @classmethod
+    def bump_tag_version(cls, user_id, book_ids):
+        """Record a change to the user's tags on the given books. `book_ids` is a list of ids or a query of book ids."""
+
+        db.session.query(cls)\
+            .filter(cls.user_id == user_id, cls.book_id.in_(book_ids))\
+            .update({cls.tag_version: cls.tag_version + 1}, synchronize_session=False)
 
 
 class Tag(db.Model):
@@ -323,6 +418,8 @@ class UserBookTag(db.Model):
     """Relates a user, a tag and a book in a many to many relationship"""
 
     __tablename__ = 'users_books_tags'
+    # a tag's books for one user, for the tag page and for renaming and merging tags
+    __table_args__ = (db.Index('ix_users_books_tags_user_tag', 'user_id', 'tag_id'),)
 
     user_id = db.Column(db.Integer,
                         db.ForeignKey('users.id', ondelete="cascade"),
@@ -333,3 +430,142 @@ class UserBookTag(db.Model):
     tag_id = db.Column(db.Integer,
                        db.ForeignKey('tags.id'),
                        primary_key=True)
+
+
+class SlowQuery(db.Model):
+    """A statement that took longer than SLOW_QUERY_MS, with the plan captured for it afterwards."""
+
+    __tablename__ = 'slow_queries'
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+    created = db.Column(db.DateTime,
+                        nullable=False,
+                        default=datetime.datetime.utcnow)
+    duration_ms = db.Column(db.Float,
+                            nullable=False)
+    # the route that ran the statement, null outside of a request
+    endpoint = db.Column(db.Text)
+    statement = db.Column(db.Text,
+                          nullable=False)
+    parameters = db.Column(db.Text)
+    # null when the same statement was explained recently, or could not be explained
+    plan = db.Column(db.Text)
+
+
+class LibraryImport(db.Model):
+    """A Goodreads or LibraryThing export being added to a user's library, see imports.py."""
+
+    __tablename__ = 'library_imports'
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id', ondelete="cascade"),
+                        nullable=False)
+    # 'goodreads' or 'librarything'
+    source = db.Column(db.Text,
+                       nullable=False)
+    filename = db.Column(db.Text)
+    # 'pending' until a worker picks it up, then 'running', and 'done' or 'failed'
+    status = db.Column(db.Text,
+                       nullable=False,
+                       default='pending')
+    total = db.Column(db.Integer,
+                      nullable=False,
+                      default=0)
+    # rows finished so far: `imported` were added to the library, `not_found` had no known isbn, the rest no isbn
+    done = db.Column(db.Integer,
+                     nullable=False,
+                     default=0)
+    imported = db.Column(db.Integer,
+                         nullable=False,
+                         default=0)
+    not_found = db.Column(db.Integer,
+                          nullable=False,
+                          default=0)
+    error = db.Column(db.Text)
+    created = db.Column(db.DateTime,
+                        nullable=False,
+                        default=datetime.datetime.utcnow)
+    # touched after every batch, a running import that hasn't been touched in a while has lost its worker
+    updated = db.Column(db.DateTime,
+                        nullable=False,
+                        default=datetime.datetime.utcnow)
+
+
+class LibraryImportRow(db.Model):
+    """One book of an import, as read from the file."""
+
+    __tablename__ = 'library_import_rows'
+
+    import_id = db.Column(db.Integer,
+                          db.ForeignKey('library_imports.id', ondelete="cascade"),
+                          primary_key=True)
+    # the book's place in the file
+    position = db.Column(db.Integer,
+                         primary_key=True)
+    # the book's isbns, the one to look up on Open Library first
+    isbns = db.Column(db.ARRAY(db.Text),
+                      nullable=False)
+    shelves = db.Column(db.ARRAY(db.Text),
+                        nullable=False)
+    # null until a batch has been through the row, then 'imported', 'not_found' or 'no_isbn'
+    outcome = db.Column(db.Text)
+    book_id = db.Column(db.Integer,
+                        db.ForeignKey('books.id', ondelete="set null"))
+
+
+class SimilarBook(db.Model):
+    """One of a book's nearest neighbours by shared authors, publishers and subjects, see similar.py."""
+
+    __tablename__ = 'similar_books'
+    __table_args__ = (db.Index('ix_similar_books_book_score', 'book_id', db.text('score DESC')),)
+
+    book_id = db.Column(db.Integer,
+                        db.ForeignKey('books.id', ondelete="cascade"),
+                        primary_key=True)
+    similar_book_id = db.Column(db.Integer,
+                                db.ForeignKey('books.id', ondelete="cascade"),
+                                primary_key=True)
+    # cosine similarity of the two books' idf weighted features, in (0, 1]
+    score = db.Column(db.Float,
+                      nullable=False)
+
+
+class SimilarRefresh(db.Model):
+    """A run of the similar books job. Incremental runs pick up the books added after the last run's `last_book_id`."""
+
+    __tablename__ = 'similar_refreshes'
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+    created = db.Column(db.DateTime,
+                        nullable=False,
+                        default=datetime.datetime.utcnow)
+    full = db.Column(db.Boolean,
+                     nullable=False)
+    last_book_id = db.Column(db.Integer,
+                             nullable=False)
+    # books whose neighbour lists were rewritten
+    books = db.Column(db.Integer,
+                      nullable=False)
+    seconds = db.Column(db.Float,
+                        nullable=False)
+
+
+class RateLimit(db.Model):
+    """A token bucket every worker draws from, see rate_limit.py."""
+
+    __tablename__ = 'rate_limits'
+
+    name = db.Column(db.Text,
+                     primary_key=True)
+    # may go below zero, by the calls that reserved a turn and are waiting for it
+    tokens = db.Column(db.Float,
+                       nullable=False)
+    updated = db.Column(db.DateTime(timezone=True),
+                        nullable=False)
@@ -0,0 +1,99 @@
+"""
+Deleting tags from a tag list, or books, leaves tags, authors, publishers and subjects that nothing links to any more.
+`flask collect-orphans` deletes them, walking each table in id order SCAN_BATCH ids at a time with an anti-join against
+every table that links to it, and committing each batch so no lock is held for long. Each table gets a share of the
+time budget and reports how far it got. `--dry-run` counts the same rows without deleting them.
+
+Rows deleted are counted on /metrics. Run from cron with PROMETHEUS_MULTIPROC_DIR set to the workers' directory and
+the counts are scraped with theirs.
+"""
+import time
+from collections import namedtuple
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import and_, exists, select
+from sqlalchemy.exc import IntegrityError
+
+from api import BOOK_VOCABULARIES
+from models import db, Tag, UserTag, UserBookTag
+
+# ids looked at per statement and per transaction
+SCAN_BATCH = 5000
+
+ORPHANS_DELETED = Counter('orphans_deleted', 'Vocabulary and tag rows nothing linked to, deleted', ['table'])
+ORPHAN_BATCHES_SKIPPED = Counter('orphan_batches_skipped', 'Batches rolled back because a row gained a link meanwhile',
+                                 ['table'])
+ORPHAN_COLLECTION_SECONDS = Histogram('orphan_collection_seconds', 'Wall time of an orphan collection run')
+
+# a table whose rows can be orphaned, with the link table columns that point at it
+OrphanTable = namedtuple('OrphanTable', ['model', 'references'])
+# what a run did to one table: rows found without links, deleted, ids scanned, and whether it got to the end
+OrphanReport = namedtuple('OrphanReport', ['found', 'deleted', 'scanned', 'complete'])
+
+ORPHAN_TABLES = [OrphanTable(Tag, [UserTag.tag_id, UserBookTag.tag_id])] + [
+    OrphanTable(model, [link_column]) for key, model, link, link_column in BOOK_VOCABULARIES
+]
+
+
+def unreferenced(table, low, high):
+    """Where clause for the rows of `table` with low < id <= high that no link points at."""
+
+    model = table.model
+    return and_(model.id > low, model.id <= high,
+                *[~exists().where(column == model.id) for column in table.references])
+
+
+def next_batch(model, low):
+    """(the id SCAN_BATCH rows past `low`, the number of rows up to it). The id is None at the end of the table."""
+
+    ids = select(model.id).where(model.id > low).order_by(model.id).limit(SCAN_BATCH).subquery()
+    return db.session.query(db.func.max(ids.c.id), db.func.count(ids.c.id)).one()
+
+
+def collect_table(table, deadline, dry_run=False):
+    """Delete, or with `dry_run` count, the orphans of one table until it's done or the deadline passes."""
+
+    model = table.model
+    found = deleted = scanned = 0
+    low = 0
+    while time.monotonic() < deadline:
+        high, rows = next_batch(model, low)
+        if high is None:
+            return OrphanReport(found, deleted, scanned, True)
+        scanned += rows
+
+        if dry_run:
+            found += db.session.query(db.func.count(model.id)).filter(unreferenced(table, low, high)).scalar()
+        else:
+            try:
+                batch = db.session.execute(model.__table__.delete().where(unreferenced(table, low, high))).rowcount
+                db.session.commit()
+            except IntegrityError:
+                # a link to one of the rows was committed after the statement started, it's no orphan after all
+                db.session.rollback()
+                ORPHAN_BATCHES_SKIPPED.labels(model.__tablename__).inc()
+            else:
+                found += batch
+                deleted += batch
+                ORPHANS_DELETED.labels(model.__tablename__).inc(batch)
+        low = high
+    return OrphanReport(found, deleted, scanned, False)
+
+
+def collect_orphans(budget_seconds=60, dry_run=False):
+    """
+    Delete the orphaned rows of every table in ORPHAN_TABLES, or with `dry_run` only count them, for up to
+    `budget_seconds`, shared between the tables. Returns {table: OrphanReport}.
+    """
+
+    started = time.monotonic()
+    deadline = started + budget_seconds
+    reports = {}
+    for n, table in enumerate(ORPHAN_TABLES):
+        # an equal share of what's left, so a large first table doesn't starve the rest
+        now = time.monotonic()
+        share = (deadline - now) / (len(ORPHAN_TABLES) - n)
+        reports[table.model.__tablename__] = collect_table(table, now + share, dry_run)
+    db.session.rollback()
+    ORPHAN_COLLECTION_SECONDS.observe(time.monotonic() - started)
+    return reports
@@ -0,0 +1,176 @@
+"""
+Optional hash partitioning of the tables that hold rows per user, on user_id: users_books, users_tags and
+users_books_tags. Each partition is vacuumed and indexed on its own, and the page queries name one user, so Postgres
+prunes the rest from the plan. Statements that look across users read every partition: finding a merged book's owners
+in `flask merge-vocabulary` (one probe of ix_users_books_book_id per partition), and the tag anti-joins of
+`flask collect-orphans`. Both are background jobs. `python -m benchmarks.partitions` times each kind before and after.
+`flask partition-tables` converts the tables while the app runs, one table at a time:
+
+1. create `<table>_partitioned` with the same columns, keys and indexes, and a trigger on `<table>` repeating every
+   write there,
+2. copy the rows over COPY_BATCH users at a time, committing each batch,
+3. swap the names in one short transaction, and keep the old table as `<table>_unpartitioned` to be dropped by hand.
+
+Copying locks the rows it reads, so a concurrent update or delete waits for the batch and then reaches the copy through
+the trigger. An interrupted run starts the copy over, which skips the rows already there.
+"""
+import re
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from models import db, User
+
+PARTITIONED_TABLES = ['users_books', 'users_tags', 'users_books_tags']
+# users whose rows are copied per statement and per transaction
+COPY_BATCH = 500
+# how long the swap waits for the app's transactions on the table, and how often it tries
+SWAP_LOCK_TIMEOUT = '5s'
+SWAP_ATTEMPTS = 5
+
+
+def table_kind(table):
+    """pg_class.relkind of `table`: 'p' when partitioned, 'r' for a plain table, None when there's no such table."""
+
+    return db.session.execute(text('SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)'),
+                              {'table': table}).scalar()
+
+
+def columns(table):
+    return [name for name, in db.session.execute(text(
+        'SELECT attname FROM pg_attribute WHERE attrelid = CAST(:table AS regclass) AND attnum > 0 '
+        'AND NOT attisdropped ORDER BY attnum'), {'table': table})]
+
+
+def primary_key(table):
+    return [name for name, in db.session.execute(text(
+        'SELECT attname FROM pg_index JOIN pg_attribute ON attrelid = indrelid AND attnum = ANY(indkey) '
+        'WHERE indrelid = CAST(:table AS regclass) AND indisprimary ORDER BY attnum'), {'table': table})]
+
+
+def constraints(table):
+    """[(name, definition)] of the table's keys and checks."""
+
+    return db.session.execute(text(
+        'SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = CAST(:table AS regclass) '
+        "AND contype IN ('p', 'u', 'f', 'c') ORDER BY conname"), {'table': table}).fetchall()
+
+
+def indexes(table):
+    """[(name, CREATE INDEX statement)] of the table's indexes that no constraint owns."""
+
+    return db.session.execute(text(
+        'SELECT relname, pg_get_indexdef(indexrelid) FROM pg_index JOIN pg_class ON pg_class.oid = indexrelid '
+        'WHERE indrelid = CAST(:table AS regclass) '
+        'AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid) ORDER BY relname'),
+        {'table': table}).fetchall()
+
+
+def mirror_function(table):
+    """The trigger function repeating a write on `table` in its partitioned copy."""
+
+    key = primary_key(table)
+    others = [column for column in columns(table) if column not in key]
+    match = ' AND '.join(f'{column} = OLD.{column}' for column in key)
+    on_conflict = 'DO UPDATE SET ' + ', '.join(f'{column} = EXCLUDED.{column}' for column in others) if others \
+        else 'DO NOTHING'
+    return (f'CREATE OR REPLACE FUNCTION {table}_mirror() RETURNS trigger AS $$ BEGIN '
+            f"IF TG_OP <> 'INSERT' THEN DELETE FROM {table}_partitioned WHERE {match}; END IF; "
+            f"IF TG_OP <> 'DELETE' THEN INSERT INTO {table}_partitioned SELECT (NEW).* "
+            f"ON CONFLICT ({', '.join(key)}) {on_conflict}; END IF; "
+            'RETURN NULL; END $$ LANGUAGE plpgsql')
+
+
+def create_partitioned(table, partitions):
+    """Create `<table>_partitioned` in `partitions` hash partitions, and start repeating the table's writes in it."""
+
+    new = f'{table}_partitioned'
+    statements = [f'CREATE TABLE {new} (LIKE {table} INCLUDING DEFAULTS) PARTITION BY HASH (user_id)'] + [
+        f'CREATE TABLE {table}_p{n} PARTITION OF {new} FOR VALUES WITH (MODULUS {partitions}, REMAINDER {n})'
+        for n in range(partitions)
+    ] + [
+        f'ALTER TABLE {new} ADD CONSTRAINT {name}_partitioned {definition}' for name, definition in constraints(table)
+    ] + [
+        re.sub(r' INDEX (\S+) ON (\S+\.)?\S+ ', f' INDEX \\1_partitioned ON {new} ', definition)
+        for name, definition in indexes(table)
+    ] + [
+        mirror_function(table),
+        f'CREATE TRIGGER {table}_mirror AFTER INSERT OR UPDATE OR DELETE ON {table} '
+        f'FOR EACH ROW EXECUTE FUNCTION {table}_mirror()',
+    ]
+    for statement in statements:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+
+def copy_rows(table):
+    """Copy the table's rows into its partitioned copy, COPY_BATCH users per transaction. Returns the rows copied."""
+
+    names = ', '.join(columns(table))
+    copy = text(f'INSERT INTO {table}_partitioned ({names}) SELECT {names} FROM {table} '
+                'WHERE user_id > :low AND user_id <= :high FOR SHARE ON CONFLICT DO NOTHING')
+    copied = 0
+    low = 0
+    while True:
+        ids = db.session.query(User.id).filter(User.id > low).order_by(User.id).limit(COPY_BATCH).subquery()
+        high = db.session.query(db.func.max(ids.c.id)).scalar()
+        if high is None:
+            return copied
+        copied += db.session.execute(copy, {'low': low, 'high': high}).rowcount
+        db.session.commit()
+        low = high
+
+
+def swap(table):
+    """Put the partitioned copy in the table's place, retrying when the app's transactions hold the lock too long."""
+
+    renames = [(name, 'CONSTRAINT') for name, definition in constraints(table)] + \
+        [(name, 'INDEX') for name, definition in indexes(table)]
+    statements = [
+        f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'",
+        f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE',
+        f'DROP TRIGGER {table}_mirror ON {table}',
+        f'DROP FUNCTION {table}_mirror()',
+        f'ALTER TABLE {table} RENAME TO {table}_unpartitioned',
+        f'ALTER TABLE {table}_partitioned RENAME TO {table}',
+    ]
+    for name, kind in renames:
+        if kind == 'CONSTRAINT':
+            statements += [f'ALTER TABLE {table}_unpartitioned RENAME CONSTRAINT {name} TO {name}_unpartitioned',
+                           f'ALTER TABLE {table} RENAME CONSTRAINT {name}_partitioned TO {name}']
+        else:
+            statements += [f'ALTER INDEX {name} RENAME TO {name}_unpartitioned',
+                           f'ALTER INDEX {name}_partitioned RENAME TO {name}']
+
+    for attempt in range(SWAP_ATTEMPTS):
+        try:
+            for statement in statements:
+                db.session.execute(text(statement))
+            db.session.commit()
+            return
+        except OperationalError:
+            # lock_timeout, the table stays as it was
+            db.session.rollback()
+            if attempt == SWAP_ATTEMPTS - 1:
+                raise
+
+
+def partition_table(table, partitions=16):
+    """Convert one table. Returns the rows copied, or None when it was already partitioned."""
+
+    if table_kind(table) == 'p':
+        return None
+    if table_kind(f'{table}_partitioned') is None:
+        create_partitioned(table, partitions)
+    copied = copy_rows(table)
+    # autovacuum doesn't analyze a partitioned table, and partitions it hasn't reached yet plan as if empty
+    db.session.execute(text(f'ANALYZE {table}_partitioned'))
+    db.session.commit()
+    swap(table)
+    return copied
+
+
+def partition_tables(partitions=16):
+    """Convert every table in PARTITIONED_TABLES. Returns {table: rows copied, or None if already partitioned}."""
+
+    return {table: partition_table(table, partitions) for table in PARTITIONED_TABLES}
@@ -0,0 +1,100 @@
+"""
+Password hashing that doesn't stall the other requests of a worker.
+
+bcrypt is deliberately slow. Under gevent every request of a worker shares one thread, so hashing runs on a small pool
+of real threads (bcrypt releases the GIL) and the hub keeps serving the other greenlets. Sync and threaded workers
+already hash on a real thread of their own and do it inline, a pool would only add a handoff. Either way the number of
+logins allowed to wait for a hash is capped, and logins beyond the cap fail fast with LoginThrottled instead of tying
+up the worker. The cost factor comes from BCRYPT_LOG_ROUNDS, and a hash made with a different cost is flagged by
+needs_rehash so it can be upgraded on the user's next login.
+"""
+import sys
+import threading
+from contextlib import contextmanager
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+
+class LoginThrottled(Exception):
+    """Raised when too many logins are already waiting for a password hash."""
+
+
+class PasswordHasher:
+    """Runs bcrypt, on a bounded thread pool under gevent. Configured from the app by init_app."""
+
+    def __init__(self, app=None):
+        self.log_rounds = 12
+        self.threads = 2
+        self.queue_timeout = 3
+        self._slots = threading.BoundedSemaphore(8)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        bcrypt.init_app(app)
+        self.log_rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.threads = app.config['BCRYPT_THREADS']
+        self.queue_timeout = app.config['LOGIN_QUEUE_TIMEOUT']
+        self._slots = threading.BoundedSemaphore(app.config['LOGIN_CONCURRENCY'])
+
+    @property
+    def executor(self):
+        # created on first use so that it is started in the gunicorn worker and not in the master before the fork
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    # monkey patched threads are greenlets, bcrypt needs real threads to leave the hub free
+                    from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+                    self._executor = GeventThreadPoolExecutor(max_workers=self.threads)
+        return self._executor
+
+    def run(self, function, *args):
+        """Call `function` on the pool under gevent, and right here on the request's own thread otherwise."""
+
+        if not is_gevent_patched():
+            return function(*args)
+        return self.executor.submit(function, *args).result()
+
+    @contextmanager
+    def login_slot(self):
+        """Hold one of the limited login slots, raising LoginThrottled if none frees up within the queue timeout."""
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise LoginThrottled()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Return the bcrypt hash of the password at the configured cost."""
+
+        return self.run(bcrypt.generate_password_hash, password, self.log_rounds).decode('utf8')
+
+    def check(self, hashed, password):
+        """Does the password match the hash."""
+
+        return self.run(bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was the hash made with a different cost factor than the configured one."""
+
+        # bcrypt hashes look like $2b$12$<salt and hash>, the second field is the cost
+        return get_log_rounds(hashed) != self.log_rounds
+
+
+def is_gevent_patched():
+    """Is this process running under gevent's monkey patching (the gevent gunicorn worker)."""
+
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def get_log_rounds(hashed):
+    return int(hashed.split('$')[2])
+
+
+passwords = PasswordHasher()
@@ -0,0 +1,37 @@
+"""Count the SQL statements a block of code runs, for tests that hold routes to a query budget."""
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SAVEPOINT_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+@contextmanager
+def count_queries():
+    """Collect the statements run inside the block, on any engine, into the yielded list. Savepoints don't count."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        # savepoints are how the test fixtures isolate tests, not work the code asked for
+        if not statement.startswith(SAVEPOINT_STATEMENTS):
+            statements.append(statement)
+
+    event.listen(Engine, 'after_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'after_cursor_execute', record)
+
+
+class QueryBudgetMixin:
+    """TestCase mixin: `with self.assertMaxQueries(4): client.get(...)` fails listing the statements when over."""
+
+    @contextmanager
+    def assertMaxQueries(self, budget, msg=None):
+        with count_queries() as statements:
+            yield statements
+        if len(statements) > budget:
+            listing = '\n\n'.join(f'{n}. {statement}' for n, statement in enumerate(statements, 1))
+            self.fail(self._formatMessage(msg, f'{len(statements)} queries, budget {budget}:\n\n{listing}'))
@@ -0,0 +1,69 @@
+"""
+Token buckets shared by every worker and process, kept in the rate_limits table.
+
+A bucket holds up to `burst` tokens and gains `rate` of them a second. A call takes one, and when none is left it
+reserves the next one to come: the tokens go below zero and the call sleeps until its turn, so callers waiting together
+go in order instead of all retrying at once. A call whose turn is further off than its `max_wait` takes nothing and gets
+RateLimited with the estimated wait instead. Buckets are read and written on a connection of their own, in a
+transaction committed right away, whatever the caller's session is doing.
+"""
+import time
+from collections import namedtuple
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import text
+
+from models import db
+
+RATE_LIMIT_WAIT_SECONDS = Histogram('rate_limit_wait_seconds', 'Time calls slept waiting for their turn', ['bucket'],
+                                    buckets=(0, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+RATE_LIMIT_REFUSED = Counter('rate_limit_refused', 'Calls turned away because their turn was too far off', ['bucket'])
+
+
+class Budget(namedtuple('Budget', ['rate', 'burst', 'max_wait'])):
+    """Calls per second, tokens saved up while idle, and the longest a call waits for its turn."""
+
+    __slots__ = ()
+
+    def __new__(cls, rate, burst, max_wait):
+        # without a rate the bucket never refills and the wait for a turn is a division by zero
+        if rate <= 0:
+            raise ValueError(f'A rate limit budget needs a rate above 0, not {rate}')
+        return super().__new__(cls, rate, burst, max_wait)
+
+
+class RateLimited(Exception):
+    """The call's turn is more than its max_wait away. `retry_after` is the estimated wait in seconds."""
+
+    def __init__(self, bucket, retry_after):
+        super().__init__(f'{bucket} is rate limited, the next turn is in about {retry_after:.0f} seconds')
+        self.bucket = bucket
+        self.retry_after = retry_after
+
+
+def reserve(bucket, budget):
+    """Take a token from the bucket, or reserve the next one. Returns the seconds until the call may go."""
+
+    with db.engine.begin() as conn:
+        conn.execute(text('INSERT INTO rate_limits (name, tokens, updated) VALUES (:name, :burst, clock_timestamp()) '
+                          'ON CONFLICT DO NOTHING'), {'name': bucket, 'burst': budget.burst})
+        tokens, elapsed, now = conn.execute(text(
+            'SELECT tokens, EXTRACT(EPOCH FROM clock_timestamp() - updated), clock_timestamp() FROM rate_limits '
+            'WHERE name = :name FOR UPDATE'), {'name': bucket}).one()
+        tokens = min(budget.burst, tokens + float(elapsed) * budget.rate)
+        wait = max(1 - tokens, 0) / budget.rate
+        if wait > budget.max_wait:
+            RATE_LIMIT_REFUSED.labels(bucket).inc()
+            raise RateLimited(bucket, wait)
+        conn.execute(text('UPDATE rate_limits SET tokens = :tokens, updated = :now WHERE name = :name'),
+                     {'name': bucket, 'tokens': tokens - 1, 'now': now})
+    return wait
+
+
+def throttle(bucket, budget):
+    """Wait for the call's turn in the bucket. Raises RateLimited instead when it's more than max_wait off."""
+
+    wait = reserve(bucket, budget)
+    RATE_LIMIT_WAIT_SECONDS.labels(bucket).observe(wait)
+    if wait:
+        time.sleep(wait)
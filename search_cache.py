@@ -0,0 +1,52 @@
+"""
+Cached results of the searches users repeat while browsing: their collection by title or ISBN, and by tag.
+
+Results are lists of book ids keyed by user, search and the user's library version. Every write to a user's books or
+book tags bumps that version in the same transaction, so a cached result is never stale: after a change the next search
+looks under a new key, and the old entries age out of the LRU. The cache holds at most SEARCH_CACHE_SIZE results of at
+most SEARCH_CACHE_MAX_IDS ids each, larger results aren't cached.
+"""
+from flask import current_app
+from prometheus_client import Counter
+
+from cache import create_cache
+
+SEARCH_CACHE_LOOKUPS = Counter('search_cache_lookups', 'Search result cache lookups', ['search', 'outcome'])
+
+
+def init_search_cache(app):
+    """Create the search result cache configured for the app."""
+
+    app.extensions['search_cache'] = create_cache(
+        app.config['SEARCH_CACHE_BACKEND'],
+        app.config['SEARCH_CACHE_SIZE'],
+        app.config.get('SEARCH_CACHE_PATH')
+    )
+
+
+def get_search_cache():
+    return current_app.extensions['search_cache']
+
+
+def search_key(user, search, terms):
+    return f'search:{user.id}:{user.library_version}:{search}:{terms}'
+
+
+def cached_book_ids(user, search, terms, book_ids):
+    """
+    The ids of the books `book_ids`, a query of book ids, selects for `search` with `terms` in the user's collection.
+    Read from the cache when the user's library hasn't changed since the same search last ran.
+    """
+
+    cache = get_search_cache()
+    key = search_key(user, search, terms)
+    cached = cache.get(key)
+    if cached is not None:
+        SEARCH_CACHE_LOOKUPS.labels(search, 'hit').inc()
+        return [int(book_id) for book_id in cached.split(',') if book_id]
+
+    SEARCH_CACHE_LOOKUPS.labels(search, 'miss').inc()
+    ids = [book_id for book_id, in book_ids]
+    if len(ids) <= current_app.config['SEARCH_CACHE_MAX_IDS']:
+        cache.set(key, ','.join(str(book_id) for book_id in ids))
+    return ids
@@ -1,43 +1,284 @@
-from app import db
-from models import Book, Author, BookAuthor
+"""
+Generate a synthetic library at production scale.
+
+Creates users, books with authors, publishers and subjects, and per user collections and tags. How often a tag,
+author or subject is used follows a power law, so a few are everywhere and most are rare. Every table is written with
+COPY, and the same --seed always produces the same data.
+
+    python seed.py                                  # small dataset, replaces the current data
+    python seed.py --users 2000 --books 1000000 --seed 7
+    python seed.py --append --users 10 --books 0    # add users to an existing dataset
+
+Every generated user has the password "password".
+"""
+import argparse
 import datetime
+import io
+import json
+import random
+import time
+from itertools import accumulate
+
+from app import app
+from models import db, normalize_name, Author, Publisher, Subject, SubjectPlace, SubjectPerson, SubjectTime
+from migrations import create_schema
+from passwords import passwords
+
+WORDS = """
+river stone night garden winter secret shadow light house king queen dragon ocean forest city road star moon fire
+glass iron silver golden silent lost last first little great hidden broken wild dark bright summer autumn spring
+mountain island castle bridge letter song dream storm wind rain snow heart memory journey war peace time clock
+library book map ship train bird wolf fox bear cat dog horse tree flower rose lantern mirror door key window
+""".split()
+FIRST_NAMES = """
+anna ben clara david elena frank grace henry iris jack kate leo maria noah olivia peter quinn rosa sam tara
+ursula victor wendy xavier yara zoe arthur beatrix carl dora emil fiona george hannah ivan julia karl lena
+""".split()
+LAST_NAMES = """
+smith jones brown taylor wilson davies evans thomas johnson roberts walker wright robinson thompson white hughes
+edwards green hall wood harris lewis martin jackson clarke clark turner hill scott cooper morris ward moore king
+""".split()
+TAG_WORDS = """
+favorites to-read read fiction nonfiction picture-books kids classics summer winter school science history poetry
+mystery fantasy sci-fi biography signed first-edition gift borrowed lent wishlist cookbooks art travel animals
+""".split()
+
+COPY_CHUNK = 50000
+
+
+def zipf_weights(n, exponent=1.1):
+    """Cumulative weights for random.choices so that item i is picked in proportion to 1 / (i + 1) ** exponent."""
+
+    return list(accumulate(1 / (i + 1) ** exponent for i in range(n)))
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', ' ').replace('\n', ' ')
+
+
+def copy_rows(cursor, table, columns, rows):
+    """COPY the rows into the table in chunks, so memory stays flat however many rows there are. Returns the count."""
+
+    count = 0
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(value) for value in row))
+        buffer.write('\n')
+        count += 1
+        if count % COPY_CHUNK == 0:
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+            buffer = io.StringIO()
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+    return count
+
+
+class LibraryGenerator:
+    """Produces the rows for every table. Ids continue after `first_ids` so a dataset can be appended to."""
+
+    def __init__(self, args, first_ids):
+        self.args = args
+        self.seed = args.seed
+        self.first = first_ids
+        self.vocabulary_sizes = {
+            'authors': max(1, int(args.books * args.authors_ratio)),
+            'publishers': max(1, args.books // 50),
+            'subjects': max(1, min(args.books, 20000)),
+            'subject_places': max(1, min(args.books // 4, 5000)),
+            'subject_people': max(1, min(args.books // 4, 5000)),
+            'subject_times': max(1, min(args.books // 10, 500)),
+        }
+        self.cum_weights = {}
+
+    def rng(self, name):
+        """A random generator per table, so each table comes out the same whichever others are generated."""
+
+        return random.Random(f'{self.seed}-{name}')
+
+    def pick(self, rng, n, k):
+        """Pick k distinct indexes out of n, favouring low indexes with a power law."""
+
+        if n not in self.cum_weights:
+            self.cum_weights[n] = zipf_weights(n)
+        k = min(k, n)
+        picked = set()
+        while len(picked) < k:
+            picked.update(rng.choices(range(n), cum_weights=self.cum_weights[n], k=k - len(picked)))
+        return picked
+
+    def users(self, password):
+        for i in range(self.args.users):
+            user_id = self.first['users'] + i
+            yield user_id, f'user{user_id}@example.com', password
+
+    def books(self):
+        rng = self.rng('books')
+        for i in range(self.args.books):
+            book_id = self.first['books'] + i
+            cover_id = rng.randrange(1, 12000000)
+            images = {size: f'https://covers.openlibrary.org/b/id/{cover_id}-{size[0].upper()}.jpg'
+                      for size in ('small', 'medium', 'large')}
+            title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 5))).title()
+            yield (
+                book_id,
+                f'978{book_id:010d}',
+                f'/books/OL{book_id}M',
+                json.dumps(images),
+                f'https://openlibrary.org/books/OL{book_id}M',
+                rng.randint(24, 1200),
+                datetime.date(rng.randint(1850, 2021), rng.randint(1, 12), 1),
+                title
+            )
+
+    def vocabulary(self, table):
+        rng = self.rng(table)
+        for i in range(self.vocabulary_sizes[table]):
+            vocabulary_id = self.first[table] + i
+            if table in ('authors', 'subject_people'):
+                name = f'{rng.choice(FIRST_NAMES).title()} {rng.choice(LAST_NAMES).title()}'
+            else:
+                name = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title()
+            # the id keeps names unique
+            name = f'{name} {vocabulary_id}'
+            yield vocabulary_id, name, normalize_name(name, person=table in ('authors', 'subject_people'))
+
+    def book_links(self, table, counts):
+        """Link every book to a few vocabulary rows. `counts` are the weights for linking 0, 1, 2... rows."""
+
+        rng = self.rng(f'books_{table}')
+        size = self.vocabulary_sizes[table]
+        for i in range(self.args.books):
+            book_id = self.first['books'] + i
+            k = rng.choices(range(len(counts)), weights=counts)[0]
+            for index in self.pick(rng, size, k):
+                yield book_id, self.first[table] + index
+
+    def tags(self):
+        for i in range(self.args.tags):
+            yield self.first['tags'] + i, f'{TAG_WORDS[i % len(TAG_WORDS)]}-{self.first["tags"] + i}'
+
+    def collections(self):
+        """
+        Yield (users_books rows, users_tags rows, users_books_tags rows) for one user at a time.
+        Collection sizes follow a pareto distribution around --books-per-user.
+        """
+
+        rng = self.rng('collections')
+        total_books = self.first['books'] + self.args.books - 1
+        start = datetime.datetime(2021, 1, 1)
+        for i in range(self.args.users):
+            user_id = self.first['users'] + i
+            size = min(total_books, int(self.args.books_per_user * rng.paretovariate(2.0) / 2))
+            book_ids = rng.sample(range(1, total_books + 1), size) if size else []
+            tag_ids = [self.first['tags'] + index
+                       for index in self.pick(rng, self.args.tags,
+                                              rng.randint(min(5, self.args.tags_per_user), self.args.tags_per_user))]
+
+            user_books = [(user_id, book_id, start + datetime.timedelta(minutes=n))
+                          for n, book_id in enumerate(book_ids)]
+            user_tags = [(user_id, tag_id) for tag_id in tag_ids]
+            user_book_tags = []
+            for book_id in book_ids:
+                k = rng.choices(range(5), weights=[30, 35, 20, 10, 5])[0]
+                # each user leans on a few of their tags
+                user_book_tags.extend((user_id, book_id, tag_ids[index]) for index in self.pick(rng, len(tag_ids), k))
+            yield user_books, user_tags, user_book_tags
+
+
+def next_ids(cursor, tables):
+    """The first free id in each table."""
+
+    ids = {}
+    for table in tables:
+        cursor.execute(f'SELECT coalesce(max(id), 0) + 1 FROM {table}')
+        ids[table] = cursor.fetchone()[0]
+    return ids
+
+
+def generate(args):
+    if not args.append:
+        db.drop_all()
+    create_schema()
+
+    vocabulary_tables = [model.__tablename__ for model in (Author, Publisher, Subject, SubjectPlace, SubjectPerson,
+                                                           SubjectTime)]
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        generator = LibraryGenerator(args, next_ids(cursor, ['users', 'books', 'tags'] + vocabulary_tables))
+        started = time.perf_counter()
+
+        def timed(label, count_rows):
+            step = time.perf_counter()
+            count = count_rows()
+            print(f'{label:<22} {count:>12,} rows {time.perf_counter() - step:8.1f}s')
+
+        # one hash for everyone, bcrypt per user would take longer than the rest of the load
+        password = passwords.hash('password')
+        timed('users', lambda: copy_rows(cursor, 'users', ['id', 'username', 'password'], generator.users(password)))
+        timed('books', lambda: copy_rows(cursor, 'books', [
+            'id', 'isbn', 'open_library_id', 'open_library_images', 'open_library_url', 'number_of_pages',
+            'publish_date', 'title'
+        ], generator.books()))
+
+        links = {
+            'authors': ('books_authors', 'author_id', [0, 75, 20, 5]),
+            'publishers': ('books_publishers', 'publisher_id', [5, 85, 10]),
+            'subjects': ('books_subjects', 'subject_id', [10, 10, 15, 20, 15, 10, 8, 6, 3, 2, 1]),
+            'subject_places': ('books_subject_places', 'subject_place_id', [60, 25, 10, 5]),
+            'subject_people': ('books_subject_people', 'subject_person_id', [70, 20, 10]),
+            'subject_times': ('books_subject_times', 'subject_time_id', [75, 20, 5]),
+        }
+        for table in vocabulary_tables:
+            link_table, column, counts = links[table]
+            timed(table, lambda: copy_rows(cursor, table, ['id', 'name', 'name_key'], generator.vocabulary(table)))
+            timed(link_table, lambda: copy_rows(cursor, link_table, ['book_id', column],
+                                                generator.book_links(table, counts)))
+
+        timed('tags', lambda: copy_rows(cursor, 'tags', ['id', 'name'], generator.tags()))
+
+        def copy_collections():
+            count = 0
+            for user_books, user_tags, user_book_tags in generator.collections():
+                # users are small enough to copy one at a time, which keeps memory flat
+                count += copy_rows(cursor, 'users_books', ['user_id', 'book_id', 'created_date'], user_books)
+                count += copy_rows(cursor, 'users_tags', ['user_id', 'tag_id'], user_tags)
+                count += copy_rows(cursor, 'users_books_tags', ['user_id', 'book_id', 'tag_id'], user_book_tags)
+            return count
+
+        timed('collections', copy_collections)
+
+        # the ids were set explicitly, move the sequences past them
+        for table in ['users', 'books', 'tags'] + vocabulary_tables:
+            cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                           f"(SELECT coalesce(max(id), 1) FROM {table}))")
+        conn.commit()
+        cursor.execute('ANALYZE')
+        conn.commit()
+        print(f'{"total":<22} {"":>17} {time.perf_counter() - started:8.1f}s')
+    finally:
+        conn.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--books-per-user', type=int, default=200, help='typical collection size')
+    parser.add_argument('--authors-ratio', type=float, default=0.6, help='distinct authors per book')
+    parser.add_argument('--tags', type=int, default=500, help='distinct tag names across all users')
+    parser.add_argument('--tags-per-user', type=int, default=40, help='most tags a single user creates')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--append', action='store_true', help='keep the existing data and add to it')
+    args = parser.parse_args(argv)
+    if args.tags_per_user < 0:
+        parser.error('--tags-per-user can\'t be negative')
+    return args
+
 
-db.drop_all()
-db.create_all()
-
-# create sample books
-# book1 = Book(
-#     isbn='fake_isbn_1',
-#     open_library_id='fake_OL_id_1',
-#     open_library_images=None,
-#     open_library_url='fake_OL_url_1',
-#     number_of_pages=42,
-#     publish_date=datetime.datetime.now(),
-#     title='Epic book title, the first'
-# )
-# book2 = Book(
-#     isbn='fake_isbn_2',
-#     open_library_id='fake_OL_id_2',
-#     open_library_images=None,
-#     open_library_url='fake_OL_url_2',
-#     number_of_pages=43,
-#     publish_date=datetime.datetime.now(),
-#     title='Epic book title, the second'
-# )
-# db.session.add_all([book1, book2])
-# db.session.commit()
-#
-# # create some sample authors
-# author1 = Author(name='Piers Anthony')
-# author2 = Author(name='Neil Gaiman')
-#
-# db.session.add_all([author1, author2])
-# db.session.commit()
-#
-# # assign author(s) to book(s)
-# book_author1 = BookAuthor(book_id=book1.id, author_id=author1.id)
-# book_author2 = BookAuthor(book_id=book1.id, author_id=author2.id)
-# book_author3 = BookAuthor(book_id=book2.id, author_id=author1.id)
-#
-# db.session.add_all([book_author1, book_author2, book_author3])
-# db.session.commit()
+if __name__ == '__main__':
+    with app.app_context():
+        generate(parse_args())
@@ -0,0 +1,256 @@
+"""
+"More like this": every book's nearest neighbours by shared authors, publishers, subjects, places, people and periods.
+
+Books are rows of a sparse matrix with a column per author, publisher and subject. A feature is weighted by its inverse
+document frequency, so sharing a rare subject counts for more than sharing 'Fiction', and rows are scaled to unit
+length. Similarity is the cosine, a sparse product of the matrix with its transpose, worked through a block of rows at
+a time. The TOP_K best neighbours of every book are kept in similar_books, which the book page reads with one query.
+
+`flask refresh-similar` computes neighbours for the books added since the last run and merges the new books into the
+lists of the books they beat. Weights drift as books are added, `flask refresh-similar --full` recomputes everything.
+Adding books queues an incremental run SIMILAR_REFRESH_DELAY seconds later on a thread of the worker, which the books
+added in the meantime join. NumPy and SciPy are only imported by the runs, a worker that never adds a book doesn't load
+them.
+"""
+import logging
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import and_, text
+
+from api import BOOK_VOCABULARIES
+from models import db, Book, UserBook, SimilarBook, SimilarRefresh
+
+# neighbours kept per book, enough to fill the page after leaving out the user's own books
+TOP_K = 20
+# rows multiplied against the whole matrix at a time, bounds the memory of the product
+BLOCK_ROWS = 1000
+# rows per insert when saving neighbour lists
+INSERT_BATCH = 10000
+# advisory lock taken by every run, so runs from the workers and the scheduled job go one at a time
+REFRESH_LOCK = 40140
+
+logger = logging.getLogger(__name__)
+
+# whether this process has a run waiting to start
+queued = False
+queued_lock = threading.Lock()
+
+
+def feature_matrix():
+    """
+    Return (book ids, matrix): the ids in ascending order and a CSR matrix with a unit length row per book.
+    Books with nothing in the link tables have no row.
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    rows, columns = [], []
+    offset = 0
+    for key, model, link, link_column in BOOK_VOCABULARIES:
+        pairs = np.array(db.session.query(link.book_id, link_column).all(), dtype=np.int64).reshape(-1, 2)
+        if len(pairs):
+            rows.append(pairs[:, 0])
+            columns.append(pairs[:, 1] + offset)
+            offset += int(pairs[:, 1].max()) + 1
+    if not rows:
+        return np.array([], dtype=np.int64), sparse.csr_matrix((0, 0))
+
+    rows, columns = np.concatenate(rows), np.concatenate(columns)
+    book_ids = np.unique(rows)
+    matrix = sparse.csr_matrix((np.ones(len(rows)), (np.searchsorted(book_ids, rows), columns)),
+                               shape=(len(book_ids), offset))
+
+    document_frequency = matrix.getnnz(axis=0)
+    idf = np.zeros(offset)
+    # a feature on one book can't make two books alike
+    shared = document_frequency > 1
+    idf[shared] = np.log(len(book_ids) / document_frequency[shared]) + 1
+    matrix = sparse.csr_matrix(matrix.multiply(idf))
+    matrix.eliminate_zeros()
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix = sparse.csr_matrix(sparse.diags(1 / norms) @ matrix)
+    return book_ids, matrix
+
+
+def top_neighbours(scores, self_columns, k=TOP_K):
+    """
+    For each row of a CSR score matrix, the (column, score) of its k best entries other than its own column, best first.
+    """
+
+    import numpy as np
+
+    neighbours = []
+    for row, self_column in enumerate(self_columns):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        columns, values = scores.indices[start:end], scores.data[start:end]
+        keep = (columns != self_column) & (values > 0)
+        columns, values = columns[keep], values[keep]
+        if len(values) > k:
+            best = np.argpartition(-values, k)[:k]
+            columns, values = columns[best], values[best]
+        order = np.argsort(-values, kind='stable')
+        neighbours.append(list(zip(columns[order].tolist(), values[order].tolist())))
+    return neighbours
+
+
+def neighbour_lists(book_ids, matrix, rows, k=TOP_K):
+    """{book id: [(similar book id, score), ...]} for the given matrix rows, BLOCK_ROWS rows per product."""
+
+    lists = {}
+    transposed = matrix.T.tocsr()
+    for start in range(0, len(rows), BLOCK_ROWS):
+        block = rows[start:start + BLOCK_ROWS]
+        scores = (matrix[block] @ transposed).tocsr()
+        for row, neighbours in zip(block, top_neighbours(scores, block, k)):
+            lists[int(book_ids[row])] = [(int(book_ids[column]), score) for column, score in neighbours]
+    return lists
+
+
+def save_neighbour_lists(lists, replace=True):
+    """Store the neighbours of the books in `lists`, replacing what was stored for them unless `replace` is off."""
+
+    book_ids = list(lists)
+    for start in range(0, len(book_ids) if replace else 0, INSERT_BATCH):
+        db.session.query(SimilarBook)\
+            .filter(SimilarBook.book_id.in_(book_ids[start:start + INSERT_BATCH]))\
+            .delete(synchronize_session=False)
+    rows = [{'book_id': book_id, 'similar_book_id': similar_id, 'score': score}
+            for book_id, neighbours in lists.items() for similar_id, score in neighbours]
+    for start in range(0, len(rows), INSERT_BATCH):
+        db.session.execute(SimilarBook.__table__.insert(), rows[start:start + INSERT_BATCH])
+
+
+def merge_new_books(book_ids, matrix, new_rows, k=TOP_K):
+    """
+    Neighbour lists of the existing books that one of the new books now beats: their stored list merged with the new
+    candidates, cut back to k. Books whose stored list stays as it was are left out.
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    existing = np.ones(len(book_ids))
+    existing[new_rows] = 0
+    # existing books by new books, only the pairs that share a feature are stored
+    scores = (sparse.diags(existing) @ matrix @ matrix[new_rows].T).tocsr()
+    scores.eliminate_zeros()
+    candidate_rows = np.flatnonzero(np.diff(scores.indptr))
+    if not len(candidate_rows):
+        return {}
+
+    best_new = {}
+    for row, neighbours in zip(candidate_rows, top_neighbours(scores[candidate_rows], [-1] * len(candidate_rows), k)):
+        best_new[int(book_ids[row])] = [(int(book_ids[new_rows[column]]), score) for column, score in neighbours]
+
+    stored = {}
+    candidate_ids = list(best_new)
+    for start in range(0, len(candidate_ids), INSERT_BATCH):
+        for book_id, similar_id, score in db.session.query(SimilarBook.book_id, SimilarBook.similar_book_id,
+                                                           SimilarBook.score)\
+                .filter(SimilarBook.book_id.in_(candidate_ids[start:start + INSERT_BATCH])):
+            stored.setdefault(book_id, []).append((similar_id, score))
+
+    merged = {}
+    for book_id, candidates in best_new.items():
+        current = stored.get(book_id, [])
+        weakest = min(score for similar_id, score in current) if len(current) >= k else 0
+        if candidates[0][1] > weakest:
+            # a book added while the last run was loading the matrix may already be on the list
+            combined = dict(current)
+            combined.update(candidates)
+            merged[book_id] = sorted(combined.items(), key=lambda neighbour: -neighbour[1])[:k]
+    return merged
+
+
+def refresh_similar_books(full=False):
+    """
+    Bring similar_books up to date and record the run. Returns the SimilarRefresh.
+    Without `full` only the books added since the last run are scored, against every book.
+    """
+
+    import numpy as np
+
+    started = time.perf_counter()
+    db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': REFRESH_LOCK})
+    last = SimilarRefresh.query.order_by(SimilarRefresh.id.desc()).first()
+    full = full or last is None
+    # read before the matrix, a book added while it loads is picked up again by the next run
+    last_book_id = db.session.query(db.func.max(Book.id)).scalar() or 0
+    book_ids, matrix = feature_matrix()
+
+    if full:
+        lists = neighbour_lists(book_ids, matrix, np.arange(len(book_ids)))
+        db.session.query(SimilarBook).delete(synchronize_session=False)
+        save_neighbour_lists(lists, replace=False)
+    else:
+        new_rows = np.flatnonzero(book_ids > last.last_book_id)
+        lists = merge_new_books(book_ids, matrix, new_rows) if len(new_rows) else {}
+        lists.update(neighbour_lists(book_ids, matrix, new_rows))
+        save_neighbour_lists(lists)
+
+    refresh = SimilarRefresh(full=full, last_book_id=last_book_id, books=len(lists),
+                             seconds=time.perf_counter() - started)
+    db.session.add(refresh)
+    db.session.commit()
+    return refresh
+
+
+def queue_refresh():
+    """
+    Run an incremental refresh on a thread of its own SIMILAR_REFRESH_DELAY seconds from now, unless one is already
+    waiting to start. Call it once books were added and committed. Returns the timer, or None when nothing was queued.
+    With the delay set to None nothing is, and the books wait for the scheduled job.
+    """
+
+    global queued
+
+    app = current_app._get_current_object()
+    delay = app.config['SIMILAR_REFRESH_DELAY']
+    if delay is None:
+        return None
+    with queued_lock:
+        if queued:
+            return None
+        queued = True
+
+    def work():
+        global queued
+        # books committed from here on may be missed by this run's matrix, they queue the next one
+        with queued_lock:
+            queued = False
+        with app.app_context():
+            try:
+                refresh_similar_books()
+            except Exception:
+                logger.exception('similar books refresh failed')
+            finally:
+                db.session.remove()
+
+    timer = threading.Timer(delay, work)
+    timer.name = 'similar-refresh'
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def similar_books(user_id, book_id, in_collection=False, limit=5):
+    """
+    The books most like `book_id`, best first: those in the user's collection with `in_collection`, otherwise those
+    not in it. One query.
+    """
+
+    owned = db.session.query(UserBook.book_id)\
+        .filter(UserBook.user_id == user_id, UserBook.book_id == SimilarBook.similar_book_id)\
+        .exists()
+
+    return db.session.query(Book)\
+        .join(SimilarBook, and_(SimilarBook.similar_book_id == Book.id, SimilarBook.book_id == book_id))\
+        .filter(owned if in_collection else ~owned)\
+        .order_by(SimilarBook.score.desc(), Book.id)\
+        .limit(limit)\
+        .all()
@@ -0,0 +1,209 @@
+"""
+Opt-in slow query log. With SLOW_QUERY_MS set, every statement that takes longer is saved to the slow_queries table
+with the types of its parameters, the route that ran it and its estimated plan. Plans are captured by a background
+thread on a connection of its own, so the request that ran the statement doesn't wait for them. /admin/slow-queries
+lists the worst offenders.
+"""
+import datetime
+import json
+import logging
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Blueprint, current_app, flash, g, has_app_context, has_request_context, redirect, render_template, \
+    request
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+
+from models import db, SlowQuery
+
+logger = logging.getLogger(__name__)
+
+admin = Blueprint('admin', __name__, url_prefix='/admin')
+
+# what a SELECT may do besides reading: take row locks, advance sequences, call the pg_ functions that notify, lock,
+# sleep or signal other backends. Running one of those again for EXPLAIN ANALYZE would do it again.
+SIDE_EFFECTS = re.compile(r'\bfor\s+(?:no\s+key\s+)?(?:key\s+)?(?:update|share)\b'
+                          r'|\b(?:nextval|setval)\s*\(|\bpg_\w+\s*\(')
+
+
+def describe(value):
+    """A parameter's type, and its length when it has one, without its value."""
+
+    if value is None:
+        return 'null'
+    if isinstance(value, (str, bytes, list, tuple, dict)):
+        return f'{type(value).__name__}({len(value)})'
+    return type(value).__name__
+
+
+def redact(parameters, executemany=False):
+    """
+    The statement's parameters described by type and length, so usernames, password hashes and the like aren't saved.
+    executemany runs are reduced to their row count and the first row.
+    """
+
+    if executemany:
+        return {'rows': len(parameters), 'first': redact(parameters[0]) if parameters else None}
+    if isinstance(parameters, dict):
+        return {key: describe(value) for key, value in parameters.items()}
+    return [describe(value) for value in parameters or ()]
+
+
+class SlowQueryLog:
+    """Hands slow statements to a background thread that explains them and saves them."""
+
+    def __init__(self, threshold_ms, keep=10000, explain_interval=60, explain_timeout_ms=10000, queue_size=100,
+                 max_statements=1000, explain_analyze=False):
+        self.threshold = threshold_ms / 1000
+        self.keep = keep
+        self.explain_interval = explain_interval
+        self.explain_analyze = explain_analyze
+        self.explain_timeout_ms = explain_timeout_ms
+        self.queue = queue.Queue(maxsize=queue_size)
+        # statement -> when it was last explained, one plan a minute is plenty for a statement that keeps being slow.
+        # Only the most recently explained `max_statements` are remembered, the rest may be explained again.
+        self.max_statements = max_statements
+        self.explained = OrderedDict()
+        self.saved = 0
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def record(self, engine, statement, parameters, executemany, seconds, endpoint):
+        """Queue a statement for saving. Never blocks, when the thread falls behind the statement is dropped."""
+
+        with self.lock:
+            # a worker forked from a process that already started the thread doesn't have it
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='slow-query-log', daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait((engine, statement, parameters, executemany, seconds, endpoint))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.save(*item)
+            except Exception:
+                logger.exception('could not save a slow query')
+            finally:
+                self.queue.task_done()
+
+    def save(self, engine, statement, parameters, executemany, seconds, endpoint):
+        plan = None
+        now = time.monotonic()
+        if not executemany and now - self.explained.get(statement, -self.explain_interval) >= self.explain_interval:
+            self.explained[statement] = now
+            self.explained.move_to_end(statement)
+            while len(self.explained) > self.max_statements:
+                self.explained.popitem(last=False)
+            plan = self.explain(engine, statement, parameters)
+
+        # raw connections run outside of SQLAlchemy's events, so saving is not timed and logged in turn
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                'INSERT INTO slow_queries (created, duration_ms, endpoint, statement, parameters, plan) '
+                'VALUES (%s, %s, %s, %s, %s, %s)',
+                (datetime.datetime.utcnow(), seconds * 1000, endpoint, statement,
+                 json.dumps(redact(parameters, executemany)), plan)
+            )
+            self.saved += 1
+            if self.saved % 100 == 0:
+                cursor.execute('DELETE FROM slow_queries WHERE id <= (SELECT max(id) FROM slow_queries) - %s',
+                               (self.keep,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def explain(self, engine, statement, parameters):
+        """
+        The plan for the statement, the estimated one unless explain_analyze is set. Even then only SELECTs without
+        row locks, sequences or pg_ function calls are run again with ANALYZE. Either way it runs in a transaction that
+        is rolled back, under a statement timeout.
+        """
+
+        lowered = statement.lstrip().lower()
+        analyze = self.explain_analyze and lowered.startswith('select') and not SIDE_EFFECTS.search(lowered)
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'SET LOCAL statement_timeout = {int(self.explain_timeout_ms)}')
+            cursor.execute(f"EXPLAIN {'(ANALYZE, BUFFERS) ' if analyze else ''}{statement}", parameters)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+        except Exception as exc:
+            logger.warning('could not explain a slow query: %s', exc)
+            return None
+        finally:
+            conn.rollback()
+            conn.close()
+
+
+def init_slow_query_log(app):
+    """Install the log when SLOW_QUERY_MS is set. The admin page is there either way."""
+
+    app.register_blueprint(admin)
+    if app.config['SLOW_QUERY_MS'] is None:
+        return
+    app.extensions['slow_query_log'] = SlowQueryLog(app.config['SLOW_QUERY_MS'],
+                                                    keep=app.config['SLOW_QUERY_KEEP'],
+                                                    explain_interval=app.config['SLOW_QUERY_EXPLAIN_INTERVAL'],
+                                                    explain_analyze=app.config['SLOW_QUERY_EXPLAIN_ANALYZE'])
+    if not event.contains(Engine, 'after_cursor_execute', check_duration):
+        event.listen(Engine, 'before_cursor_execute', start_timer)
+        event.listen(Engine, 'after_cursor_execute', check_duration)
+
+
+def start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info['slow_query_started'] = time.perf_counter()
+
+
+def check_duration(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('slow_query_started', None)
+    if started is None or not has_app_context():
+        return
+    slow_query_log = current_app.extensions.get('slow_query_log')
+    seconds = time.perf_counter() - started
+    if slow_query_log and seconds >= slow_query_log.threshold:
+        endpoint = request.endpoint if has_request_context() else None
+        slow_query_log.record(conn.engine, statement, parameters, executemany, seconds, endpoint)
+
+
+@admin.route('/slow-queries')
+def slow_queries():
+    """The statements that took the most time in total, with their latest plan."""
+
+    if not g.user or g.user.username not in current_app.config['ADMIN_USERNAMES']:
+        flash('You are not authorized.', 'danger')
+        return redirect('/')
+
+    total_ms = func.sum(SlowQuery.duration_ms)
+    offenders = db.session.query(
+        SlowQuery.statement,
+        SlowQuery.endpoint,
+        func.count().label('count'),
+        func.avg(SlowQuery.duration_ms).label('mean_ms'),
+        func.max(SlowQuery.duration_ms).label('max_ms'),
+        total_ms.label('total_ms'),
+        func.max(SlowQuery.id).label('latest_id')
+    ).group_by(SlowQuery.statement, SlowQuery.endpoint).order_by(total_ms.desc()).limit(25).all()
+
+    # the parameters of each offender's latest run, and the latest plan of each statement
+    latest = dict(db.session.query(SlowQuery.id, SlowQuery.parameters)
+                  .filter(SlowQuery.id.in_([offender.latest_id for offender in offenders])))
+    plans = dict(db.session.query(SlowQuery.statement, SlowQuery.plan)
+                 .filter(SlowQuery.plan.isnot(None),
+                         SlowQuery.statement.in_({offender.statement for offender in offenders}))
+                 .distinct(SlowQuery.statement)
+                 .order_by(SlowQuery.statement, SlowQuery.id.desc()))
+
+    return render_template('admin-slow-queries.html', user=g.user, offenders=offenders, latest=latest, plans=plans,
+                           enabled='slow_query_log' in current_app.extensions)
@@ -0,0 +1,25 @@
+// Suggest names from the user's library in the datalist of every input with a data-autocomplete url.
+document.querySelectorAll('input[data-autocomplete]').forEach(function (input) {
+  var list = document.getElementById(input.getAttribute('list'));
+  var latest = 0;
+  input.addEventListener('input', function () {
+    var request = ++latest;
+    if (!input.value.trim()) {
+      list.innerHTML = '';
+      return;
+    }
+    fetch(input.dataset.autocomplete + '&q=' + encodeURIComponent(input.value))
+      .then(function (resp) { return resp.json(); })
+      .then(function (body) {
+        // an answer to an older keystroke that arrived late
+        if (request !== latest) return;
+        list.innerHTML = '';
+        body.suggestions.forEach(function (suggestion) {
+          var option = document.createElement('option');
+          option.value = suggestion.name;
+          option.label = suggestion.kind;
+          list.appendChild(option);
+        });
+      });
+  });
+});
@@ -0,0 +1,223 @@
+"""
+Set based changes to a user's tags.
+
+Each operation is a fixed handful of statements however many books and tags it touches: one query checks that the
+user owns everything named, one statement changes the links, and the books whose links changed get their card
+versions bumped in one more.
+
+Tag names are shared by every user, so renaming a tag for one user moves their links to the tag with the new name,
+creating it if no one has used the name yet. Merging is the same move into a tag the user already has. The old tag
+stays for the other users who have it.
+"""
+from flask import Blueprint, flash, g, redirect, request
+from sqlalchemy import literal, select
+from sqlalchemy.dialects.postgresql import insert
+
+from autocomplete import get_prefix_indexes
+from models import db, UserBook, Tag, UserTag, UserBookTag
+
+tags = Blueprint('tags', __name__)
+
+# inserts tried for a tag the orphan collector keeps deleting before it can be read back
+CREATE_ATTEMPTS = 3
+
+
+class TagsNotCreated(RuntimeError):
+    """The tags were deleted again after every one of CREATE_ATTEMPTS inserts."""
+
+
+def owns_all(user_id, book_ids, tag_ids):
+    """Whether every book is in the user's collection and every tag in their tag list. One query."""
+
+    books = db.session.query(db.func.count())\
+        .select_from(UserBook)\
+        .filter(UserBook.user_id == user_id, UserBook.book_id.in_(book_ids))\
+        .scalar_subquery()
+    user_tags = db.session.query(db.func.count())\
+        .select_from(UserTag)\
+        .filter(UserTag.user_id == user_id, UserTag.tag_id.in_(tag_ids))\
+        .scalar_subquery()
+    return db.session.query(books, user_tags).one() == (len(book_ids), len(tag_ids))
+
+
+def apply_tags(user_id, book_ids, tag_ids):
+    """Put every tag on every book, skipping the pairs already there. Returns the ids of the books that changed."""
+
+    changed = db.session.execute(insert(UserBookTag.__table__)
+                                 .values([{'user_id': user_id, 'book_id': book_id, 'tag_id': tag_id}
+                                          for book_id in book_ids for tag_id in tag_ids])
+                                 .on_conflict_do_nothing()
+                                 .returning(UserBookTag.book_id))
+    return {book_id for book_id, in changed}
+
+
+def remove_tags(user_id, book_ids, tag_ids):
+    """Take every tag off every book. Returns the ids of the books that changed."""
+
+    changed = db.session.execute(UserBookTag.__table__.delete()
+                                 .where(UserBookTag.user_id == user_id)
+                                 .where(UserBookTag.book_id.in_(book_ids))
+                                 .where(UserBookTag.tag_id.in_(tag_ids))
+                                 .returning(UserBookTag.book_id))
+    return {book_id for book_id, in changed}
+
+
+def tag_ids_for(names):
+    """
+    {name: id} for the tag names, creating the ones no one has used yet. Safe against a concurrent create. The tags are
+    read FOR SHARE, so the orphan collector can't delete one before the caller's transaction links to it.
+    """
+
+    tag_ids = {}
+    # sorted, so requests creating the same tags lock them in the same order
+    missing = sorted(set(names))
+    # a tag that already existed can be collected as an orphan between the insert and the select, it's inserted again
+    for attempt in range(CREATE_ATTEMPTS):
+        if not missing:
+            break
+        db.session.execute(insert(Tag.__table__)
+                           .values([{'name': name} for name in missing])
+                           .on_conflict_do_nothing(index_elements=['name']))
+        tag_ids.update(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(missing)).with_for_update(read=True))
+        missing = [name for name in missing if name not in tag_ids]
+    if missing:
+        raise TagsNotCreated(f"tags deleted as soon as they were created: {', '.join(missing)}")
+    return tag_ids
+
+
+def add_user_tags(user_id, tag_ids):
+    """Put the tags on the user's tag list, skipping those already there. Returns the ids that were added."""
+
+    if not tag_ids:
+        return set()
+    added = db.session.execute(insert(UserTag.__table__)
+                               .values([{'user_id': user_id, 'tag_id': tag_id} for tag_id in tag_ids])
+                               .on_conflict_do_nothing()
+                               .returning(UserTag.tag_id))
+    return {tag_id for tag_id, in added}
+
+
+def move_tags(user_id, from_tag_ids, to_tag_id):
+    """
+    Move the user's books from the tags in `from_tag_ids` to `to_tag_id` and swap the tags in their tag list. Books
+    that already had the target keep a single link. Returns (ids of the books that changed, whether the user's list
+    gained the target).
+    """
+
+    from_tag_ids = [tag_id for tag_id in from_tag_ids if tag_id != to_tag_id]
+    if not from_tag_ids:
+        return set(), False
+
+    links = UserBookTag.__table__
+    db.session.execute(insert(links)
+                       .from_select(['user_id', 'book_id', 'tag_id'],
+                                    select(links.c.user_id, links.c.book_id, literal(to_tag_id))
+                                    .where(links.c.user_id == user_id, links.c.tag_id.in_(from_tag_ids))
+                                    .distinct())
+                       .on_conflict_do_nothing())
+    changed = db.session.execute(links.delete()
+                                 .where(links.c.user_id == user_id, links.c.tag_id.in_(from_tag_ids))
+                                 .returning(links.c.book_id))
+    added = add_user_tags(user_id, [to_tag_id])
+    db.session.query(UserTag)\
+        .filter(UserTag.user_id == user_id, UserTag.tag_id.in_(from_tag_ids))\
+        .delete(synchronize_session=False)
+    return {book_id for book_id, in changed}, bool(added)
+
+
+def finish_change(user, book_ids, tags_added=(), tags_removed=()):
+    """Bump the card versions of the changed books and the library version, commit, and update the user's index."""
+
+    user_id, version = user.id, user.library_version
+    if book_ids:
+        UserBook.bump_tag_version(user_id, list(book_ids))
+    user.bump_library_version()
+    db.session.commit()
+    get_prefix_indexes().changed(user_id, version, tags_added=tags_added, tags_removed=tags_removed)
+
+
+@tags.route('/users/<int:user_id>/books/tags', methods=['POST'])
+def bulk_tag(user_id):
+    """Add the selected tags to, or with action=remove take them off, the selected books in one transaction."""
+
+    if not g.user or g.user.id != user_id:
+        flash('You are not authorized.', 'danger')
+        return redirect('/')
+
+    back = f'/users/{user_id}/books'
+    book_ids = sorted(set(request.form.getlist('book_id', type=int)))
+    tag_ids = sorted(set(request.form.getlist('tag_id', type=int)))
+    if not book_ids or not tag_ids:
+        flash('Select at least one book and one tag.', 'danger')
+        return redirect(back)
+
+    if not owns_all(user_id, book_ids, tag_ids):
+        flash('Book or tag not found!', 'danger')
+        return redirect(back)
+
+    if request.form.get('action') == 'remove':
+        changed = remove_tags(user_id, book_ids, tag_ids)
+        message = f'Removed the tags from {len(changed)} books.'
+    else:
+        changed = apply_tags(user_id, book_ids, tag_ids)
+        message = f'Tagged {len(changed)} books.'
+    finish_change(g.user, changed)
+
+    flash(message, 'success')
+    return redirect(back)
+
+
+def user_tag_names(user_id, tag_ids):
+    """{tag id: name} of those of the tags in the user's tag list. One query."""
+
+    return dict(db.session.query(Tag.id, Tag.name)
+                .join(UserTag)
+                .filter(UserTag.user_id == user_id, Tag.id.in_(tag_ids)))
+
+
+@tags.route('/users/<int:user_id>/tags/<int:tag_id>/rename', methods=['POST'])
+def rename_tag(user_id, tag_id):
+    """Rename one of the user's tags. Renaming to a name already in their list merges the two."""
+
+    if not g.user or g.user.id != user_id:
+        flash('You are not authorized.', 'danger')
+        return redirect('/')
+
+    name = ' '.join((request.form.get('name') or '').split())
+    old_name = user_tag_names(user_id, [tag_id]).get(tag_id)
+    if old_name is None:
+        flash('Tag not found!', 'danger')
+        return redirect('/')
+    if not name:
+        flash('The new name is empty.', 'danger')
+        return redirect(f'/users/{user_id}/tags/{tag_id}')
+
+    new_tag_id = tag_ids_for([name])[name]
+    changed, added = move_tags(user_id, [tag_id], new_tag_id)
+    finish_change(g.user, changed, tags_added=[name] if added else [],
+                  tags_removed=[old_name] if new_tag_id != tag_id else [])
+
+    flash(f'Renamed {old_name} to {name}.', 'success')
+    return redirect(f'/users/{user_id}/tags/{new_tag_id}')
+
+
+@tags.route('/users/<int:user_id>/tags/merge', methods=['POST'])
+def merge_tags(user_id):
+    """Merge the tags in `tag_id` into the tag `into`, all of them the user's."""
+
+    if not g.user or g.user.id != user_id:
+        flash('You are not authorized.', 'danger')
+        return redirect('/')
+
+    into = request.form.get('into', type=int)
+    tag_ids = sorted(set(request.form.getlist('tag_id', type=int)) - {into})
+    names = user_tag_names(user_id, tag_ids + [into])
+    if into is None or not tag_ids or len(names) != len(tag_ids) + 1:
+        flash('Tag not found!', 'danger')
+        return redirect(f'/users/{user_id}/tags')
+
+    changed, added = move_tags(user_id, tag_ids, into)
+    finish_change(g.user, changed, tags_removed=[names[tag_id] for tag_id in tag_ids])
+
+    flash(f'Merged {len(tag_ids)} tags into {names[into]}.', 'success')
+    return redirect(f'/users/{user_id}/tags/{into}')
@@ -0,0 +1,184 @@
+"""JSON api tests."""
+import datetime
+import os
+from unittest import TestCase
+from models import db, User, Book, Author, BookAuthor, Subject, BookSubject, UserBook, Tag, UserTag, UserBookTag
+from isolation import clean_tables
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+
+class ApiTestCase(TestCase):
+    """Test the versioned JSON api."""
+
+    def setUp(self):
+        """Create a user with one tagged book in their collection."""
+
+        clean_tables(UserBookTag, UserTag, Tag, UserBook, BookAuthor, BookSubject, Author, Subject, Book, User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        other_user = User(username='other_user@nodomain.com', password='password2')
+        book = Book(
+            isbn="1111111111111",
+            open_library_id="abcd",
+            open_library_images={
+                "small": "small_url",
+                "medium": "medium_url",
+                "large": "large_url"
+            },
+            open_library_url="fake_url",
+            number_of_pages=42,
+            publish_date=datetime.datetime.strptime('1969-04-20', '%Y-%m-%d'),
+            title="epic fake book title"
+        )
+        book.authors.append(Author(name="Author The First"))
+        book.subjects.append(Subject(name="subject1"))
+        tag = Tag(name='test_tag')
+        db.session.add_all([user, other_user, book, tag])
+        db.session.commit()
+
+        db.session.add_all([
+            UserBook(user_id=user.id, book_id=book.id),
+            UserTag(user_id=user.id, tag_id=tag.id),
+            UserBookTag(user_id=user.id, book_id=book.id, tag_id=tag.id)
+        ])
+        db.session.commit()
+
+        # keep plain ids, the instances are detached once a test request tears down the session
+        self.user_id = user.id
+        self.other_user_id = other_user.id
+        self.book_id = book.id
+        self.tag_id = tag.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c):
+        with c.session_transaction() as s:
+            s[CURR_USER_KEY] = self.user_id
+
+    def test_user_books(self):
+        """The library lists the user's books with their authors and tags."""
+
+        with app.test_client() as c:
+            self.login(c)
+            resp = c.get(f'/api/v1/users/{self.user_id}/books')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {'books': [{
+                'id': self.book_id,
+                'isbn': '1111111111111',
+                'title': 'epic fake book title',
+                'cover': 'medium_url',
+                'authors': ['Author The First'],
+                'tags': [{'id': self.tag_id, 'name': 'test_tag'}]
+            }]})
+            self.assertTrue(resp.headers['ETag'])
+
+    def test_user_books_not_logged_in(self):
+        """Requests without a logged in user are rejected."""
+
+        with app.test_client() as c:
+            resp = c.get(f'/api/v1/users/{self.user_id}/books')
+
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(resp.json, {'error': 'You are not authorized.'})
+
+    def test_user_books_wrong_user(self):
+        """A user can not read another user's library."""
+
+        with app.test_client() as c:
+            self.login(c)
+            resp = c.get(f'/api/v1/users/{self.other_user_id}/books')
+
+            self.assertEqual(resp.status_code, 403)
+
+    def test_user_book_detail(self):
+        """The book detail includes the book's vocabulary and the user's tags."""
+
+        with app.test_client() as c:
+            self.login(c)
+            resp = c.get(f'/api/v1/users/{self.user_id}/books/{self.book_id}')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['publish_date'], '1969-04-20')
+            self.assertEqual(resp.json['authors'], ['Author The First'])
+            self.assertEqual(resp.json['subjects'], ['subject1'])
+            self.assertEqual(resp.json['publishers'], [])
+            self.assertTrue(resp.json['in_collection'])
+            self.assertEqual(resp.json['tags'], [{'id': self.tag_id, 'name': 'test_tag'}])
+
+    def test_user_book_detail_wrong_book(self):
+        """An unknown book is a 404."""
+
+        with app.test_client() as c:
+            self.login(c)
+            resp = c.get(f'/api/v1/users/{self.user_id}/books/{self.book_id + 1}')
+
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.json, {'error': 'Book not found!'})
+
+    def test_user_tags(self):
+        """The tags list counts the books each tag is applied to."""
+
+        with app.test_client() as c:
+            self.login(c)
+            resp = c.get(f'/api/v1/users/{self.user_id}/tags')
+
+            self.assertEqual(resp.json, {'tags': [{'id': self.tag_id, 'name': 'test_tag', 'book_count': 1}]})
+
+    def test_user_books_by_tag(self):
+        """The tag listing returns the books with that tag."""
+
+        with app.test_client() as c:
+            self.login(c)
+            resp = c.get(f'/api/v1/users/{self.user_id}/tags/{self.tag_id}/books')
+
+            self.assertEqual(resp.json['tag'], {'id': self.tag_id, 'name': 'test_tag'})
+            self.assertEqual([book['id'] for book in resp.json['books']], [self.book_id])
+
+    def test_user_books_by_tag_wrong_tag(self):
+        """A tag the user has not created is a 404."""
+
+        with app.test_client() as c:
+            self.login(c)
+            resp = c.get(f'/api/v1/users/{self.user_id}/tags/{self.tag_id + 1}/books')
+
+            self.assertEqual(resp.status_code, 404)
+
+    def test_if_none_match(self):
+        """A matching If-None-Match returns 304 until the library changes."""
+
+        with app.test_client() as c:
+            self.login(c)
+            etag = c.get(f'/api/v1/users/{self.user_id}/tags').headers['ETag']
+
+            resp = c.get(f'/api/v1/users/{self.user_id}/tags', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+            self.assertEqual(resp.headers['ETag'], etag)
+
+            c.post(f'/users/{self.user_id}/books/{self.book_id}/tag/{self.tag_id}/delete')
+
+            resp = c.get(f'/api/v1/users/{self.user_id}/tags', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            self.assertEqual(resp.json['tags'][0]['book_count'], 0)
+
+    def test_if_none_match_missing(self):
+        """Another resource's ETag doesn't turn a missing book or tag into a 304."""
+
+        with app.test_client() as c:
+            self.login(c)
+            etag = c.get(f'/api/v1/users/{self.user_id}/books/{self.book_id}').headers['ETag']
+
+            resp = c.get(f'/api/v1/users/{self.user_id}/books/{self.book_id + 1}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.get(f'/api/v1/users/{self.user_id}/tags/{self.tag_id + 1}/books', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 404)
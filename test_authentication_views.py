@@ -5,9 +5,10 @@ from unittest import TestCase
 from flask import g
 
 from models import db, User
+from isolation import clean_tables
 
-os.environ['DATABASE_URL'] = "postgres:///personal_library_test"
-os.environ['FLASK_ENV'] = "production"
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
 
 from app import app, CURR_USER_KEY, do_login, do_logout
 
@@ -20,7 +21,7 @@ class AuthenticationViewTestCase(TestCase):
     """Tests for authentication views."""
 
     def setUp(self):
-        User.query.delete()
+        clean_tables(User)
 
         # provide a test user to login for tests requiring a logged in user
         user = User(username='test_user@nodomain.com', password='password1')
@@ -0,0 +1,131 @@
+"""Autocomplete tests."""
+import os
+import time
+from unittest import TestCase
+from models import db, User, Book, Author, BookAuthor, UserBook, Tag, UserTag, UserBookTag
+from isolation import clean_tables
+from query_budget import QueryBudgetMixin
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+from autocomplete import PrefixIndex
+
+db.create_all()
+
+
+class PrefixIndexTestCase(TestCase):
+    """Test the in-memory index."""
+
+    def setUp(self):
+        self.index = PrefixIndex.build(1, [
+            ('title', 'The Hobbit', 1),
+            ('title', 'The Fellowship of the Ring', 1),
+            ('author', 'J. R. R. Tolkien', 2),
+            ('tag', 'fantasy', 1),
+        ])
+
+    def test_word_prefixes(self):
+        """Any word of a name can start a match, case doesn't matter."""
+
+        self.assertEqual(self.index.search('tolk'), [('author', 'J. R. R. Tolkien')])
+        self.assertEqual(self.index.search('THE'), [('title', 'The Fellowship of the Ring'), ('title', 'The Hobbit')])
+        self.assertEqual(self.index.search('ring'), [('title', 'The Fellowship of the Ring')])
+        self.assertEqual(self.index.search('  '), [])
+
+    def test_kinds_and_limit(self):
+        self.assertEqual(self.index.search('f', kinds=('tag',)), [('tag', 'fantasy')])
+        self.assertEqual(len(self.index.search('the', limit=1)), 1)
+
+    def test_add_remove(self):
+        """A name shared by several books stays until the last of them goes."""
+
+        self.index.add('title', 'The Two Towers')
+        self.assertIn(('title', 'The Two Towers'), self.index.search('two'))
+
+        self.index.remove('author', 'J. R. R. Tolkien')
+        self.assertEqual(self.index.search('tolk'), [('author', 'J. R. R. Tolkien')])
+        self.index.remove('author', 'J. R. R. Tolkien')
+        self.assertEqual(self.index.search('tolk'), [])
+
+
+class AutocompleteViewTestCase(QueryBudgetMixin, TestCase):
+    """Test the suggestions endpoint and keeping it current through the write routes."""
+
+    def setUp(self):
+        clean_tables(UserBookTag, UserTag, Tag, UserBook, BookAuthor, Author, Book, User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        book = Book(isbn='1111111111111', open_library_id='abcd', title='The Hobbit')
+        book.authors.append(Author(name='J. R. R. Tolkien'))
+        tag = Tag(name='fantasy')
+        db.session.add_all([user, book, tag])
+        db.session.commit()
+        db.session.add_all([UserBook(user_id=user.id, book_id=book.id), UserTag(user_id=user.id, tag_id=tag.id)])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.book_id = book.id
+        self.tag_id = tag.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def client(self):
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = self.user_id
+        return client
+
+    def suggest(self, client, query):
+        resp = client.get(f'/users/{self.user_id}/autocomplete?q={query}')
+        return [(suggestion['kind'], suggestion['name']) for suggestion in resp.json['suggestions']]
+
+    def test_suggestions(self):
+        """The index is built once, later keystrokes only load the user."""
+
+        client = self.client()
+        self.assertEqual(self.suggest(client, 'hob'), [('title', 'The Hobbit')])
+
+        with self.assertMaxQueries(1):
+            start = time.perf_counter()
+            self.assertEqual(self.suggest(client, 'f'), [('tag', 'fantasy')])
+            elapsed = time.perf_counter() - start
+        # the in-memory part, most of the request is the user query and flask
+        self.assertLess(elapsed, 0.05)
+
+    def test_updated_on_writes(self):
+        """Tags and books added or removed by this worker are patched in without a rebuild."""
+
+        client = self.client()
+        self.suggest(client, 'hob')
+
+        client.post(f'/users/{self.user_id}/tag', data={'tag': 'favorites'})
+        client.post(f'/users/{self.user_id}/books/{self.book_id}/delete')
+
+        # one user query per request
+        with self.assertMaxQueries(2):
+            self.assertEqual(self.suggest(client, 'f'), [('tag', 'fantasy'), ('tag', 'favorites')])
+            self.assertEqual(self.suggest(client, 'hob'), [])
+
+    def test_rebuilt_after_other_changes(self):
+        """A change the index didn't see moves the library version on, and the next request rebuilds it."""
+
+        client = self.client()
+        self.suggest(client, 'hob')
+
+        user = User.query.get(self.user_id)
+        tag = Tag(name='history')
+        db.session.add(tag)
+        db.session.flush()
+        db.session.add(UserTag(user_id=self.user_id, tag_id=tag.id))
+        user.bump_library_version()
+        db.session.commit()
+
+        self.assertEqual(self.suggest(client, 'h'), [('tag', 'history'), ('title', 'The Hobbit')])
+
+    def test_wrong_user(self):
+        resp = self.client().get(f'/users/{self.user_id + 1}/autocomplete?q=a')
+
+        self.assertEqual(resp.status_code, 403)
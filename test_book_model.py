@@ -4,9 +4,10 @@ import os
 from unittest import TestCase
 from models import db, Book, Author, Publisher, Subject, SubjectPlace, SubjectPerson, SubjectTime, BookAuthor, \
     BookPublisher, BookSubject, BookSubjectPlace, BookSubjectPerson, BookSubjectTime
+from isolation import clean_tables
 
-os.environ['DATABASE_URL'] = "postgres:///personal_library_test"
-os.environ['FLASK_ENV'] = "production"
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
 
 from app import app
 
@@ -19,19 +20,8 @@ class BookModelTestCase(TestCase):
     def setUp(self):
         """Create sample book data."""
 
-        Book.query.delete()
-        Author.query.delete()
-        Publisher.query.delete()
-        Subject.query.delete()
-        SubjectPlace.query.delete()
-        SubjectPerson.query.delete()
-        SubjectTime.query.delete()
-        BookAuthor.query.delete()
-        BookPublisher.query.delete()
-        BookSubject.query.delete()
-        BookSubjectPlace.query.delete()
-        BookSubjectPerson.query.delete()
-        BookSubjectTime.query.delete()
+        clean_tables(Book, Author, Publisher, Subject, SubjectPlace, SubjectPerson, SubjectTime, BookAuthor,
+                     BookPublisher, BookSubject, BookSubjectPlace, BookSubjectPerson, BookSubjectTime)
 
         book = Book(
             isbn="1111111111111",
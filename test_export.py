@@ -0,0 +1,117 @@
+"""Library export tests."""
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from models import db, User, Book, Author, BookAuthor, Publisher, BookPublisher, Subject, BookSubject, UserBook, Tag, \
+    UserTag, UserBookTag
+from isolation import clean_tables
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+
+class ExportTestCase(TestCase):
+    """Test the CSV and JSON Lines backups."""
+
+    def setUp(self):
+        clean_tables(UserBookTag, UserTag, Tag, UserBook, BookAuthor, BookPublisher, BookSubject, Author, Publisher,
+                     Subject, Book, User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        books = [
+            Book(
+                isbn=f"111111111111{i}",
+                open_library_id="abcd",
+                open_library_images={"small": "small_url", "medium": "medium_url", "large": "large_url"},
+                open_library_url="fake_url",
+                number_of_pages=42,
+                publish_date=datetime.date(1969, 4, 20),
+                title=title
+            )
+            for i, title in enumerate(['b, with a comma', 'a plain title'])
+        ]
+        books[0].authors.extend([Author(name='Second Author'), Author(name='First Author')])
+        books[0].publishers.append(Publisher(name='Publishing House'))
+        books[0].subjects.append(Subject(name='subject1'))
+        tags = [Tag(name='to-read'), Tag(name='favorites')]
+        db.session.add_all([user] + books + tags)
+        db.session.commit()
+
+        db.session.add_all([UserBook(user_id=user.id, book_id=book.id) for book in books])
+        db.session.add_all([UserTag(user_id=user.id, tag_id=tag.id) for tag in tags])
+        db.session.add_all([UserBookTag(user_id=user.id, book_id=books[0].id, tag_id=tag.id) for tag in tags])
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get(self, url, **kwargs):
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.user_id
+            # read the stream while the request, and its cursor, are still open
+            return client.get(url, buffered=True, **kwargs)
+
+    def test_csv(self):
+        """One row per book ordered by title, lists joined in the cell."""
+
+        resp = self.get(f'/users/{self.user_id}/export.csv')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertIn('attachment', resp.headers['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual([row['title'] for row in rows], ['a plain title', 'b, with a comma'])
+        self.assertEqual(rows[1]['authors'], 'First Author; Second Author')
+        self.assertEqual(rows[1]['publishers'], 'Publishing House')
+        self.assertEqual(rows[1]['tags'], 'favorites; to-read')
+        self.assertEqual(rows[0]['tags'], '')
+
+    def test_jsonl(self):
+        """One JSON object per line, written a batch at a time."""
+
+        with patch('export.EXPORT_BATCH', 1):
+            resp = self.get(f'/users/{self.user_id}/export.jsonl')
+
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1], {
+            'isbn': '1111111111110',
+            'title': 'b, with a comma',
+            'authors': ['First Author', 'Second Author'],
+            'publishers': ['Publishing House'],
+            'subjects': ['subject1'],
+            'tags': ['favorites', 'to-read']
+        })
+
+    def test_gzip(self):
+        """Clients that accept gzip get the export compressed."""
+
+        plain = self.get(f'/users/{self.user_id}/export.csv').get_data()
+        resp = self.get(f'/users/{self.user_id}/export.csv', headers={'Accept-Encoding': 'gzip, deflate'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.get_data()), plain)
+
+        # gzip with a quality of 0 is a refusal
+        resp = self.get(f'/users/{self.user_id}/export.csv', headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.get_data(), plain)
+
+    def test_export_wrong_user(self):
+        """Only the owner can export a library."""
+
+        resp = self.get(f'/users/{self.user_id + 1}/export.csv')
+
+        self.assertEqual(resp.status_code, 302)
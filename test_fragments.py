@@ -0,0 +1,148 @@
+"""Cache and book card fragment tests."""
+import datetime
+import os
+import tempfile
+from unittest import TestCase
+from models import db, User, Book, UserBook, Tag, UserTag, UserBookTag
+from isolation import clean_tables
+from cache import LocalCache, SQLiteCache
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+from fragments import book_card_key
+
+db.create_all()
+
+
+class CacheTestCase(TestCase):
+    """Test the cache backends."""
+
+    def check_lru(self, cache):
+        cache.set('a', '1')
+        cache.set('b', '2')
+        # reading a makes b the least recently used entry
+        self.assertEqual(cache.get('a'), '1')
+        cache.set('c', '3')
+
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': '1', 'c': '3'})
+        self.assertEqual(len(cache), 2)
+
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_local_cache(self):
+        """The local cache evicts the least recently used entry."""
+
+        self.check_lru(LocalCache(max_entries=2))
+
+    def test_sqlite_cache(self):
+        """The sqlite cache evicts the least recently used entry."""
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_lru(SQLiteCache(os.path.join(directory, 'cache.sqlite3'), max_entries=2))
+
+
+class BookCardTestCase(TestCase):
+    """Test the cached book cards on the library page."""
+
+    def setUp(self):
+        clean_tables(UserBookTag, UserTag, Tag, UserBook, Book, User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        books = [
+            Book(
+                isbn=f"111111111111{i}",
+                open_library_id="abcd",
+                open_library_images={"medium": f"medium_url_{i}"},
+                publish_date=datetime.datetime.strptime('1969-04-20', '%Y-%m-%d'),
+                title=f"epic fake book title {i}"
+            )
+            for i in range(2)
+        ]
+        tag = Tag(name='test_tag')
+        db.session.add_all([user, tag] + books)
+        db.session.commit()
+
+        db.session.add_all([UserBook(user_id=user.id, book_id=book.id) for book in books])
+        db.session.add(UserTag(user_id=user.id, tag_id=tag.id))
+        db.session.commit()
+
+        self.user_id = user.id
+        self.book_ids = [book.id for book in books]
+        self.tag_id = tag.id
+
+        self.cache = app.extensions['fragment_cache']
+        self.cache.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_cards_cached(self):
+        """Each card is rendered once and then served from the cache."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as s:
+                s[CURR_USER_KEY] = self.user_id
+
+            first = c.get(f'/users/{self.user_id}/books').get_data(as_text=True)
+            self.assertIn(book_card_key(self.user_id, self.book_ids[0], 0, 0), self.cache.get_many(
+                [book_card_key(self.user_id, book_id, 0, 0) for book_id in self.book_ids]))
+            self.assertEqual(len(self.cache), 2)
+
+            second = c.get(f'/users/{self.user_id}/books').get_data(as_text=True)
+            self.assertEqual(first, second)
+            self.assertIn("epic fake book title 1", second)
+
+    def test_tagging_rerenders_only_affected_card(self):
+        """Adding a tag to a book changes the key of that book's card and no other."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as s:
+                s[CURR_USER_KEY] = self.user_id
+
+            c.get(f'/users/{self.user_id}/books')
+            c.post(f'/users/{self.user_id}/books/{self.book_ids[0]}/tag/{self.tag_id}')
+            html = c.get(f'/users/{self.user_id}/books').get_data(as_text=True)
+
+            self.assertIn(f'href="/users/{self.user_id}/tags/{self.tag_id}">test_tag</a>', html)
+            cached = self.cache.get_many([
+                book_card_key(self.user_id, self.book_ids[0], 0, 1),
+                book_card_key(self.user_id, self.book_ids[1], 0, 0)
+            ])
+            self.assertEqual(len(cached), 2)
+            # the untouched card was not rendered a second time
+            self.assertEqual(len(self.cache), 3)
+
+            c.post(f'/users/{self.user_id}/tag/{self.tag_id}/delete')
+            html = c.get(f'/users/{self.user_id}/books').get_data(as_text=True)
+
+            self.assertNotIn('test_tag</a>', html)
+            self.assertIsNotNone(self.cache.get(book_card_key(self.user_id, self.book_ids[0], 0, 2)))
+
+    def test_book_added_again(self):
+        """A book removed and added again starts from new card keys, the cards cached before don't come back."""
+
+        other_tag = Tag(name='other_tag')
+        db.session.add(other_tag)
+        db.session.commit()
+        other_tag_id = other_tag.id
+        db.session.add(UserTag(user_id=self.user_id, tag_id=other_tag_id))
+        db.session.commit()
+        book_id = self.book_ids[0]
+
+        with app.test_client() as c:
+            with c.session_transaction() as s:
+                s[CURR_USER_KEY] = self.user_id
+
+            c.post(f'/users/{self.user_id}/books/{book_id}/tag/{self.tag_id}')
+            self.assertIn('test_tag</a>', c.get(f'/users/{self.user_id}/books').get_data(as_text=True))
+
+            c.post(f'/users/{self.user_id}/books/{book_id}/delete')
+            c.post(f'/users/{self.user_id}/books/{book_id}')
+            c.post(f'/users/{self.user_id}/books/{book_id}/tag/{other_tag_id}')
+            html = c.get(f'/users/{self.user_id}/books').get_data(as_text=True)
+
+        self.assertIn('other_tag</a>', html)
+        self.assertNotIn('test_tag</a>', html)
@@ -0,0 +1,167 @@
+"""Goodreads and LibraryThing import tests."""
+import io
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from models import db, User, Book, Author, BookAuthor, UserBook, Tag, UserTag, UserBookTag, LibraryImport, \
+    LibraryImportRow
+from isolation import clean_tables
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+from imports import parse_export
+
+db.create_all()
+
+GOODREADS = '''Book Id,Title,Author,ISBN,ISBN13,My Rating,Bookshelves,Exclusive Shelf,My Review
+1,In The Library,Some Author,"=""1111111111""","=""9781111111111""",5,"favorites, sci-fi",read,"Loved it,
+over two lines"
+2,Open Library Only,Other Author,"=""""","=""9782222222222""",0,,to-read,
+3,Nobody Knows,Nobody,"=""3333333333""","=""""",0,sci-fi,to-read,
+4,No Isbn,Nobody,"=""""","=""""",0,,read,
+'''
+
+LIBRARYTHING = 'Book Id\tTitle\tPrimary Author\tISBN\tISBNs\tTags\tCollections\n' \
+    '7\tA Title\tAn Author\t[0439023483]\t9780439023481, 0439023483\tfantasy, owned\tYour library\n'
+
+
+def open_library_data(isbns):
+    """What Open Library knows, which is only 9782222222222."""
+
+    return {
+        f'ISBN:{isbn}': {
+            'key': '/books/OL2M',
+            'url': 'fake_url',
+            'title': 'Open Library Only',
+            'publish_date': 'June 2001',
+            'authors': [{'name': 'Other Author'}]
+        }
+        for isbn in isbns if isbn == '9782222222222'
+    }
+
+
+class ImportTestCase(TestCase):
+    """Test reading exports and adding them to a library."""
+
+    def setUp(self):
+        clean_tables(LibraryImportRow, LibraryImport, UserBookTag, UserTag, Tag, UserBook, BookAuthor, Author, Book,
+                     User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        book = Book(isbn='9781111111111', open_library_id='/books/OL1M', title='In The Library')
+        favorites = Tag(name='favorites')
+        db.session.add_all([user, book, favorites])
+        db.session.commit()
+        # already has the book, and the tag from another import
+        db.session.add_all([UserBook(user_id=user.id, book_id=book.id), UserTag(user_id=user.id, tag_id=favorites.id)])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.book_id = book.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def upload(self, text, filename='goodreads_library_export.csv'):
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.user_id
+            return client.post(f'/users/{self.user_id}/imports',
+                               data={'file': (io.BytesIO(text.encode()), filename)},
+                               content_type='multipart/form-data')
+
+    def test_parse_goodreads(self):
+        """Isbns lose Goodreads' spreadsheet quoting, the exclusive shelf comes first."""
+
+        source, books = parse_export(io.StringIO(GOODREADS, newline=''))
+
+        self.assertEqual(source, 'goodreads')
+        self.assertEqual(list(books), [
+            (['9781111111111', '1111111111'], ['read', 'favorites', 'sci-fi']),
+            (['9782222222222'], ['to-read']),
+            (['3333333333'], ['to-read', 'sci-fi']),
+            ([], ['read'])
+        ])
+
+    def test_parse_librarything(self):
+        """Tab separated LibraryThing exports, tags become shelves."""
+
+        source, books = parse_export(io.StringIO(LIBRARYTHING))
+
+        self.assertEqual(source, 'librarything')
+        self.assertEqual(list(books), [(['0439023483', '9780439023481'], ['fantasy', 'owned'])])
+
+    def test_import(self):
+        """Local books are used as they are, only the missing isbns go to Open Library, shelves become tags."""
+
+        with patch('imports.lookup_isbns_open_library', side_effect=open_library_data) as lookup, \
+                patch('imports.queue_refresh') as queue_refresh:
+            resp = self.upload(GOODREADS)
+
+        library_import = LibraryImport.query.one()
+        self.assertEqual(resp.status_code, 302)
+        # the fetched book is scored for "more like this"
+        queue_refresh.assert_called_once_with()
+        self.assertEqual(resp.location, f'http://localhost/users/{self.user_id}/imports/{library_import.id}')
+        lookup.assert_called_once_with(['9782222222222', '3333333333'])
+
+        self.assertEqual((library_import.status, library_import.total, library_import.done), ('done', 4, 4))
+        self.assertEqual((library_import.imported, library_import.not_found), (2, 1))
+
+        fetched = Book.query.filter_by(isbn='9782222222222').one()
+        self.assertEqual(fetched.get_authors(), 'Other Author')
+        self.assertEqual({user_book.book_id for user_book in UserBook.query.filter_by(user_id=self.user_id)},
+                         {self.book_id, fetched.id})
+        user = User.query.get(self.user_id)
+        self.assertEqual(sorted(tag.name for tag in user.tags), ['favorites', 'read', 'sci-fi', 'to-read'])
+        self.assertEqual(sorted(tag.name for tag in Book.query.get(self.book_id).get_user_book_tags(self.user_id)),
+                         ['favorites', 'read', 'sci-fi'])
+        self.assertGreater(user.library_version, 0)
+
+    def test_resume(self):
+        """An import that fails partway keeps the batches it finished and carries on from there."""
+
+        with patch('imports.IMPORT_BATCH', 1), \
+                patch('imports.lookup_isbns_open_library', side_effect=ConnectionError('Open Library is down')):
+            self.upload(GOODREADS)
+
+        library_import = LibraryImport.query.one()
+        import_id = library_import.id
+        self.assertEqual(library_import.status, 'failed')
+        self.assertEqual(library_import.error, 'Open Library is down')
+        # the local book, and the row without an isbn
+        self.assertEqual(library_import.done, 2)
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.user_id
+            page = client.get(f'/users/{self.user_id}/imports/{import_id}')
+            self.assertIn(b'Resume', page.data)
+            with patch('imports.lookup_isbns_open_library', side_effect=open_library_data) as lookup:
+                client.post(f'/users/{self.user_id}/imports/{import_id}/resume')
+
+        lookup.assert_called_once_with(['9782222222222', '3333333333'])
+        library_import = LibraryImport.query.get(import_id)
+        self.assertEqual((library_import.status, library_import.done, library_import.imported), ('done', 4, 2))
+        self.assertEqual(UserBook.query.filter_by(user_id=self.user_id).count(), 2)
+
+    def test_not_an_export(self):
+        """Files from anywhere else are turned away before anything is saved."""
+
+        resp = self.upload('isbn,title\n1111111111,A Book\n', 'books.csv')
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(LibraryImport.query.count(), 0)
+
+    def test_import_wrong_user(self):
+        """Only the owner can import into a library."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.user_id
+            resp = client.get(f'/users/{self.user_id + 1}/imports')
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, 'http://localhost/')
@@ -0,0 +1,175 @@
+"""Invalidation bus and user cache tests."""
+import json
+import os
+import time
+from unittest import TestCase
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
+from models import db, User
+from isolation import clean_tables
+from query_budget import count_queries
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+from invalidation import CHANNEL, InvalidationBus, connect_to
+from user_cache import get_user_cache
+
+db.create_all()
+
+
+class RecordingCache:
+    """A subscriber that remembers what it was told."""
+
+    def __init__(self):
+        self.invalidated = []
+        self.clears = 0
+
+    def invalidate(self, name):
+        self.invalidated.append(name)
+
+    def clear(self):
+        self.clears += 1
+
+
+class UserCacheTestCase(TestCase):
+    """Test that requests find the logged in user in the cache until the user's row changes."""
+
+    def setUp(self):
+        clean_tables(User)
+        user = User(username='test_user@nodomain.com', password='password1')
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def cached(self):
+        with app.app_context():
+            return get_user_cache().get(self.user_id)
+
+    def test_cached_user(self):
+        self.client.get(f'/users/{self.user_id}/tags')
+
+        with count_queries() as statements:
+            self.client.get(f'/users/{self.user_id}/tags')
+
+        self.assertFalse(any(statement.startswith('SELECT users.id') for statement in statements))
+        self.assertEqual(self.cached()['username'], 'test_user@nodomain.com')
+
+    def test_change_invalidates(self):
+        """A committed change drops the cached user, a rolled back one doesn't."""
+
+        self.client.get(f'/users/{self.user_id}/tags')
+        with app.app_context():
+            User.query.get(self.user_id).bump_library_version()
+            db.session.flush()
+            db.session.rollback()
+            self.assertIsNotNone(get_user_cache().get(self.user_id))
+
+            User.query.get(self.user_id).bump_library_version()
+            db.session.commit()
+            self.assertIsNone(get_user_cache().get(self.user_id))
+
+        self.client.get(f'/users/{self.user_id}/tags')
+        self.assertIsNotNone(self.cached())
+
+    def test_library_version_not_cached(self):
+        """A version bump this worker never heard of still reaches the caches keyed on it."""
+
+        self.client.get(f'/api/v1/users/{self.user_id}/tags')
+        # another worker's write, whose notification hasn't arrived
+        db.session.execute(text('UPDATE users SET library_version = 7 WHERE id = :id'), {'id': self.user_id})
+        db.session.commit()
+
+        self.assertNotIn('library_version', self.cached())
+        resp = self.client.get(f'/api/v1/users/{self.user_id}/tags')
+        self.assertIn(f'-{self.user_id}-7', resp.headers['ETag'])
+
+    def test_ttl(self):
+        self.client.get(f'/users/{self.user_id}/tags')
+        with app.app_context():
+            cache = get_user_cache()
+            ttl, cache.ttl = cache.ttl, -1
+            try:
+                self.assertIsNone(cache.get(self.user_id))
+            finally:
+                cache.ttl = ttl
+
+    def test_raced_load_not_kept(self):
+        """A load that started before an invalidation may hold the old row."""
+
+        with app.app_context():
+            cache = get_user_cache()
+            generation = cache.generation
+            cache.invalidate(str(self.user_id))
+            cache.set(self.user_id, {'id': self.user_id}, generation)
+            self.assertIsNone(cache.get(self.user_id))
+
+
+class ListenerTestCase(TestCase):
+    """Test the listener against notifications committed on another connection."""
+
+    def setUp(self):
+        self.engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'], isolation_level='AUTOCOMMIT')
+        self.bus = InvalidationBus()
+        self.cache = RecordingCache()
+        self.bus.subscribe('user', self.cache)
+        self.bus.start(lambda: connect_to(self.engine))
+
+    def tearDown(self):
+        self.bus.stop()
+        self.engine.dispose()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'timed out')
+            time.sleep(0.01)
+
+    def notify(self, payload):
+        with self.engine.connect() as conn:
+            conn.execute('SELECT pg_notify(%s, %s)', (CHANNEL, payload))
+
+    def test_delivery(self):
+        """Connecting clears the subscribers, then keys reach the subscribers of their kind."""
+
+        self.wait_for(lambda: self.cache.clears)
+        received = REGISTRY.get_sample_value('invalidations_received_total', {'kind': 'user', 'source': 'notify'}) or 0
+
+        self.notify('not json')
+        self.notify(json.dumps({'key': 'book:1', 'sent': time.time()}))
+        self.notify(json.dumps({'key': 'user:42', 'sent': time.time()}))
+
+        self.wait_for(lambda: self.cache.invalidated)
+        self.assertEqual(self.cache.invalidated, ['42'])
+        self.assertEqual(REGISTRY.get_sample_value('invalidations_received_total',
+                                                   {'kind': 'user', 'source': 'notify'}), received + 1)
+
+    def test_users_trigger(self):
+        """Any statement changing a users row notifies, once it commits."""
+
+        self.wait_for(lambda: self.cache.clears)
+        with self.engine.connect() as conn:
+            user_id = conn.execute("INSERT INTO users (username, password) "
+                                   "VALUES ('trigger@nodomain.com', 'password1') RETURNING id").scalar()
+            transactional = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+            with transactional.connect() as other:
+                transaction = other.begin()
+                other.execute('UPDATE users SET library_version = library_version + 1 WHERE id = %s', (user_id,))
+                transaction.rollback()
+            transactional.dispose()
+            conn.execute('UPDATE users SET library_version = library_version + 1 WHERE id = %s', (user_id,))
+            conn.execute('DELETE FROM users WHERE id = %s', (user_id,))
+
+        # notifications arrive in commit order, everything sent before this one is in
+        self.notify(json.dumps({'key': 'user:end', 'sent': time.time()}))
+
+        self.wait_for(lambda: 'end' in self.cache.invalidated)
+        self.assertEqual(self.cache.invalidated, [str(user_id), str(user_id), 'end'])
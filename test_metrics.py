@@ -0,0 +1,84 @@
+"""Request metrics tests."""
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from flask import g
+from prometheus_client import REGISTRY
+from models import db, User, UserBook, UserTag, UserBookTag
+from isolation import clean_tables
+from metrics import open_library_call
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+
+def sample(name, endpoint):
+    return REGISTRY.get_sample_value(name, {'endpoint': endpoint}) or 0
+
+
+class MetricsTestCase(TestCase):
+    """Test the per request histograms and the /metrics endpoint."""
+
+    def setUp(self):
+        clean_tables(UserBookTag, UserTag, UserBook, User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_request_records_sql(self):
+        """A page view observes its wall time, statement count and database time under its endpoint."""
+
+        endpoint = 'library.user_books'
+        requests_before = sample('request_seconds_count', endpoint)
+        statements_before = sample('request_sql_statements_sum', endpoint)
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.user_id
+            resp = client.get(f'/users/{self.user_id}/books')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sample('request_seconds_count', endpoint), requests_before + 1)
+        # loading the user and their books at least
+        self.assertGreaterEqual(sample('request_sql_statements_sum', endpoint), statements_before + 2)
+        self.assertEqual(REGISTRY.get_sample_value('requests_total', {'endpoint': endpoint, 'status': '200'}),
+                         sample('request_seconds_count', endpoint))
+
+    def test_open_library_calls(self):
+        """Open Library calls are counted against the request and failed calls are labelled as errors."""
+
+        labels = {'endpoint': 'library.search_isbn', 'outcome': 'error'}
+        errors_before = REGISTRY.get_sample_value('open_library_seconds_count', labels) or 0
+
+        with app.test_request_context('/books/search', method='POST'):
+            app.preprocess_request()
+            with open_library_call():
+                pass
+            with self.assertRaises(ValueError):
+                with open_library_call():
+                    raise ValueError('timed out')
+            self.assertEqual(g.request_metrics.open_library_calls, 2)
+
+        self.assertEqual(REGISTRY.get_sample_value('open_library_seconds_count', labels), errors_before + 1)
+
+    def test_metrics_endpoint(self):
+        """/metrics serves the text format, and asks for the token when one is configured."""
+
+        with app.test_client() as client:
+            resp = client.get('/metrics')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'# TYPE request_sql_statements histogram', resp.data)
+
+            with patch.dict(app.config, {'METRICS_TOKEN': 'scrape'}):
+                self.assertEqual(client.get('/metrics').status_code, 401)
+                resp = client.get('/metrics', headers={'Authorization': 'Bearer scrape'})
+                self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,79 @@
+"""Orphan collection tests."""
+import os
+from unittest import TestCase
+from prometheus_client import REGISTRY
+from models import db, User, Book, Author, BookAuthor, Publisher, BookPublisher, Subject, BookSubject, SubjectPlace, \
+    BookSubjectPlace, SubjectPerson, BookSubjectPerson, SubjectTime, BookSubjectTime, Tag, UserTag, UserBookTag, UserBook
+from isolation import clean_tables
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app
+import orphans
+from orphans import collect_orphans
+
+db.create_all()
+
+
+class CollectOrphansTestCase(TestCase):
+    """Test finding and deleting the rows nothing links to."""
+
+    def setUp(self):
+        clean_tables(UserBookTag, UserTag, Tag, UserBook, BookAuthor, Author, BookPublisher, Publisher, BookSubject,
+                     Subject, BookSubjectPlace, SubjectPlace, BookSubjectPerson, SubjectPerson, BookSubjectTime,
+                     SubjectTime, Book, User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        book = Book(isbn='1111111111111', open_library_id='abcd', title='The Hobbit')
+        book.authors.append(Author(name='J. R. R. Tolkien'))
+        book.subjects.append(Subject(name='Fantasy'))
+        listed, on_book = Tag(name='listed'), Tag(name='on a book')
+        db.session.add_all([user, book, listed, on_book, Tag(name='orphan tag'), Author(name='Orphan author'),
+                            Publisher(name='Orphan publisher'), Subject(name='Orphan subject')])
+        db.session.commit()
+        # users_books_tags rows only exist with the users_tags row in the app, either one keeps a tag
+        db.session.add_all([UserBook(user_id=user.id, book_id=book.id), UserTag(user_id=user.id, tag_id=listed.id),
+                            UserBookTag(user_id=user.id, book_id=book.id, tag_id=on_book.id)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def names(self, model):
+        return sorted(name for name, in db.session.query(model.name))
+
+    def test_dry_run(self):
+        reports = collect_orphans(dry_run=True)
+
+        self.assertEqual({table: report.found for table, report in reports.items()}, {
+            'tags': 1, 'authors': 1, 'publishers': 1, 'subjects': 1,
+            'subject_places': 0, 'subject_people': 0, 'subject_times': 0,
+        })
+        self.assertTrue(all(report.complete and not report.deleted for report in reports.values()))
+        self.assertEqual(self.names(Tag), ['listed', 'on a book', 'orphan tag'])
+
+    def test_collect(self):
+        """Orphans go in batches, everything with a link stays, and the deletions are counted."""
+
+        deleted_before = REGISTRY.get_sample_value('orphans_deleted_total', {'table': 'tags'}) or 0
+        batch, orphans.SCAN_BATCH = orphans.SCAN_BATCH, 1
+        try:
+            reports = collect_orphans()
+        finally:
+            orphans.SCAN_BATCH = batch
+
+        self.assertEqual(reports['tags'], orphans.OrphanReport(found=1, deleted=1, scanned=3, complete=True))
+        self.assertEqual(self.names(Tag), ['listed', 'on a book'])
+        self.assertEqual(self.names(Author), ['J. R. R. Tolkien'])
+        self.assertEqual(self.names(Publisher), [])
+        self.assertEqual(self.names(Subject), ['Fantasy'])
+        self.assertEqual(REGISTRY.get_sample_value('orphans_deleted_total', {'table': 'tags'}), deleted_before + 1)
+
+    def test_budget(self):
+        """A spent budget stops before deleting anything and says the tables weren't finished."""
+
+        reports = collect_orphans(budget_seconds=0)
+
+        self.assertFalse(any(report.complete for report in reports.values()))
+        self.assertEqual(self.names(Tag), ['listed', 'on a book', 'orphan tag'])
@@ -0,0 +1,109 @@
+"""Table partitioning tests."""
+import os
+import re
+from unittest import TestCase
+from sqlalchemy import text
+from models import db, User, Book, UserBook, Tag, UserTag, UserBookTag
+from isolation import clean_tables
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+import partitions
+from partitions import partition_tables, create_partitioned, copy_rows, swap, table_kind
+
+db.create_all()
+
+
+class PartitionTablesTestCase(TestCase):
+    """Test converting the per user tables to hash partitions. The DDL rolls back with each test."""
+
+    def setUp(self):
+        clean_tables(UserBookTag, UserTag, Tag, UserBook, Book, User)
+
+        users = [User(username=f'user{n}@nodomain.com', password='password1') for n in range(3)]
+        books = [Book(isbn=f'{n:013d}', open_library_id='abcd', title=title,
+                      open_library_images={"small": "small_url", "medium": "medium_url", "large": "large_url"})
+                 for n, title in enumerate(['The Hobbit', 'Dune'])]
+        tag = Tag(name='fantasy')
+        db.session.add_all(users + books + [tag])
+        db.session.commit()
+        db.session.add_all([UserBook(user_id=user.id, book_id=book.id) for user in users for book in books] +
+                           [UserTag(user_id=user.id, tag_id=tag.id) for user in users] +
+                           [UserBookTag(user_id=user.id, book_id=books[0].id, tag_id=tag.id) for user in users])
+        db.session.commit()
+
+        self.user_id, self.tag_id = users[0].id, tag.id
+        self.book_ids = [book.id for book in books]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def scanned_partitions(self, query):
+        """The partitions the plan of `query` reads."""
+
+        sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+        plan = '\n'.join(line for line, in db.session.execute(text(f'EXPLAIN {sql}')))
+        return set(re.findall(r'\b(users_\w+_p\d+)\b', plan))
+
+    def test_partition(self):
+        """Rows, keys and indexes carry over, and the tag queries read one partition."""
+
+        batch, partitions.COPY_BATCH = partitions.COPY_BATCH, 2
+        try:
+            copied = partition_tables(partitions=4)
+        finally:
+            partitions.COPY_BATCH = batch
+
+        self.assertEqual(copied, {'users_books': 6, 'users_tags': 3, 'users_books_tags': 3})
+        self.assertEqual({table: table_kind(table) for table in partitions.PARTITIONED_TABLES},
+                         {'users_books': 'p', 'users_tags': 'p', 'users_books_tags': 'p'})
+        self.assertEqual(table_kind('users_books_unpartitioned'), 'r')
+        self.assertIn('ix_users_books_tags_user_tag',
+                      [name for name, definition in partitions.indexes('users_books_tags')])
+        self.assertEqual(partition_tables(partitions=4), dict.fromkeys(partitions.PARTITIONED_TABLES))
+        # create_all sees the partitioned tables
+        db.create_all()
+
+        tag_books = db.session.query(UserBookTag.book_id)\
+            .filter(UserBookTag.user_id == self.user_id, UserBookTag.tag_id == self.tag_id)
+        book_tags = db.session.query(Tag)\
+            .join(UserBookTag)\
+            .filter(UserBookTag.user_id == self.user_id, UserBookTag.book_id == self.book_ids[0])
+        self.assertEqual(len(self.scanned_partitions(tag_books)), 1)
+        self.assertEqual(len(self.scanned_partitions(book_tags)), 1)
+        # the isbn search asks about one user, lookups of a book's owners read every partition through their index
+        owned = db.session.query(UserBook).filter_by(user_id=self.user_id, book_id=self.book_ids[0])
+        owners = db.session.query(UserBook.user_id).filter(UserBook.book_id == self.book_ids[0])
+        self.assertEqual(len(self.scanned_partitions(owned)), 1)
+        self.assertEqual(len(self.scanned_partitions(owners)), 4)
+        self.assertIn('ix_users_books_book_id', [name for name, definition in partitions.indexes('users_books')])
+        self.assertEqual([tag.name for tag in Book.query.get(self.book_ids[0]).get_user_book_tags(self.user_id)],
+                         ['fantasy'])
+
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = self.user_id
+        html = client.get(f'/users/{self.user_id}/tags/{self.tag_id}').get_data(as_text=True)
+        self.assertIn('The Hobbit', html)
+        self.assertNotIn('Dune', html)
+
+    def test_writes_during_copy(self):
+        """Inserts, updates and deletes made once the copy exists reach it through the trigger."""
+
+        create_partitioned('users_books', 4)
+        UserBook.query.filter_by(user_id=self.user_id, book_id=self.book_ids[1]).delete()
+        db.session.commit()
+        copy_rows('users_books')
+        UserBook.bump_tag_version(self.user_id, [self.book_ids[0]])
+        db.session.add(UserBook(user_id=self.user_id, book_id=self.book_ids[1]))
+        db.session.commit()
+        swap('users_books')
+
+        self.assertEqual(table_kind('users_books'), 'p')
+        self.assertEqual(sorted(db.session.query(UserBook.user_id, UserBook.book_id, UserBook.tag_version)),
+                         sorted(db.session.execute(text('SELECT user_id, book_id, tag_version '
+                                                        'FROM users_books_unpartitioned'))))
+        self.assertEqual(db.session.query(UserBook.tag_version)
+                         .filter_by(user_id=self.user_id, book_id=self.book_ids[0]).scalar(), 1)
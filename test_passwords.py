@@ -0,0 +1,134 @@
+"""Password hashing tests."""
+import os
+import threading
+from functools import partial
+from unittest import TestCase
+from unittest.mock import patch
+import gevent
+from models import db, User
+from isolation import clean_tables
+from passwords import PasswordHasher, LoginThrottled, bcrypt, get_log_rounds, passwords
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing, rehashing and the login limit."""
+
+    def setUp(self):
+        clean_tables(User)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        passwords.log_rounds = app.config['BCRYPT_LOG_ROUNDS']
+
+    def test_hash_uses_configured_cost(self):
+        """Hashes are made with the configured cost and checked on the pool."""
+
+        hashed = passwords.hash('password1')
+
+        self.assertEqual(get_log_rounds(hashed), app.config['BCRYPT_LOG_ROUNDS'])
+        self.assertTrue(passwords.check(hashed, 'password1'))
+        self.assertFalse(passwords.check(hashed, 'password2'))
+
+    def hash_at_once(self, hasher, spawn, join):
+        """Hash two passwords on tasks started by `spawn` and waited for by `join`. Returns the hashes that finished."""
+
+        both_started = threading.Barrier(2, timeout=5)
+        generate = bcrypt.generate_password_hash
+        hashes = []
+
+        def generate_with_other(password, rounds):
+            # only gets past the barrier when the other hash is in bcrypt at the same time
+            both_started.wait()
+            return generate(password, rounds)
+
+        with patch.object(bcrypt, 'generate_password_hash', generate_with_other):
+            join([spawn(lambda password=password: hashes.append(hasher.hash(password)))
+                  for password in ['password1', 'password2']])
+        return hashes
+
+    def test_hashes_at_once_inline(self):
+        """Sync and threaded workers hash on the request's own thread, two logins hash at the same time."""
+
+        hasher = PasswordHasher(app)
+
+        def spawn(target):
+            thread = threading.Thread(target=target)
+            thread.start()
+            return thread
+
+        hashes = self.hash_at_once(hasher, spawn, lambda threads: [thread.join() for thread in threads])
+
+        self.assertEqual(len(hashes), 2)
+        self.assertIsNone(hasher._executor)
+
+    def test_hashes_at_once_gevent(self):
+        """Under gevent two greenlets hash at the same time on the pool's real threads."""
+
+        hasher = PasswordHasher(app)
+        hasher.threads = 2
+        try:
+            with patch('passwords.is_gevent_patched', return_value=True):
+                hashes = self.hash_at_once(hasher, gevent.spawn, partial(gevent.joinall, raise_error=True))
+        finally:
+            if hasher._executor:
+                hasher._executor.shutdown()
+
+        self.assertEqual(len(hashes), 2)
+
+    def test_rehash_on_login(self):
+        """Logging in with a hash of another cost saves a hash at the configured cost."""
+
+        User.signup(username='user1@nodomain.com', password='password1')
+        db.session.commit()
+        passwords.log_rounds = 5
+
+        with app.test_client() as c:
+            resp = c.post('/login', data={'username': 'user1@nodomain.com', 'password': 'password1'})
+
+            self.assertEqual(resp.status_code, 302)
+
+        user = User.query.filter_by(username='user1@nodomain.com').first()
+        self.assertEqual(get_log_rounds(user.password), 5)
+
+    def test_login_slots(self):
+        """A login beyond the concurrency limit is turned away once the queue timeout passes."""
+
+        hasher = PasswordHasher()
+        hasher._slots = threading.BoundedSemaphore(1)
+        hasher.queue_timeout = 0.01
+
+        with hasher.login_slot():
+            with self.assertRaises(LoginThrottled):
+                with hasher.login_slot():
+                    pass
+
+        with hasher.login_slot():
+            pass
+
+    def test_login_throttled(self):
+        """The login route answers 503 when no login slot is free."""
+
+        slots = passwords._slots
+        passwords._slots = threading.BoundedSemaphore(1)
+        passwords._slots.acquire()
+        timeout = passwords.queue_timeout
+        passwords.queue_timeout = 0.01
+        try:
+            with app.test_client() as c:
+                resp = c.post('/login', data={'username': 'user1@nodomain.com', 'password': 'password1'})
+
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn("Too many people are logging in right now", resp.get_data(as_text=True))
+        finally:
+            passwords._slots = slots
+            passwords.queue_timeout = timeout
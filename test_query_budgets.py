@@ -0,0 +1,138 @@
+"""Query budget tests: every route runs a fixed number of SQL statements however large the library is."""
+import datetime
+import os
+from unittest import TestCase
+from models import db, User, Book, Author, BookAuthor, Publisher, BookPublisher, Subject, BookSubject, UserBook, Tag, \
+    UserTag, UserBookTag
+from query_budget import QueryBudgetMixin
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+LIBRARY_SIZES = [1, 10, 50]
+
+
+class QueryBudgetTestCase(QueryBudgetMixin, TestCase):
+    """Check each route against its budget at several library sizes, so a query per book fails at the larger ones."""
+
+    def clear(self):
+        UserBookTag.query.delete()
+        UserTag.query.delete()
+        Tag.query.delete()
+        UserBook.query.delete()
+        BookAuthor.query.delete()
+        BookPublisher.query.delete()
+        BookSubject.query.delete()
+        Author.query.delete()
+        Publisher.query.delete()
+        Subject.query.delete()
+        Book.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def create_library(self, size):
+        """A user owning `size` books, each with an author, a publisher, a subject and two of the user's three tags."""
+
+        self.clear()
+        app.extensions['fragment_cache'].clear()
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        tags = [Tag(name=f'tag {i}') for i in range(3)]
+        books = []
+        for i in range(size):
+            book = Book(
+                isbn=f'{i:013d}',
+                open_library_id=f'OL{i}M',
+                open_library_images={"small": "small_url", "medium": "medium_url", "large": "large_url"},
+                open_library_url='fake_url',
+                number_of_pages=100 + i,
+                publish_date=datetime.date(2000, 1, 1),
+                title=f'book {i}'
+            )
+            book.authors.append(Author(name=f'author {i}'))
+            book.publishers.append(Publisher(name=f'publisher {i}'))
+            book.subjects.append(Subject(name=f'subject {i}'))
+            books.append(book)
+        db.session.add_all([user] + tags + books)
+        db.session.commit()
+
+        db.session.add_all([UserTag(user_id=user.id, tag_id=tag.id) for tag in tags])
+        db.session.add_all([UserBook(user_id=user.id, book_id=book.id) for book in books])
+        db.session.add_all([UserBookTag(user_id=user.id, book_id=book.id, tag_id=tag.id)
+                            for book in books for tag in tags[:2]])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.book_id = books[0].id
+        self.tag_ids = [tag.id for tag in tags]
+        db.session.remove()
+
+    def check_budget(self, budget, request):
+        """Run `request(client)` against a library of each size. It must stay within budget and never grow."""
+
+        counts = {}
+        for size in LIBRARY_SIZES:
+            with self.subTest(books=size):
+                self.create_library(size)
+                with app.test_client() as client:
+                    with client.session_transaction() as change_session:
+                        change_session[CURR_USER_KEY] = self.user_id
+                    with self.assertMaxQueries(budget) as statements:
+                        resp = request(client)
+                    self.assertLess(resp.status_code, 400)
+                counts[size] = len(statements)
+        self.assertEqual(len(set(counts.values())), 1, f'queries grow with the library: {counts}')
+
+    def tearDown(self):
+        db.session.rollback()
+        self.clear()
+
+    def test_budget_exceeded(self):
+        """Going over the budget fails and lists the statements."""
+
+        with self.assertRaises(AssertionError) as cm:
+            with self.assertMaxQueries(1):
+                db.session.execute('SELECT 1')
+                db.session.execute('SELECT 2')
+        self.assertIn('2 queries, budget 1', str(cm.exception))
+        self.assertIn('SELECT 2', str(cm.exception))
+
+    def test_user_books(self):
+        # the books and their tag versions are one query, the last one lists the user's tags for bulk tagging
+        self.check_budget(5, lambda client: client.get(f'/users/{self.user_id}/books'))
+
+    def test_user_books_search(self):
+        # a first search runs on its own before the cards are read, a repeat is answered from the search cache
+        self.check_budget(6, lambda client: client.post(f'/users/{self.user_id}/books/search',
+                                                        data={'radio-search': 'title', 'search-input': 'book'}))
+
+    def test_user_book_detail(self):
+        # the last one is "more like this"
+        self.check_budget(12, lambda client: client.get(f'/users/{self.user_id}/books/{self.book_id}'))
+
+    def test_show_user_book_by_tag(self):
+        self.check_budget(7, lambda client: client.get(f'/users/{self.user_id}/tags/{self.tag_ids[0]}'))
+
+    def test_user_tags(self):
+        self.check_budget(2, lambda client: client.get(f'/users/{self.user_id}/tags'))
+
+    def test_add_book_tag(self):
+        self.check_budget(6, lambda client: client.post(
+            f'/users/{self.user_id}/books/{self.book_id}/tag/{self.tag_ids[2]}'))
+
+    def test_delete_book_tag(self):
+        self.check_budget(7, lambda client: client.post(
+            f'/users/{self.user_id}/books/{self.book_id}/tag/{self.tag_ids[0]}/delete'))
+
+    def test_api_books(self):
+        self.check_budget(4, lambda client: client.get(f'/api/v1/users/{self.user_id}/books'))
+
+    def test_api_book(self):
+        self.check_budget(4, lambda client: client.get(f'/api/v1/users/{self.user_id}/books/{self.book_id}'))
+
+    def test_api_tags(self):
+        self.check_budget(2, lambda client: client.get(f'/api/v1/users/{self.user_id}/tags'))
@@ -0,0 +1,76 @@
+"""Rate limiter tests."""
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from prometheus_client import REGISTRY
+from models import db, User
+from isolation import clean_tables
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, create_app, CURR_USER_KEY
+from config import TestingConfig
+from rate_limit import Budget, RateLimited, reserve
+
+db.create_all()
+
+
+class RateLimitTestCase(TestCase):
+    """Test the shared token buckets. They commit on a connection of their own, conftest empties them after a test."""
+
+    def test_burst_then_turns(self):
+        """The burst goes right away, then each call is given the next turn."""
+
+        budget = Budget(rate=10, burst=2, max_wait=1)
+        waits = [reserve('test:turns', budget) for _ in range(4)]
+
+        self.assertEqual(waits[:2], [0, 0])
+        self.assertAlmostEqual(waits[2], 0.1, delta=0.05)
+        self.assertAlmostEqual(waits[3], 0.2, delta=0.05)
+
+    def test_refused_with_estimate(self):
+        """A turn too far off isn't taken, the caller gets the estimated wait."""
+
+        budget = Budget(rate=1, burst=1, max_wait=0.5)
+        refused = REGISTRY.get_sample_value('rate_limit_refused_total', {'bucket': 'test:refused'}) or 0
+        reserve('test:refused', budget)
+
+        for _ in range(2):
+            with self.assertRaises(RateLimited) as raised:
+                reserve('test:refused', budget)
+            self.assertAlmostEqual(raised.exception.retry_after, 1, delta=0.1)
+        self.assertEqual(REGISTRY.get_sample_value('rate_limit_refused_total', {'bucket': 'test:refused'}),
+                         refused + 2)
+
+    def test_rate_above_zero(self):
+        """A budget without a rate is refused when it's made, and an app configured with one doesn't start."""
+
+        with self.assertRaises(ValueError):
+            Budget(rate=0, burst=1, max_wait=1)
+
+        class NoRate(TestingConfig):
+            OPEN_LIBRARY_BACKGROUND_RATE = 0.0
+
+        with self.assertRaises(ValueError):
+            create_app(NoRate)
+
+    def test_busy_page(self):
+        """A lookup that would wait too long tells the user when to come back, without calling Open Library."""
+
+        clean_tables(User)
+        user = User(username='test_user@nodomain.com', password='password1')
+        db.session.add(user)
+        db.session.commit()
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = user.id
+
+        limits = {'OPEN_LIBRARY_INTERACTIVE_RATE': 0.1, 'OPEN_LIBRARY_INTERACTIVE_BURST': 0,
+                  'OPEN_LIBRARY_INTERACTIVE_MAX_WAIT': 0}
+        with patch.dict(app.config, limits), patch('utils.open_library.get') as get:
+            resp = client.post('/books/search', data={'isbn': '9780000000001'}, follow_redirects=True)
+
+        get.assert_not_called()
+        self.assertIn('Open Library is busy, please try again in about 10 seconds.', resp.get_data(as_text=True))
+        db.session.rollback()
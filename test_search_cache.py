@@ -0,0 +1,93 @@
+"""Search result cache tests."""
+import os
+from unittest import TestCase
+from prometheus_client import REGISTRY
+from models import db, User, Book, UserBook, Tag, UserTag, UserBookTag
+from isolation import clean_tables
+from query_budget import QueryBudgetMixin
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+
+def lookups(search, outcome):
+    return REGISTRY.get_sample_value('search_cache_lookups_total', {'search': search, 'outcome': outcome}) or 0
+
+
+class SearchCacheTestCase(QueryBudgetMixin, TestCase):
+    """Test that repeated searches come from the cache until the user's library changes."""
+
+    def setUp(self):
+        clean_tables(UserBookTag, UserTag, Tag, UserBook, Book, User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        books = [Book(isbn=f'{n:013d}', open_library_id='abcd', title=title,
+                      open_library_images={"small": "small_url", "medium": "medium_url", "large": "large_url"})
+                 for n, title in enumerate(['The Hobbit', 'The Silmarillion', 'Dune'])]
+        tag = Tag(name='fantasy')
+        db.session.add_all([user, tag] + books)
+        db.session.commit()
+        db.session.add_all([UserBook(user_id=user.id, book_id=book.id) for book in books] +
+                           [UserTag(user_id=user.id, tag_id=tag.id),
+                            UserBookTag(user_id=user.id, book_id=books[0].id, tag_id=tag.id)])
+        db.session.commit()
+
+        self.user_id, self.tag_id = user.id, tag.id
+        self.book_ids = [book.id for book in books]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def client(self):
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = self.user_id
+        return client
+
+    def search(self, client, terms):
+        return client.post(f'/users/{self.user_id}/books/search',
+                           data={'radio-search': 'title', 'search-input': terms}).get_data(as_text=True)
+
+    def test_repeated_search(self):
+        """A repeat skips the search query, whatever the case of the terms."""
+
+        client = self.client()
+        hits, misses = lookups('title', 'hit'), lookups('title', 'miss')
+        self.assertIn('The Silmarillion', self.search(client, 'the'))
+
+        with self.assertMaxQueries(5) as statements:
+            html = self.search(client, 'THE')
+
+        self.assertIn('The Hobbit', html)
+        self.assertIn('The Silmarillion', html)
+        self.assertNotIn('Dune', html)
+        self.assertFalse(any('ILIKE' in statement for statement in statements))
+        self.assertEqual((lookups('title', 'hit'), lookups('title', 'miss')), (hits + 1, misses + 1))
+
+    def test_tag_page_after_write(self):
+        """Tagging a book bumps the library version, so the tag page looks again and finds it."""
+
+        client = self.client()
+        self.assertNotIn('Dune', client.get(f'/users/{self.user_id}/tags/{self.tag_id}').get_data(as_text=True))
+
+        client.post(f'/users/{self.user_id}/books/{self.book_ids[2]}/tag/{self.tag_id}')
+        misses = lookups('tag', 'miss')
+
+        self.assertIn('Dune', client.get(f'/users/{self.user_id}/tags/{self.tag_id}').get_data(as_text=True))
+        self.assertEqual(lookups('tag', 'miss'), misses + 1)
+
+    def test_large_results_not_kept(self):
+        client = self.client()
+        max_ids, app.config['SEARCH_CACHE_MAX_IDS'] = app.config['SEARCH_CACHE_MAX_IDS'], 1
+        try:
+            self.search(client, 'the')
+            misses = lookups('title', 'miss')
+            self.search(client, 'the')
+        finally:
+            app.config['SEARCH_CACHE_MAX_IDS'] = max_ids
+
+        self.assertEqual(lookups('title', 'miss'), misses + 1)
@@ -0,0 +1,125 @@
+"""More like this tests."""
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from models import db, User, Book, Author, BookAuthor, Subject, BookSubject, UserBook, SimilarBook, SimilarRefresh
+from isolation import clean_tables
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+from similar import refresh_similar_books, similar_books, queue_refresh
+
+db.create_all()
+
+
+class SimilarBooksTestCase(TestCase):
+    """Test the neighbour lists and reading them for the book page."""
+
+    def setUp(self):
+        clean_tables(SimilarRefresh, SimilarBook, UserBook, BookAuthor, BookSubject, Author, Subject, Book, User)
+
+        self.tolkien = Author(name='J. R. R. Tolkien')
+        self.fantasy = Subject(name='Fantasy')
+        self.fiction = Subject(name='Fiction')
+        self.dragons = Subject(name='Dragons')
+        self.books = {}
+        # the hobbit shares an author and two subjects with the fellowship, only 'Fiction' with dune
+        for title, authors, subjects in [
+            ('The Hobbit', [self.tolkien], [self.fantasy, self.fiction, self.dragons]),
+            ('The Fellowship of the Ring', [self.tolkien], [self.fantasy, self.fiction]),
+            ('Dune', [Author(name='Frank Herbert')], [self.fiction]),
+            ('A Cookbook', [Author(name='A Cook')], [Subject(name='Cooking')]),
+        ]:
+            self.books[title] = self.add_book(title, authors, subjects)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(UserBook(user_id=user.id, book_id=self.books['Dune']))
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def add_book(self, title, authors, subjects):
+        book = Book(isbn=f'{len(self.books):013d}', open_library_id='abcd', title=title,
+                    open_library_images={"small": "small_url", "medium": "medium_url", "large": "large_url"})
+        book.authors.extend(authors)
+        book.subjects.extend(subjects)
+        db.session.add(book)
+        db.session.commit()
+        return book.id
+
+    def neighbours(self, title):
+        return [self.title(similar_id) for similar_id, in db.session.query(SimilarBook.similar_book_id)
+                .filter_by(book_id=self.books[title])
+                .order_by(SimilarBook.score.desc())]
+
+    @staticmethod
+    def title(book_id):
+        return Book.query.get(book_id).title
+
+    def test_full_refresh(self):
+        """Shared rare features count for more, books with nothing in common aren't neighbours."""
+
+        refresh = refresh_similar_books()
+
+        self.assertTrue(refresh.full)
+        self.assertEqual(self.neighbours('The Hobbit'), ['The Fellowship of the Ring', 'Dune'])
+        self.assertEqual(self.neighbours('Dune'), ['The Fellowship of the Ring', 'The Hobbit'])
+        self.assertEqual(self.neighbours('A Cookbook'), [])
+
+    def test_incremental_refresh(self):
+        """A new book gets its own list and joins the lists of the books it's close to."""
+
+        refresh_similar_books()
+        self.books['The Two Towers'] = self.add_book('The Two Towers', [self.tolkien], [self.fantasy, self.dragons])
+
+        refresh = refresh_similar_books()
+
+        self.assertFalse(refresh.full)
+        self.assertEqual(self.neighbours('The Two Towers')[0], 'The Hobbit')
+        self.assertIn('The Two Towers', self.neighbours('The Hobbit'))
+        self.assertIn('The Two Towers', self.neighbours('The Fellowship of the Ring'))
+        self.assertEqual(self.neighbours('A Cookbook'), [])
+
+        # 'Dragons' was on one book when the hobbit's list was made and didn't count, now it's the rarest they share
+        refresh_similar_books(full=True)
+        self.assertEqual(self.neighbours('The Hobbit')[0], 'The Two Towers')
+
+    def test_queue_refresh(self):
+        """Books added while a run is waiting join it, the run scores them on its own thread."""
+
+        with app.app_context():
+            self.assertIsNone(queue_refresh())
+            with patch.dict(app.config, {'SIMILAR_REFRESH_DELAY': 0.2}):
+                timer = queue_refresh()
+                self.assertIsNone(queue_refresh())
+                timer.join()
+
+        self.assertEqual(SimilarRefresh.query.count(), 1)
+        self.assertEqual(self.neighbours('The Hobbit'), ['The Fellowship of the Ring', 'Dune'])
+
+    def test_collection_filter(self):
+        """The user's own books are left out, or are all that's shown."""
+
+        refresh_similar_books()
+        hobbit = self.books['The Hobbit']
+
+        self.assertEqual([book.title for book in similar_books(self.user_id, hobbit)], ['The Fellowship of the Ring'])
+        self.assertEqual([book.title for book in similar_books(self.user_id, hobbit, in_collection=True)], ['Dune'])
+
+    def test_book_page(self):
+        refresh_similar_books()
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.user_id
+            resp = client.get(f"/users/{self.user_id}/books/{self.books['The Hobbit']}")
+
+        html = resp.get_data(as_text=True)
+        self.assertIn('More like this', html)
+        self.assertIn('The Fellowship of the Ring', html)
@@ -0,0 +1,146 @@
+"""Slow query log tests."""
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import text
+from models import db, User, SlowQuery
+from isolation import clean_tables
+from slow_queries import SlowQueryLog, init_slow_query_log, redact
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test recording, explaining and listing slow statements. They're saved on a connection of their own, so the tests
+    clean up after them."""
+
+    def setUp(self):
+        clean_tables(SlowQuery, User)
+        user = User(username='admin@nodomain.com', password='password1')
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        # record everything
+        app.config['SLOW_QUERY_MS'] = 0
+        init_slow_query_log(app)
+        self.log = app.extensions['slow_query_log']
+
+    def tearDown(self):
+        app.extensions.pop('slow_query_log')
+        app.config['SLOW_QUERY_MS'] = None
+        db.session.rollback()
+        with db.engine.begin() as conn:
+            conn.execute(text('DELETE FROM slow_queries'))
+
+    def get(self, url):
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.user_id
+            resp = client.get(url)
+        self.log.queue.join()
+        return resp
+
+    def test_records_with_plan(self):
+        """Statements are saved with their route, their parameters' types and their estimated plan."""
+
+        self.get(f'/users/{self.user_id}/tags')
+
+        # loading the user in before_request
+        slow_query = SlowQuery.query.filter(SlowQuery.endpoint == 'library.user_tags',
+                                            SlowQuery.statement.like('SELECT users.id%')).first()
+        self.assertEqual(slow_query.parameters, '{"pk_1": "int"}')
+        self.assertIn('cost=', slow_query.plan)
+        self.assertNotIn('actual time', slow_query.plan)
+
+    def test_analyze_opt_in(self):
+        """With explain_analyze, SELECTs are run again for actual timings, unless they lock or have side effects."""
+
+        self.log.explain_analyze = True
+        self.get(f'/users/{self.user_id}/tags')
+
+        slow_query = SlowQuery.query.filter(SlowQuery.endpoint == 'library.user_tags',
+                                            SlowQuery.statement.like('SELECT users.id%')).first()
+        self.assertIn('actual time', slow_query.plan)
+
+        for statement in ['SELECT users.id FROM users FOR UPDATE', 'SELECT users.id FROM users FOR NO KEY UPDATE',
+                          'SELECT users.id FROM users FOR SHARE', "SELECT nextval('users_id_seq')",
+                          "SELECT pg_notify('test', 'slow')", 'SELECT pg_advisory_lock(1)']:
+            with self.subTest(statement):
+                plan = self.log.explain(db.engine, statement, {})
+                self.assertIn('cost=', plan)
+                self.assertNotIn('actual time', plan)
+
+    def test_parameters_redacted(self):
+        """Usernames and password hashes never reach the table, only their types and lengths."""
+
+        with app.test_request_context('/'):
+            db.session.add(User(username='other@nodomain.com', password='password2'))
+            db.session.commit()
+        self.log.queue.join()
+
+        parameters = SlowQuery.query.filter(SlowQuery.statement.like('INSERT INTO users%')).one().parameters
+        self.assertNotIn('other@nodomain.com', parameters)
+        self.assertNotIn('$2b$', parameters)
+        self.assertIn('"str(18)"', parameters)
+        self.assertEqual(redact([('a', 1), ('bc', None)], executemany=True),
+                         {'rows': 2, 'first': ['str(1)', 'int']})
+
+    def test_explained_bounded(self):
+        """Only the most recently explained statements are remembered."""
+
+        log = SlowQueryLog(0, max_statements=2)
+        with patch.object(log, 'explain'), patch.object(db.engine, 'raw_connection'):
+            for statement in ['SELECT 1', 'SELECT 2', 'SELECT 3']:
+                log.save(db.engine, statement, {}, False, 1, None)
+        self.assertEqual(list(log.explained), ['SELECT 2', 'SELECT 3'])
+
+    def test_writes_are_not_analyzed(self):
+        """Writes get the estimated plan only, so explaining them doesn't run them again."""
+
+        with app.test_request_context('/'):
+            db.session.add(User(username='other@nodomain.com', password='password2'))
+            db.session.commit()
+        self.log.queue.join()
+
+        slow_query = SlowQuery.query.filter(SlowQuery.statement.like('INSERT INTO users%')).one()
+        self.assertNotIn('actual time', slow_query.plan)
+        self.assertEqual(User.query.filter_by(username='other@nodomain.com').count(), 1)
+
+    def test_explains_once_per_interval(self):
+        """A statement that keeps being slow is saved every time but explained once per interval."""
+
+        self.get(f'/users/{self.user_id}/tags')
+        self.get(f'/users/{self.user_id}/tags')
+
+        plans = [plan for plan, in db.session.query(SlowQuery.plan)
+                 .filter(SlowQuery.statement.like('SELECT tags.id%FROM tags, users_tags%'))]
+        self.assertEqual(len(plans), 2)
+        self.assertEqual(len([plan for plan in plans if plan]), 1)
+
+    def test_full_queue_drops(self):
+        """Recording never blocks a request, statements are dropped when the thread falls behind."""
+
+        log = SlowQueryLog(0, queue_size=1)
+        with patch.object(log, 'save'), patch('threading.Thread.start'):
+            log.record(None, 'SELECT 1', {}, False, 1, None)
+            log.record(None, 'SELECT 2', {}, False, 1, None)
+        self.assertEqual(log.dropped, 1)
+
+    def test_admin_page(self):
+        """Admins see the top offenders, everyone else is turned away."""
+
+        self.get(f'/users/{self.user_id}/tags')
+        self.assertEqual(self.get('/admin/slow-queries').status_code, 302)
+
+        with patch.dict(app.config, {'ADMIN_USERNAMES': ['admin@nodomain.com']}):
+            resp = self.get('/admin/slow-queries')
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('library.user_tags', html)
+        self.assertIn('cost=', html)
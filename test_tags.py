@@ -0,0 +1,296 @@
+"""Set based tag operation tests."""
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from models import db, User, Book, UserBook, Tag, UserTag, UserBookTag
+from isolation import clean_tables
+from query_budget import QueryBudgetMixin
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app, CURR_USER_KEY
+from tags import CREATE_ATTEMPTS, TagsNotCreated, tag_ids_for
+
+db.create_all()
+
+
+class BulkTagTestCase(QueryBudgetMixin, TestCase):
+    """Test tagging and untagging many books in one request."""
+
+    def setUp(self):
+        clean_tables(UserBookTag, UserTag, Tag, UserBook, Book, User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        other = User(username='other_user@nodomain.com', password='password1')
+        books = [Book(isbn=f'{n:013d}', open_library_id='abcd', title=f'Picture book {n}',
+                      open_library_images={"small": "small_url", "medium": "medium_url", "large": "large_url"})
+                 for n in range(20)]
+        summer, beach, unowned = Tag(name='summer'), Tag(name='beach'), Tag(name='unowned')
+        db.session.add_all([user, other, summer, beach, unowned] + books)
+        db.session.commit()
+        db.session.add_all([UserBook(user_id=user.id, book_id=book.id) for book in books[:15]] +
+                           [UserTag(user_id=user.id, tag_id=summer.id), UserTag(user_id=user.id, tag_id=beach.id),
+                            UserTag(user_id=other.id, tag_id=unowned.id)])
+        db.session.commit()
+        # already tagged summer, the bulk add leaves it alone
+        db.session.add(UserBookTag(user_id=user.id, book_id=books[0].id, tag_id=summer.id))
+        db.session.commit()
+
+        self.user_id = user.id
+        self.book_ids = [book.id for book in books]
+        self.tag_ids = {tag.name: tag.id for tag in (summer, beach, unowned)}
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def client(self):
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = self.user_id
+        return client
+
+    def links(self):
+        return set(db.session.query(UserBookTag.book_id, UserBookTag.tag_id).filter_by(user_id=self.user_id))
+
+    def tag_versions(self):
+        return dict(db.session.query(UserBook.book_id, UserBook.tag_version).filter_by(user_id=self.user_id))
+
+    def test_apply(self):
+        """Every tag goes on every book in one transaction of a fixed number of statements."""
+
+        owned = self.book_ids[:15]
+        versions = self.tag_versions()
+        library_version = User.query.get(self.user_id).library_version
+
+        with self.assertMaxQueries(5):
+            resp = self.client().post(f'/users/{self.user_id}/books/tags', data={
+                'book_id': owned, 'tag_id': [self.tag_ids['summer'], self.tag_ids['beach']]
+            })
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.links(), {(book_id, self.tag_ids[name]) for book_id in owned
+                                        for name in ('summer', 'beach')})
+        # every book got a new tag, beach, so every card changed
+        self.assertEqual(self.tag_versions(), {book_id: version + 1 for book_id, version in versions.items()})
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.user_id).library_version, library_version + 1)
+
+    def test_remove(self):
+        client = self.client()
+        client.post(f'/users/{self.user_id}/books/tags', data={
+            'book_id': self.book_ids[:15], 'tag_id': [self.tag_ids['summer'], self.tag_ids['beach']]
+        })
+
+        with self.assertMaxQueries(5):
+            client.post(f'/users/{self.user_id}/books/tags', data={
+                'book_id': self.book_ids[:10], 'tag_id': [self.tag_ids['summer']], 'action': 'remove'
+            })
+
+        self.assertEqual(self.links(),
+                         {(book_id, self.tag_ids['beach']) for book_id in self.book_ids[:15]} |
+                         {(book_id, self.tag_ids['summer']) for book_id in self.book_ids[10:15]})
+
+    def test_ownership(self):
+        """A book outside the collection or another user's tag turns the whole request away."""
+
+        client = self.client()
+        for book_ids, tag_name in [(self.book_ids[10:20], 'summer'), (self.book_ids[:5], 'unowned')]:
+            resp = client.post(f'/users/{self.user_id}/books/tags', data={
+                'book_id': book_ids, 'tag_id': [self.tag_ids[tag_name]]
+            }, follow_redirects=True)
+
+            self.assertIn('Book or tag not found!', resp.get_data(as_text=True))
+            self.assertEqual(self.links(), {(self.book_ids[0], self.tag_ids['summer'])})
+
+    def test_wrong_user(self):
+        resp = self.client().post(f'/users/{self.user_id + 1}/books/tags', data={
+            'book_id': self.book_ids[:1], 'tag_id': [self.tag_ids['summer']]
+        })
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, 'http://localhost/')
+
+
+class RenameMergeTestCase(QueryBudgetMixin, TestCase):
+    """Test renaming and merging one user's tags without touching anyone else's."""
+
+    def setUp(self):
+        clean_tables(UserBookTag, UserTag, Tag, UserBook, Book, User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        other = User(username='other_user@nodomain.com', password='password1')
+        books = [Book(isbn=f'{n:013d}', open_library_id='abcd', title=f'Book {n}') for n in range(4)]
+        scifi, sf, sci_fi = Tag(name='scifi'), Tag(name='sf'), Tag(name='sci-fi')
+        db.session.add_all([user, other, scifi, sf, sci_fi] + books)
+        db.session.commit()
+        db.session.add_all([UserBook(user_id=owner.id, book_id=book.id) for owner in (user, other) for book in books] +
+                           [UserTag(user_id=owner.id, tag_id=tag.id) for owner in (user, other)
+                            for tag in (scifi, sf, sci_fi)])
+        db.session.commit()
+        # books 0-1 scifi, 1-2 sf, 3 sci-fi, for both users
+        db.session.add_all([UserBookTag(user_id=owner.id, book_id=books[n].id, tag_id=tag.id)
+                            for owner in (user, other)
+                            for n, tag in [(0, scifi), (1, scifi), (1, sf), (2, sf), (3, sci_fi)]])
+        db.session.commit()
+
+        self.user_id, self.other_id = user.id, other.id
+        self.book_ids = [book.id for book in books]
+        self.tag_ids = {tag.name: tag.id for tag in (scifi, sf, sci_fi)}
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def client(self):
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = self.user_id
+        return client
+
+    def tagged(self, user_id):
+        """{tag name: sorted book indexes} of the user's links, and the names in their tag list."""
+
+        links = {}
+        for name, book_id in db.session.query(Tag.name, UserBookTag.book_id).join(UserBookTag)\
+                .filter(UserBookTag.user_id == user_id):
+            links.setdefault(name, []).append(self.book_ids.index(book_id))
+        listed = {name for name, in db.session.query(Tag.name).join(UserTag).filter(UserTag.user_id == user_id)}
+        return {name: sorted(books) for name, books in links.items()}, listed
+
+    def test_rename_to_new_name(self):
+        resp = self.client().post(f'/users/{self.user_id}/tags/{self.tag_ids["sf"]}/rename',
+                                  data={'name': ' science  fiction '})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.tagged(self.user_id), (
+            {'scifi': [0, 1], 'science fiction': [1, 2], 'sci-fi': [3]}, {'scifi', 'science fiction', 'sci-fi'}
+        ))
+        # the other user still has sf as it was
+        self.assertEqual(self.tagged(self.other_id)[0]['sf'], [1, 2])
+
+    def test_rename_to_existing_name(self):
+        """Renaming onto another of the user's tags merges them, a book with both keeps one link."""
+
+        self.client().post(f'/users/{self.user_id}/tags/{self.tag_ids["sf"]}/rename', data={'name': 'scifi'})
+
+        self.assertEqual(self.tagged(self.user_id), ({'scifi': [0, 1, 2], 'sci-fi': [3]}, {'scifi', 'sci-fi'}))
+
+    def test_merge(self):
+        versions = dict(db.session.query(UserBook.book_id, UserBook.tag_version).filter_by(user_id=self.user_id))
+
+        # a fixed count, however many books the tags are on
+        with self.assertMaxQueries(8):
+            self.client().post(f'/users/{self.user_id}/tags/merge', data={
+                'tag_id': [self.tag_ids['sf'], self.tag_ids['sci-fi']], 'into': self.tag_ids['scifi']
+            })
+
+        self.assertEqual(self.tagged(self.user_id), ({'scifi': [0, 1, 2, 3]}, {'scifi'}))
+        self.assertEqual(self.tagged(self.other_id)[1], {'scifi', 'sf', 'sci-fi'})
+        # book 0 only had the tag everything was merged into
+        self.assertEqual(dict(db.session.query(UserBook.book_id, UserBook.tag_version).filter_by(user_id=self.user_id)),
+                         {book_id: versions[book_id] + (book_id != self.book_ids[0]) for book_id in self.book_ids})
+
+    def test_merge_unowned_tag(self):
+        tag = Tag(name='not mine')
+        db.session.add(tag)
+        db.session.commit()
+        tag_id = tag.id
+
+        resp = self.client().post(f'/users/{self.user_id}/tags/merge', data={
+            'tag_id': [tag_id], 'into': self.tag_ids['scifi']
+        }, follow_redirects=True)
+
+        self.assertIn('Tag not found!', resp.get_data(as_text=True))
+        self.assertEqual(self.tagged(self.user_id)[1], {'scifi', 'sf', 'sci-fi'})
+
+
+class AddUserTagsTestCase(QueryBudgetMixin, TestCase):
+    """Test creating tags for a user, one name or a whole vocabulary at a time."""
+
+    def setUp(self):
+        clean_tables(UserBookTag, UserTag, Tag, UserBook, User)
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        # someone else's tag, the same row is reused
+        shared = Tag(name='fantasy')
+        db.session.add_all([user, shared])
+        db.session.commit()
+        self.user_id, self.shared_id = user.id, shared.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def client(self):
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = self.user_id
+        return client
+
+    def user_tags(self):
+        return dict(db.session.query(Tag.name, Tag.id).join(UserTag).filter(UserTag.user_id == self.user_id))
+
+    def test_batch(self):
+        """Names, one per line or in several fields, are created and added in one transaction."""
+
+        with self.assertMaxQueries(5):
+            resp = self.client().post(f'/users/{self.user_id}/tag', data={
+                'tag': ['to read', 'picture books'],
+                'tags': 'to read\r\nfantasy\n\n  history \n'
+            })
+
+        self.assertEqual(resp.status_code, 302)
+        tags = self.user_tags()
+        self.assertEqual(set(tags), {'to read', 'fantasy', 'history', 'picture books'})
+        self.assertEqual(tags['fantasy'], self.shared_id)
+        self.assertEqual(Tag.query.count(), 4)
+
+    def test_name_with_comma(self):
+        """A name with commas in it is one tag."""
+
+        self.client().post(f'/users/{self.user_id}/tag', data={'tag': 'Sleep, dreams, and the night'})
+
+        self.assertEqual(set(self.user_tags()), {'Sleep, dreams, and the night'})
+
+    def test_already_added(self):
+        client = self.client()
+        client.post(f'/users/{self.user_id}/tag', data={'tag': 'fantasy'})
+        library_version = User.query.get(self.user_id).library_version
+
+        resp = client.post(f'/users/{self.user_id}/tag', data={'tag': 'fantasy'}, follow_redirects=True)
+
+        self.assertIn('Tag already in user&#39;s collection', resp.get_data(as_text=True))
+        self.assertEqual(User.query.get(self.user_id).library_version, library_version)
+
+    def test_created_tags_keep_vanishing(self):
+        """A tag that's gone again after every insert is given up on, instead of being inserted forever."""
+
+        with patch('tags.insert') as insert:
+            insert.return_value.values.return_value.on_conflict_do_nothing.return_value = text('SELECT 1')
+            with self.assertRaises(TagsNotCreated):
+                tag_ids_for(['fantasy', 'short-lived'])
+
+        self.assertEqual(insert.call_count, CREATE_ATTEMPTS)
+
+    def test_resolved_tags_locked(self):
+        """A tag read for linking can't be deleted by the orphan collector until the linking transaction ends."""
+
+        with db.engine.begin() as conn:
+            conn.execute(text("INSERT INTO tags (name) VALUES ('locked tag')"))
+        try:
+            tag_ids_for(['locked tag'])
+            with self.assertRaises(OperationalError), db.engine.begin() as conn:
+                conn.execute(text("SET LOCAL lock_timeout = '100ms'"))
+                conn.execute(text("DELETE FROM tags WHERE name = 'locked tag'"))
+        finally:
+            db.session.rollback()
+            with db.engine.begin() as conn:
+                conn.execute(text("DELETE FROM tags WHERE name = 'locked tag'"))
+
+    def test_empty(self):
+        resp = self.client().post(f'/users/{self.user_id}/tag', data={'tag': ' ', 'tags': '\n '},
+                                  follow_redirects=True)
+
+        self.assertIn('Enter a tag name.', resp.get_data(as_text=True))
+        self.assertEqual(self.user_tags(), {})
@@ -3,9 +3,10 @@ import datetime
 import os
 from unittest import TestCase
 from models import db, User, Book, Tag, UserBook, UserTag, UserBookTag
+from isolation import clean_tables
 
-os.environ['DATABASE_URL'] = "postgres:///personal_library_test"
-os.environ['FLASK_ENV'] = "production"
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
 
 from app import app
 
@@ -18,11 +19,7 @@ class UserBookTagModelTestCase(TestCase):
     def setUp(self):
         """Create sample user data."""
 
-        User.query.delete()
-        Book.query.delete()
-        Tag.query.delete()
-        UserBook.query.delete()
-        UserTag.query.delete()
+        clean_tables(User, Book, Tag, UserBook, UserTag)
 
         user = User(username="user1@nodomain.com", password="password1")
         db.session.add(user)
@@ -5,9 +5,10 @@ from unittest import TestCase
 from models import db, User, Book, Author, Publisher, Subject, SubjectPlace, SubjectPerson, SubjectTime, BookAuthor, \
     BookPublisher, BookSubject, BookSubjectPlace, BookSubjectPerson, BookSubjectTime, UserBook, Tag, UserTag, \
     UserBookTag
+from isolation import clean_tables
 
-os.environ['DATABASE_URL'] = "postgres:///personal_library_test"
-os.environ['FLASK_ENV'] = "production"
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
 
 from app import app, CURR_USER_KEY
 
@@ -51,23 +52,9 @@ class UserBookTagViewTestCase(TestCase):
     def setUp(self):
         """Prepare data for tests."""
 
-        User.query.delete()
-        Book.query.delete()
-        Author.query.delete()
-        Publisher.query.delete()
-        Subject.query.delete()
-        SubjectPlace.query.delete()
-        SubjectPerson.query.delete()
-        SubjectTime.query.delete()
-        BookAuthor.query.delete()
-        BookPublisher.query.delete()
-        BookSubject.query.delete()
-        BookSubjectPlace.query.delete()
-        BookSubjectPerson.query.delete()
-        BookSubjectTime.query.delete()
-        Tag.query.delete()
-        UserTag.query.delete()
-        UserBookTag.query.delete()
+        clean_tables(User, Book, Author, Publisher, Subject, SubjectPlace, SubjectPerson, SubjectTime, BookAuthor,
+                     BookPublisher, BookSubject, BookSubjectPlace, BookSubjectPerson, BookSubjectTime, Tag, UserTag,
+                     UserBookTag)
 
         user = User(username='test_user@nodomain.com', password='password1')
         db.session.add(user)
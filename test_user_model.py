@@ -4,9 +4,10 @@ import os
 from unittest import TestCase
 import sqlalchemy.exc
 from models import db, User
+from isolation import clean_tables
 
-os.environ['DATABASE_URL'] = "postgres:///personal_library_test"
-os.environ['FLASK_ENV'] = "production"
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
 
 from app import app
 
@@ -19,7 +20,7 @@ class UserModelTestCase(TestCase):
     def setUp(self):
         """Create sample user data."""
 
-        User.query.delete()
+        clean_tables(User)
 
         user = User(username="user1@nodomain.com", password="password1")
         db.session.add(user)
@@ -4,10 +4,11 @@ from unittest import TestCase
 import requests
 import datetime
 from models import db, User, Book, UserBook
+from isolation import clean_tables
 from utils import lookup_isbn_open_library, map_response_to_book, search_user_books
 
-os.environ['DATABASE_URL'] = "postgres:///personal_library_test"
-os.environ['FLASK_ENV'] = "production"
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
 
 from app import app
 
@@ -18,9 +19,7 @@ class UtilTests(TestCase):
     """Test utility functions."""
 
     def setUp(self):
-        UserBook.query.delete()
-        Book.query.delete()
-        User.query.delete()
+        clean_tables(UserBook, Book, User)
 
         book = Book(
             isbn="1111111111111",
@@ -0,0 +1,109 @@
+"""Vocabulary name key tests."""
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import text
+from models import db, normalize_name, User, Book, Author, BookAuthor, Subject, BookSubject, UserBook
+from isolation import clean_tables
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', "postgres:///personal_library_test")
+os.environ['FLASK_ENV'] = "testing"
+
+from app import app
+from vocabulary import INSERT_ATTEMPTS, NamesNotResolved, resolve_names, merge_vocabularies
+
+db.create_all()
+
+
+class VocabularyTestCase(TestCase):
+    """Test resolving names through their keys and merging the rows that share one."""
+
+    def setUp(self):
+        clean_tables(UserBook, BookAuthor, BookSubject, Author, Subject, Book, User)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name('Tolkien, J.R.R.', person=True), 'j r r tolkien')
+        self.assertEqual(normalize_name('J. R. R. Tolkien', person=True), 'j r r tolkien')
+        self.assertEqual(normalize_name('Gabriel García Márquez'), 'gabriel garcia marquez')
+        self.assertEqual(normalize_name('Science-Fiction'), normalize_name('science fiction'))
+        # only people's names are turned around
+        self.assertEqual(normalize_name('Fiction, general'), 'fiction general')
+        # symbols that tell names apart are kept, names that are nothing but punctuation are their own key
+        self.assertEqual([normalize_name(name) for name in ['C++', 'C#', 'C', 'F# Programming']],
+                         ['c++', 'c#', 'c', 'f# programming'])
+        self.assertEqual(normalize_name('?!'), '?!')
+        self.assertEqual(normalize_name('  '), '')
+
+    def test_resolve_symbols(self):
+        """Names differing in a meaningful symbol get rows of their own, blank names none."""
+
+        subjects = resolve_names(Subject, ['C++', 'C#', 'C', 'c++', '?!', '...', ' '])
+
+        self.assertEqual([subject.name for subject in subjects], ['C++', 'C#', 'C', '?!', '...'])
+        self.assertEqual(Subject.query.count(), 5)
+        self.assertNotIn('', [subject.name_key for subject in Subject.query])
+
+    def test_resolve_names(self):
+        """Known names under another spelling reuse their row, new ones are added once."""
+
+        tolkien = Author(name='J. R. R. Tolkien')
+        db.session.add(tolkien)
+        db.session.commit()
+
+        authors = resolve_names(Author, ['Tolkien, J.R.R.', 'Christopher Tolkien', 'christopher tolkien', ''])
+
+        self.assertEqual([author.name for author in authors], ['J. R. R. Tolkien', 'Christopher Tolkien'])
+        self.assertEqual(authors[0].id, tolkien.id)
+        self.assertEqual(Author.query.count(), 2)
+
+    def test_inserted_names_keep_vanishing(self):
+        """A name that's gone again after every insert is given up on, instead of being inserted forever."""
+
+        with patch('vocabulary.insert') as insert:
+            insert.return_value.values.return_value.on_conflict_do_nothing.return_value = text('SELECT 1')
+            with self.assertRaises(NamesNotResolved):
+                resolve_names(Author, ['Short Lived'])
+
+        self.assertEqual(insert.call_count, INSERT_ATTEMPTS)
+
+    def test_merge_vocabularies(self):
+        """Rows from before the key existed are keyed, duplicates merged into the oldest with their books."""
+
+        user = User(username='test_user@nodomain.com', password='password1')
+        oldest, newer, other = Author(name='J. R. R. Tolkien'), Author(name='Tolkien, J.R.R.'), Author(name='Other')
+        fantasy, fantasy_again = Subject(name='Fantasy'), Subject(name='FANTASY')
+        db.session.add(fantasy)
+        db.session.commit()
+        hobbit = Book(isbn='1', open_library_id='abcd', title='The Hobbit')
+        hobbit.authors.extend([oldest, newer])
+        hobbit.subjects.append(fantasy_again)
+        silmarillion = Book(isbn='2', open_library_id='abcd', title='The Silmarillion')
+        silmarillion.authors.extend([newer, other])
+        db.session.add_all([user, hobbit, silmarillion])
+        db.session.commit()
+        db.session.add(UserBook(user_id=user.id, book_id=silmarillion.id))
+        db.session.query(Author).update({'name_key': None})
+        db.session.query(Subject).update({'name_key': None})
+        db.session.commit()
+        ids = oldest.id, hobbit.id, silmarillion.id, user.id
+        versions = hobbit.version, silmarillion.version, user.library_version
+
+        counts = merge_vocabularies()
+        db.session.expire_all()
+        oldest_id, hobbit_id, silmarillion_id, user_id = ids
+
+        self.assertEqual(counts['authors'], (3, 1))
+        self.assertEqual(counts['subjects'], (2, 1))
+        self.assertEqual(Author.query.filter(Author.name_key.is_(None)).count(), 0)
+        self.assertEqual(sorted(author.name for author in Author.query), ['J. R. R. Tolkien', 'Other'])
+        self.assertEqual([author.id for author in Book.query.get(hobbit_id).authors], [oldest_id])
+        self.assertEqual(sorted(author.name for author in Book.query.get(silmarillion_id).authors),
+                         ['J. R. R. Tolkien', 'Other'])
+        self.assertEqual([subject.name for subject in Book.query.get(hobbit_id).subjects], ['Fantasy'])
+        # the hobbit had a merged author and a merged subject
+        self.assertEqual(Book.query.get(hobbit_id).version, versions[0] + 2)
+        self.assertEqual(Book.query.get(silmarillion_id).version, versions[1] + 1)
+        self.assertEqual(User.query.get(user_id).library_version, versions[2] + 1)
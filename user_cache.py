@@ -0,0 +1,119 @@
+"""
+The logged in user, which add_user_to_g looks up at the start of every request, kept in each worker's memory.
+
+Entries are the user's column values, attached to the request's session without a query. A change to the user's row
+drops the entry in every worker: the flush that makes it marks it for this worker, and the trigger on the users table
+notifies the others (see invalidation). Entries older than INVALIDATION_TTL seconds are loaded again.
+
+library_version is left out. The search cache, the autocomplete indexes and the api etags are keyed on it, and a copy
+that missed an invalidation would serve them from before another worker's write. The cached user has it expired, so
+the first read in a request selects it from the row.
+"""
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+
+from flask import current_app
+from prometheus_client import Counter
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from invalidation import pending
+from models import db, User
+
+# read from the database on every request that uses it
+UNCACHED_COLUMNS = {'library_version'}
+
+USER_CACHE_LOOKUPS = Counter('user_cache_lookups', 'Logged in user lookups', ['outcome'])
+
+
+def user_key(user_id):
+    return f'user:{user_id}'
+
+
+class UserCache:
+    """The column values of the most recently active users, up to `max_users`, each trusted for `ttl` seconds."""
+
+    def __init__(self, max_users=10000, ttl=60):
+        self.max_users = max_users
+        self.ttl = ttl
+        # bumped by every invalidation, so a load that raced one isn't kept
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            loaded, columns = entry
+            if time.monotonic() - loaded > self.ttl:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return columns
+
+    def set(self, user_id, columns, generation):
+        """Keep the user's `columns`, read while the cache was at `generation`, unless an invalidation came since."""
+
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[user_id] = (time.monotonic(), columns)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, name):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(int(name), None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def note_changed_users(session, flush_context):
+    # still the state from before the flush, the users it wrote
+    for obj in chain(session.dirty, session.deleted):
+        if isinstance(obj, User):
+            pending(user_key(obj.id), session)
+
+
+def init_user_cache(app):
+    cache = app.extensions['user_cache'] = UserCache(app.config['USER_CACHE_SIZE'], app.config['INVALIDATION_TTL'])
+    app.extensions['invalidation'].subscribe('user', cache)
+    if not event.contains(db.session, 'after_flush', note_changed_users):
+        event.listen(db.session, 'after_flush', note_changed_users)
+
+
+def get_user_cache():
+    return current_app.extensions['user_cache']
+
+
+def load_user(user_id):
+    """The user with `user_id` in the session, or None. From the cache when it's there."""
+
+    cache = get_user_cache()
+    columns = cache.get(user_id)
+    if columns is not None:
+        USER_CACHE_LOOKUPS.labels('hit').inc()
+        user = User(**columns)
+        # marks the uncached columns expired, to be loaded on first use
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    USER_CACHE_LOOKUPS.labels('miss').inc()
+    generation = cache.generation
+    user = User.query.get(user_id)
+    if user is not None:
+        cache.set(user_id, {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs
+                            if attr.key not in UNCACHED_COLUMNS}, generation)
+    return user
@@ -1,16 +1,59 @@
 import requests
 from datetime import datetime
 from dateutil.parser import parse
-from flask import flash
+from flask import current_app, flash, has_app_context
+from requests.adapters import HTTPAdapter
+from metrics import open_library_call
 from models import db, Book, Author, Publisher, Subject, SubjectPlace, SubjectPerson, SubjectTime, UserBook
+from rate_limit import Budget, throttle
+from vocabulary import resolve_names
 
 DEFAULT_DATE = datetime(1900, 1, 1)
 
+# one session for every call so connections to open library are kept alive and reused between requests
+open_library = requests.Session()
+open_library.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=50))
+open_library.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=50))
+
+
+def get_setting(name):
+    """
+    Read a setting from the running app, or outside of one (scripts and tests) from the config of FLASK_ENV. The config
+    is imported here rather than with this module, so it reads the environment as it is when the setting is needed.
+    """
+
+    if has_app_context():
+        return current_app.config[name]
+    from config import get_config
+    return getattr(get_config(), name)
+
+
+def unique(values):
+    """The values that aren't empty, without repeats, in their first order."""
+
+    return list(dict.fromkeys(value for value in values if value))
+
+
+def throttle_open_library(caller):
+    """Wait for a turn to call Open Library from the `caller` budget, 'interactive' or 'background'."""
+
+    if not get_setting('OPEN_LIBRARY_RATE_LIMIT'):
+        return
+    throttle(f'open_library:{caller}', open_library_budget(caller))
+
+
+def open_library_budget(caller, setting=get_setting):
+    """The Open Library budget of `caller` from its settings. Raises ValueError for a rate that isn't above 0."""
+
+    prefix = f'OPEN_LIBRARY_{caller.upper()}'
+    return Budget(setting(f'{prefix}_RATE'), setting(f'{prefix}_BURST'), setting(f'{prefix}_MAX_WAIT'))
+
 
 def lookup_isbn_open_library(isbn):
     """
     Check the database to see if the book has already been added to the database by another user.
     If it is not there, send a get request to external api looking for book data by isbn.
+    Raises RateLimited when Open Library is too busy for a page to wait on.
     """
 
     params = {
@@ -18,7 +61,11 @@ def lookup_isbn_open_library(isbn):
         'jscmd': 'data',
         'format': 'json'
     }
-    resp = requests.get(f'https://openlibrary.org/api/books', params=params)
+    throttle_open_library('interactive')
+    with open_library_call():
+        resp = open_library.get(f"{get_setting('OPEN_LIBRARY_URL')}/api/books",
+                                params=params,
+                                timeout=get_setting('OPEN_LIBRARY_TIMEOUT'))
     if resp.status_code == 500:
         flash('Open Library API is down.')
     elif resp.status_code > 400:
@@ -26,90 +73,87 @@ def lookup_isbn_open_library(isbn):
     return resp
 
 
+def lookup_isbns_open_library(isbns):
+    """
+    Fetch the Open Library data for many isbns in one call, for bulk imports.
+    Returns the response json keyed by 'ISBN:<isbn>', isbns Open Library doesn't know are left out. Raises on errors,
+    including RateLimited when the import budget's queue is too long.
+    """
+
+    params = {
+        'bibkeys': ','.join(f'ISBN:{isbn}' for isbn in isbns),
+        'jscmd': 'data',
+        'format': 'json'
+    }
+    throttle_open_library('background')
+    with open_library_call():
+        resp = open_library.get(f"{get_setting('OPEN_LIBRARY_URL')}/api/books",
+                                params=params,
+                                timeout=get_setting('OPEN_LIBRARY_TIMEOUT'))
+        resp.raise_for_status()
+    return resp.json()
+
+
 def map_response_to_book(resp, isbn):
     """Maps an external api response to a book object."""
 
-    data = resp.json()
-    data_key = data[f'ISBN:{isbn}']
+    return map_book_data(resp.json()[f'ISBN:{isbn}'], isbn)
+
+
+def parse_publish_date(value):
+    """Open Library publish dates are free text ('1997', 'June 2001', 'c1999'), None when there's no telling."""
+
+    if not value:
+        return None
+    try:
+        return parse(value, default=DEFAULT_DATE)
+    except (ValueError, OverflowError):
+        return None
+
+
+def names(data_key, key):
+    """The names listed under `key` in the Open Library data for one isbn."""
+
+    return [item.get('name') for item in data_key.get(key) or []]
+
+
+def map_book_data(data_key, isbn):
+    """Maps the Open Library data for one isbn to a book object."""
+
     book = Book(
         isbn=isbn,
         open_library_id=data_key.get('key'),
         open_library_images=data_key.get('cover') if data_key.get('cover') else None,
         open_library_url=data_key.get('url'),
         number_of_pages=data_key.get('number_of_pages'),
-        publish_date=parse(data_key.get('publish_date'), default=DEFAULT_DATE),
+        publish_date=parse_publish_date(data_key.get('publish_date')),
         title=data_key.get('title')
     )
-    # build list of authors, adding new authors as needed
-    if data_key.get('authors'):
-        for item in data_key.get('authors'):
-            author = Author.query.filter_by(name=item.get('name')).first()
-            if not author:
-                new_author = Author(name=item.get('name'))
-                book.authors.append(new_author)
-            else:
-                book.authors.append(author)
-
-    # build list of publishers, creating new publishers as needed
-    if data_key.get('publishers'):
-        for item in data_key.get('publishers'):
-            publisher = Publisher.query.filter_by(name=item.get('name')).first()
-            if not publisher:
-                new_publisher = Publisher(name=item.get('name'))
-                book.publishers.append(new_publisher)
-            else:
-                book.publishers.append(publisher)
-
-    # build list of subjects, creating new subjects as needed
-    if data_key.get('subjects'):
-        for item in data_key.get('subjects'):
-            subject = Subject.query.filter_by(name=item.get('name')).first()
-            if not subject:
-                new_subject = Subject(name=item.get('name'))
-                book.subjects.append(new_subject)
-            else:
-                book.subjects.append(subject)
-
-    # Build list of subject places, creating new subject places as needed
-    if data_key.get('subject_places'):
-        for item in data_key.get('subject_places'):
-            subject_place = SubjectPlace.query.filter_by(name=item.get('name')).first()
-            if not subject_place:
-                new_subject_place = SubjectPlace(name=item.get('name'))
-                book.subject_places.append(new_subject_place)
-            else:
-                book.subject_places.append(subject_place)
-
-    # build list of subject_people, creating new subject people as needed
-    if data_key.get('subject_people'):
-        for item in data_key.get('subject_people'):
-            subject_person = SubjectPerson.query.filter_by(name=item.get('name')).first()
-            if not subject_person:
-                new_subject_person = SubjectPerson(name=item.get('name'))
-                book.subject_people.append(new_subject_person)
-            else:
-                book.subject_people.append(subject_person)
-
-    # build list of subject times, creating new subject times as needed
-    if data_key.get('subject_times'):
-        for item in data_key.get('subject_times'):
-            subject_time = SubjectTime.query.filter_by(name=item.get('name')).first()
-            if not subject_time:
-                new_subject_time = SubjectTime(name=item.get('name'))
-                book.subject_times.append(new_subject_time)
-            else:
-                book.subject_times.append(subject_time)
+    # each list resolves through the normalized name, so another spelling of a known name reuses its row
+    book.authors = resolve_names(Author, names(data_key, 'authors'))
+    book.publishers = resolve_names(Publisher, names(data_key, 'publishers'))
+    book.subjects = resolve_names(Subject, names(data_key, 'subjects'))
+    book.subject_places = resolve_names(SubjectPlace, names(data_key, 'subject_places'))
+    book.subject_people = resolve_names(SubjectPerson, names(data_key, 'subject_people'))
+    book.subject_times = resolve_names(SubjectTime, names(data_key, 'subject_times'))
 
     return book
 
 
-def search_user_books(user_id, search_field, search_string):
+def search_user_books_query(user_id, search_field, search_string):
     """
-    Return books in the specified user's collection searching on the passed in book attribute and search string.
+    Query for the books in the specified user's collection searching on the passed in book attribute and search string.
     """
     search_query = db.session.query(Book).join(UserBook).filter(UserBook.user_id == user_id)
     if search_field == 'title':
         search_query = search_query.filter(Book.title.ilike(f'%{search_string}%'))
     elif search_field == 'isbn':
         search_query = search_query.filter(Book.isbn == search_string)
-    return search_query.all()
+    return search_query
+
+
+def search_user_books(user_id, search_field, search_string):
+    """
+    Return books in the specified user's collection searching on the passed in book attribute and search string.
+    """
+    return search_user_books_query(user_id, search_field, search_string).all()
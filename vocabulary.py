@@ -0,0 +1,129 @@
+"""
+One row per author, publisher and subject however Open Library spells it.
+
+Every vocabulary row carries name_key, the normalize_name of its name. New names resolve through it, so a book by
+'Tolkien, J.R.R.' links to the existing 'J. R. R. Tolkien'. `flask merge-vocabulary` fills the key in for rows from
+before it existed and merges the rows that share one into the oldest of them, rewriting the link tables with a handful
+of set based statements per table.
+"""
+from sqlalchemy import or_, text
+from sqlalchemy.dialects.postgresql import insert
+
+from api import BOOK_VOCABULARIES
+from models import db, normalize_name, Author, SubjectPerson
+
+# vocabularies of people, where 'Last, First' is turned around
+PERSON_VOCABULARIES = (Author, SubjectPerson)
+# rows given a name_key per statement
+BACKFILL_BATCH = 10000
+# inserts tried for a name the orphan collector keeps deleting before it can be read back
+INSERT_ATTEMPTS = 3
+
+
+class NamesNotResolved(RuntimeError):
+    """The names were deleted again after every one of INSERT_ATTEMPTS inserts."""
+
+
+def name_key(model, name):
+    return normalize_name(name, person=model in PERSON_VOCABULARIES)
+
+
+def existing_rows(model, names):
+    """{key: row} for the names, the oldest row where several share a key. Rows still without a key match by name."""
+
+    keys = [name_key(model, name) for name in names]
+    rows = {}
+    for row in model.query.filter(or_(model.name_key.in_(keys), model.name.in_(names))).order_by(model.id):
+        rows.setdefault(row.name_key or name_key(model, row.name), row)
+    return rows
+
+
+def resolve_names(model, names):
+    """
+    The vocabulary rows for the names, one per distinct key, in order. Names not known under any spelling are inserted.
+    A name inserted by a concurrent request in the meantime is skipped by the insert and read back with the rest.
+    """
+
+    by_key = {}
+    for name in names:
+        key = name_key(model, name) if name else ''
+        if key:
+            by_key.setdefault(key, name)
+    if not by_key:
+        return []
+
+    rows = existing_rows(model, list(by_key.values()))
+    missing = [key for key in by_key if key not in rows]
+    # a row that already existed can be collected as an orphan between the insert and the read, it's inserted again
+    for attempt in range(INSERT_ATTEMPTS):
+        if not missing:
+            break
+        db.session.execute(insert(model.__table__)
+                           .values([{'name': by_key[key], 'name_key': key} for key in missing])
+                           .on_conflict_do_nothing(index_elements=['name']))
+        rows.update(existing_rows(model, [by_key[key] for key in missing]))
+        missing = [key for key in missing if key not in rows]
+    if missing:
+        raise NamesNotResolved(f"{model.__tablename__} deleted as soon as they were inserted: "
+                               f"{', '.join(by_key[key] for key in missing)}")
+    return [rows[key] for key in by_key]
+
+
+def backfill_name_keys(model):
+    """Give the rows without a name_key one, BACKFILL_BATCH rows per update. Returns how many were filled in."""
+
+    table = model.__tablename__
+    filled = 0
+    while True:
+        rows = db.session.query(model.id, model.name).filter(model.name_key.is_(None)).limit(BACKFILL_BATCH).all()
+        if not rows:
+            return filled
+        db.session.execute(text(f'UPDATE {table} SET name_key = new.name_key '
+                                f'FROM unnest(:ids, :keys) AS new(id, name_key) WHERE {table}.id = new.id'),
+                           {'ids': [row_id for row_id, name in rows],
+                            'keys': [name_key(model, name) for row_id, name in rows]})
+        db.session.commit()
+        filled += len(rows)
+
+
+def merge_duplicates(model, link, link_column):
+    """
+    Merge the rows of a vocabulary that share a name_key into the oldest, in one transaction. Books that had a merged
+    row are moved to the survivor, their card versions and their owners' library versions are bumped.
+    Returns the number of rows merged away.
+    """
+
+    table, link_table, column = model.__tablename__, link.__tablename__, link_column.name
+    statements = [
+        # every row that shares its key with an older one, and the oldest it goes into
+        'CREATE TEMP TABLE duplicates AS '
+        f'SELECT id, keep_id FROM (SELECT id, min(id) OVER (PARTITION BY name_key) AS keep_id FROM {table} '
+        'WHERE name_key IS NOT NULL) AS keyed WHERE id <> keep_id',
+        'CREATE TEMP TABLE merged_books AS '
+        f'SELECT DISTINCT book_id FROM {link_table} JOIN duplicates ON {link_table}.{column} = duplicates.id',
+        f'INSERT INTO {link_table} (book_id, {column}) '
+        f'SELECT book_id, keep_id FROM {link_table} JOIN duplicates ON {link_table}.{column} = duplicates.id '
+        'ON CONFLICT DO NOTHING',
+        f'DELETE FROM {link_table} USING duplicates WHERE {link_table}.{column} = duplicates.id',
+        f'DELETE FROM {table} USING duplicates WHERE {table}.id = duplicates.id',
+        'UPDATE books SET version = version + 1 WHERE id IN (SELECT book_id FROM merged_books)',
+        'UPDATE users SET library_version = library_version + 1 '
+        'WHERE id IN (SELECT user_id FROM users_books WHERE book_id IN (SELECT book_id FROM merged_books))',
+        'DROP TABLE duplicates, merged_books',
+    ]
+    merged = 0
+    for statement in statements:
+        result = db.session.execute(text(statement))
+        if statement.startswith(f'DELETE FROM {table} '):
+            merged = result.rowcount
+    db.session.commit()
+    return merged
+
+
+def merge_vocabularies():
+    """Fill in missing keys and merge duplicates in every vocabulary. Returns {table: (keys filled in, rows merged)}."""
+
+    return {
+        model.__tablename__: (backfill_name_keys(model), merge_duplicates(model, link, link_column))
+        for key, model, link, link_column in BOOK_VOCABULARIES
+    }